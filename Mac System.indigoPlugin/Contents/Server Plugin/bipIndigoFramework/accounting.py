@@ -0,0 +1,250 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################################################################################
+""" Subprocess accounting for Indigo plugins
+
+    By Bernard Philippe (bip.philippe) (C) 2015
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.#
+
+    Each subprocess started by shellscript or by the event loop is counted with its wall
+    time and the bytes of its outputs, by command label and by device. The device is the
+    one being polled or actioned by the thread when the subprocess starts (see setDevice),
+    the commands run for all the devices at once, and the actions run by the event loop,
+    being counted for the plugin.
+    The totals since the start and for the last period are written to a JSON or CSV file
+    at each period, if an export file is set.
+"""
+####################################################################################
+
+import indigo
+import core
+import perfstats
+import os
+import csv
+import json
+import time
+import threading
+
+# device name of the subprocesses run outside of a device poll or action
+_pluginDevice = u'plugin'
+# the subprocesses with other labels are counted together beyond this number of labels
+_maxLabels = 200
+_csvColumns = (u'scope', u'name', u'calls', u'seconds', u'stdoutBytes', u'stderrBytes', u'periodCalls', u'periodSeconds')
+
+# device being polled or actioned, per thread
+_context = threading.local()
+
+
+########################################
+def init():
+    """ Initiate the counters
+    """
+    indigo.activePlugin._accounting = accounting()
+    indigo.activePlugin._accountingExport = None
+
+
+def setExport(thepath, theformat=u'json', theperiod=300):
+    """ Set the file the totals are written to
+
+        Args:
+            thepath: file path, or None or empty for no export
+            theformat: u'json' or u'csv'
+            theperiod: time in seconds between two exports
+    """
+    if (thepath is None) or (len(thepath.strip()) == 0):
+        indigo.activePlugin._accountingExport = None
+        return
+    indigo.activePlugin._accountingExport = (os.path.expanduser(thepath.strip()), theformat, theperiod)
+    indigo.activePlugin._accounting.nextExport = time.time() + theperiod
+    core.logger(traceLog = (u'subprocesses accounting exported to %s every %s seconds', indigo.activePlugin._accountingExport[0], theperiod))
+
+
+def setDevice(thedevice):
+    """ Set the device the subprocesses started by the current thread are counted for
+
+        Args:
+            thedevice: device polled or actioned, or None for the plugin
+    """
+    _context.device = None if thedevice is None else thedevice.name
+
+
+def currentDevice():
+    """ Device the subprocesses started by the current thread are counted for
+
+        Returns:
+            device name, or None for the plugin
+    """
+    return getattr(_context, 'device', None)
+
+
+def setPlugin():
+    """ Counts the subprocesses started next by the current thread for the plugin, as
+        the snapshots read for all the devices at once by whichever device poll needs
+        them first
+
+        Returns:
+            device name they were counted for, to be given back to restoreDevice
+    """
+    thedevice = currentDevice()
+    _context.device = None
+    return thedevice
+
+
+def restoreDevice(thedevice):
+    """ Counts the subprocesses started next by the current thread for a device again
+
+        Args:
+            thedevice: device name returned by setPlugin
+    """
+    _context.device = thedevice
+
+
+def record(thecommand, theseconds, theoutput, theerror, thelabel=None, thedevice=None):
+    """ Counts a subprocess once ended
+
+        Args:
+            thecommand: command as text (shell) or list of arguments
+            theseconds: wall time of the subprocess
+            theoutput: standard output bytes read
+            theerror: standard error bytes read
+            thelabel: command label, or None for the first command of thecommand
+            thedevice: device name, or None for the device of the current thread
+    """
+    theaccounting = getattr(indigo.activePlugin, '_accounting', None)
+    if theaccounting is None:
+        return
+    if thelabel is None:
+        if isinstance(thecommand, basestring):
+            thelabel = thecommand.split(u'|')[0]
+        else:
+            thelabel = os.path.basename(thecommand[0])
+    if thedevice is None:
+        thedevice = currentDevice()
+    theaccounting.add(perfstats.commandLabel(thelabel), _pluginDevice if thedevice is None else thedevice, theseconds, len(theoutput), len(theerror))
+
+
+def exportIfDue():
+    """ Writes the export file if the period is passed - called at each dialog cycle
+    """
+    if (indigo.activePlugin._accountingExport is not None) and (time.time() >= indigo.activePlugin._accounting.nextExport):
+        export()
+
+
+def export():
+    """ Writes the export file and starts a new period
+
+        Returns:
+            True if written
+    """
+    if indigo.activePlugin._accountingExport is None:
+        return False
+    (thepath, theformat, theperiod) = indigo.activePlugin._accountingExport
+    theaccounting = indigo.activePlugin._accounting
+    theaccounting.nextExport = time.time() + theperiod
+    thereport = theaccounting.report()
+    # written aside then renamed, so that a reader never gets a partial file
+    thetemppath = thepath + u'.tmp'
+    try:
+        with open(thetemppath, 'wb') as thefile:
+            if theformat == u'csv':
+                _writeCsv(thefile, thereport)
+            else:
+                json.dump(thereport, thefile, indent=1, sort_keys=True, separators=(',', ': '))
+        os.rename(thetemppath, thepath)
+    except (IOError, OSError) as e:
+        core.logger(errLog = u'subprocesses accounting could not be written to %s because %s' % (thepath, e))
+        return False
+    core.logger(traceLog = (u'subprocesses accounting written to %s', thepath))
+    return True
+
+
+def _writeCsv(thefile, thereport):
+    """ One line for the total, then one per label and one per device
+    """
+    thewriter = csv.writer(thefile)
+    thewriter.writerow(_csvColumns)
+    therows = [(u'total', u'', thereport[u'total'])]
+    for thescope in (u'labels', u'devices'):
+        therows.extend([(thescope[:-1], thename, thevalues) for (thename, thevalues) in sorted(thereport[thescope].items())])
+    for (thescope, thename, thevalues) in therows:
+        thewriter.writerow([thescope, thename.encode('utf-8')] + [thevalues[thecolumn] for thecolumn in _csvColumns[2:]])
+
+
+########################################
+class _usage(object):
+    """ Subprocesses count, wall time and output bytes
+    """
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.stdoutBytes = 0
+        self.stderrBytes = 0
+        # at the start of the period
+        self.periodStart = (0, 0.0)
+
+    def add(self, theseconds, theoutbytes, theerrbytes):
+        self.calls = self.calls + 1
+        self.seconds = self.seconds + theseconds
+        self.stdoutBytes = self.stdoutBytes + theoutbytes
+        self.stderrBytes = self.stderrBytes + theerrbytes
+
+    def report(self):
+        thevalues = {u'calls':self.calls,
+                     u'seconds':round(self.seconds, 3),
+                     u'stdoutBytes':self.stdoutBytes,
+                     u'stderrBytes':self.stderrBytes,
+                     u'periodCalls':self.calls - self.periodStart[0],
+                     u'periodSeconds':round(self.seconds - self.periodStart[1], 3)}
+        self.periodStart = (self.calls, self.seconds)
+        return thevalues
+
+
+class accounting(object):
+    """ Subprocesses usage since the start, by label and by device
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._periodStarted = self._started
+        self._total = _usage()
+        self._labels = dict()
+        self._devices = dict()
+        self.nextExport = self._started
+
+    def add(self, thelabel, thedevice, theseconds, theoutbytes, theerrbytes):
+        with self._lock:
+            if (thelabel not in self._labels) and (len(self._labels) >= _maxLabels):
+                thelabel = u'other commands'
+            self._total.add(theseconds, theoutbytes, theerrbytes)
+            self._labels.setdefault(thelabel, _usage()).add(theseconds, theoutbytes, theerrbytes)
+            self._devices.setdefault(thedevice, _usage()).add(theseconds, theoutbytes, theerrbytes)
+
+    def report(self):
+        """ Totals, and the calls and wall time of the period since the previous report
+        """
+        with self._lock:
+            thenow = time.time()
+            thetotal = self._total.report()
+            theperiod = thenow - self._periodStarted
+            thereport = {u'since':time.strftime(u'%Y-%m-%d %H:%M:%S', time.localtime(self._started)),
+                         u'exported':time.strftime(u'%Y-%m-%d %H:%M:%S', time.localtime(thenow)),
+                         u'periodSeconds':round(theperiod, 1),
+                         u'periodCallsPerMinute':round(thetotal[u'periodCalls'] * 60 / theperiod, 2) if theperiod > 0 else 0,
+                         u'total':thetotal,
+                         u'labels':dict([(thelabel, theusage.report()) for (thelabel, theusage) in self._labels.items()]),
+                         u'devices':dict([(thedevice, theusage.report()) for (thedevice, theusage) in self._devices.items()])}
+            self._periodStarted = thenow
+        return thereport
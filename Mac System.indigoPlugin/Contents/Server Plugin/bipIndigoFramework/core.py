@@ -23,6 +23,9 @@
 ####################################################################################
 
 import indigo
+import threading
+import time
+import perfstats
 
 MSG_MAIN_EVENTS = 1
 MSG_SECONDARY_EVENTS = 2
@@ -35,6 +38,16 @@ _debugStateDict = {u'logMainEvents':MSG_MAIN_EVENTS, u'logSecondaryEvents':MSG_S
 
 #ALL_DEBUGS = (MSG_DEBUG | MSG_RAW_DEBUG | MSG_STATES_DEBUG)
 
+# state pushes are serialized when devices are polled by several threads
+_updateLock = threading.RLock()
+# device id -> states as last pushed to the server, in unicode (see shadowstates)
+_shadowStates = dict()
+# device id -> state -> time of the last push
+_pushTimes = dict()
+# state -> (absolute, relative) change under which a numeric state is not pushed (see setdeadbands)
+_deadbands = dict()
+_maxStaleness = 0
+
 ################################################################################
 def debugFlags(valueDict):
     """ Get proporty value of standard indigo debug and an extra raw debug flag (plugin value)
@@ -82,6 +95,9 @@ def logger(traceLog = None, traceRaw = None, msgLog = None, errLog = None, isMai
         or MSG_SECONDARY_EVENTS, depending on isMain
         isMain : true is the message is a MSG_MAIN_EVENTS
 
+        Each text can also be given as a (format, arg1, arg2...) tuple or as a callable
+        returning the text: the text is then only built if the message is to be output
+
         If both traceLog and traceRaw are given:
         - traceLog message only will be output if logLevel contains MSG_DEBUG and not MSG_RAW_DEBUG
         - traceRaw message only will be output if logLevel contains MSG_RAW_DEBUG
@@ -95,17 +111,44 @@ def logger(traceLog = None, traceRaw = None, msgLog = None, errLog = None, isMai
 
     # debug messages
     if (indigo.activePlugin.logLevel & MSG_RAW_DEBUG) and (traceRaw is not None):
-        indigo.activePlugin.debugLog(traceRaw)
+        indigo.activePlugin.debugLog(_logtext(traceRaw))
     elif (indigo.activePlugin.logLevel & MSG_DEBUG) and (traceLog is not None):
-        indigo.activePlugin.debugLog(traceLog)
+        indigo.activePlugin.debugLog(_logtext(traceLog))
 
     # error message
     if errLog is not None:
-        indigo.activePlugin.errorLog(errLog)
+        indigo.activePlugin.errorLog(_logtext(errLog))
 
     # log message (the two levels, depending on msgSec)
     if (msgLog is not None) and ((indigo.activePlugin.logLevel & MSG_SECONDARY_EVENTS) or ((indigo.activePlugin.logLevel & MSG_MAIN_EVENTS) and isMain)):
-        indigo.server.log(msgLog)
+        indigo.server.log(_logtext(msgLog))
+
+
+def _logtext(themessage):
+    """ Builds the text of a log message given as text, (format, args...) tuple or callable
+
+        Args:
+            themessage: message as given to logger
+        Returns:
+            text of the message
+    """
+    if type(themessage) is tuple:
+        return themessage[0] % themessage[1:]
+    elif callable(themessage):
+        return themessage()
+    return themessage
+
+
+########################################
+def isLogging(level):
+    """ Test if messages of a level are going to be output
+
+        Args:
+            level: debug level needed
+        Returns:
+            True if the plugin logLevel contains the level
+    """
+    return (indigo.activePlugin.logLevel & level) != 0
 
 
 ########################################
@@ -215,6 +258,99 @@ def dumpdeviceproperties(thedevice):
     dumpdict(thedevice.pluginProps, u'"' + thedevice.name + '" property %s is %s', level=MSG_DEBUG)
 
 ########################################
+def shadowstates(thedevice):
+    """ Takes a copy of the device states, that updatestates compares the new values to
+        instead of reading the device states - the states must then only be changed
+        by updatestates
+
+        Args:
+            thedevice: device object
+    """
+    theshadow = {}
+    for thekey,thevalue in thedevice.states.iteritems():
+        if type(thevalue) is str:
+            thevalue = thevalue.decode('utf-8')
+        theshadow[thekey] = thevalue
+    thenow = time.time()
+    with _updateLock:
+        _shadowStates[thedevice.id] = theshadow
+        _pushTimes[thedevice.id] = dict.fromkeys(theshadow, thenow)
+
+
+def shadowstate(thedevice, thekey):
+    """ Gives a device state as last pushed by updatestates - the device object given by
+        the server at start may be older than that
+
+        Args:
+            thedevice: device object
+            thekey: state name
+        Returns:
+            the state value, from the device object if no copy was taken
+    """
+    with _updateLock:
+        theshadow = _shadowStates.get(thedevice.id)
+        if (theshadow is not None) and (thekey in theshadow):
+            return theshadow[thekey]
+    thevalue = thedevice.states[thekey] if thekey in thedevice.states else None
+    if type(thevalue) is str:
+        thevalue = thevalue.decode('utf-8')
+    return thevalue
+
+
+def dropshadowstates(thedevice):
+    """ Forgets the copy of the device states taken by shadowstates
+
+        Args:
+            thedevice: device object
+    """
+    with _updateLock:
+        _shadowStates.pop(thedevice.id, None)
+        _pushTimes.pop(thedevice.id, None)
+
+
+def setdeadbands(thedeadbands, themaxstaleness=0):
+    """ Set the changes of numeric states that updatestates does not push, unless other
+        states of the device are pushed or the state was not pushed for themaxstaleness -
+        onOffState is never held back, nor the states which value is not a number
+
+        Args:
+            thedeadbands: python dictionnary of the states names and (absolute, relative)
+                          changes, a change being pushed if greater or equal to the absolute
+                          change or to the relative change times the last pushed value
+            themaxstaleness: time in seconds after which a change is pushed anyway,
+                             or 0 for no limit
+    """
+    global _deadbands, _maxStaleness
+    with _updateLock:
+        _deadbands = dict(thedeadbands)
+        _deadbands.pop(u'onOffState', None)
+        _maxStaleness = themaxstaleness
+
+
+def _number(thevalue):
+    """ Value of a numeric state as a float, or None if not a number
+    """
+    if type(thevalue) is bool:
+        return None
+    try:
+        return float(thevalue)
+    except (TypeError, ValueError):
+        return None
+
+
+def _indeadband(thekey, theactualvalue, thevalue):
+    """ Test if the change of a state is within its deadband
+    """
+    if thekey not in _deadbands:
+        return False
+    theactualnumber = _number(theactualvalue)
+    thenumber = _number(thevalue)
+    if (theactualnumber is None) or (thenumber is None):
+        return False
+    (theabsolute, therelative) = _deadbands[thekey]
+    return abs(thenumber - theactualnumber) < max(theabsolute, therelative * abs(theactualnumber))
+
+
 def updatestates(thedevice, thevaluesDict):
     """ Update device states on server and log if changed
 
@@ -225,31 +361,70 @@ def updatestates(thedevice, thevaluesDict):
             Python dictionnary of the states names and values that have been changed
     """
 
-    updateDict = {}
-
-    for thekey,thevalue in thevaluesDict.iteritems():
-        theactualvalue=thedevice.states[thekey]
-        if type(theactualvalue) is str:
-            theactualvalue = theactualvalue.decode('utf-8')
-        if type(thevalue) is str:
-            thevalue=thevalue.decode('utf-8')
-
-        if theactualvalue != thevalue :
-            logger(traceRaw = u'"%s" %s value : %s != %s' % (thedevice.name, thekey, formatdump(thedevice.states[thekey]),formatdump(thevalue)))
-            thedevice.updateStateOnServer(key=thekey, value=thevalue)
-            updateDict[thekey]=thevalue
-        else:
-            logger(traceRaw = u'"%s" %s value : %s == %s' % (thedevice.name, thekey, formatdump(thedevice.states[thekey]),formatdump(thevalue)))
+    with _updateLock:
+        updateDict = {}
+        updateList = []
+
+        rawdebug = isLogging(MSG_RAW_DEBUG)
+        theshadow = _shadowStates.get(thedevice.id)
+        thepushtimes = _pushTimes.get(thedevice.id)
+        thenow = time.time()
+        # changes held back by their deadband
+        thebandDict = {}
+
+        for thekey,thevalue in thevaluesDict.iteritems():
+            if type(thevalue) is str:
+                thevalue=thevalue.decode('utf-8')
+            if (theshadow is not None) and (thekey in theshadow):
+                theactualvalue = theshadow[thekey]
+            else:
+                # states added by upgradeDeviceStates may not be in the device object yet
+                theactualvalue=thedevice.states[thekey] if thekey in thedevice.states else None
+                if type(theactualvalue) is str:
+                    theactualvalue = theactualvalue.decode('utf-8')
+                if theshadow is not None:
+                    theshadow[thekey] = theactualvalue
+
+            if theactualvalue == thevalue:
+                if rawdebug:
+                    logger(traceRaw = (u'"%s" %s value : %s == %s', thedevice.name, thekey, formatdump(theactualvalue), formatdump(thevalue)))
+            elif (thepushtimes is not None) and _indeadband(thekey, theactualvalue, thevalue) \
+                    and ((_maxStaleness <= 0) or (thenow - thepushtimes.get(thekey, thenow) < _maxStaleness)):
+                if rawdebug:
+                    logger(traceRaw = (u'"%s" %s value : %s ~ %s within deadband', thedevice.name, thekey, formatdump(theactualvalue), formatdump(thevalue)))
+                thebandDict[thekey]=thevalue
+            else:
+                if rawdebug:
+                    logger(traceRaw = (u'"%s" %s value : %s != %s', thedevice.name, thekey, formatdump(theactualvalue), formatdump(thevalue)))
+                updateList.append({u'key':thekey, u'value':thevalue})
+                updateDict[thekey]=thevalue
 
-    if len(updateDict)>0:
-        indigo.activePlugin.sleep(0.2)
-        if (thedevice.displayStateId in updateDict):
-            thelevel = MSG_MAIN_EVENTS
-        else:
-            thelevel = MSG_SECONDARY_EVENTS
-        dumpdict(updateDict,theformat=u'received "'+thedevice.name+'" status %s update to %s', level=thelevel)
+        if len(updateDict)>0:
+            # the changes held back are sent along, as the device is pushed anyway
+            for thekey,thevalue in thebandDict.iteritems():
+                updateList.append({u'key':thekey, u'value':thevalue})
+                updateDict[thekey]=thevalue
+            # push all the changed states at once when the server API allows it
+            thestart = perfstats.start()
+            if hasattr(thedevice, u'updateStatesOnServer'):
+                thedevice.updateStatesOnServer(updateList)
+            else:
+                for theupdate in updateList:
+                    thedevice.updateStateOnServer(key=theupdate[u'key'], value=theupdate[u'value'])
+            perfstats.phase(u'statePush', thestart)
+            if theshadow is not None:
+                theshadow.update(updateDict)
+            if thepushtimes is not None:
+                for thekey in updateDict:
+                    thepushtimes[thekey] = thenow
+
+            if (thedevice.displayStateId in updateDict):
+                thelevel = MSG_MAIN_EVENTS
+            else:
+                thelevel = MSG_SECONDARY_EVENTS
+            dumpdict(updateDict,theformat=u'received "'+thedevice.name+'" status %s update to %s', level=thelevel)
 
-    return updateDict
+        return updateDict
 
 
 ########################################
@@ -265,11 +440,15 @@ def specialimage(thedevice, thekey, thedict, theimagedict):
 
     if thekey in thedict:
         if thedict[thekey] in theimagedict:
-            logger(traceLog = u'device "%s" has special image for %s with vakue %s' % (thedevice.name, thekey, formatdump(thedict[thekey])))
-            thedevice.updateStateImageOnServer(theimagedict[thedict[thekey]])
+            logger(traceLog = lambda: u'device "%s" has special image for %s with vakue %s' % (thedevice.name, thekey, formatdump(thedict[thekey])))
+            theimage = theimagedict[thedict[thekey]]
         else:
-            logger(traceLog = u'device "%s" has automatic image for %s with value %s' % (thedevice.name, thekey, formatdump(thedict[thekey])))
-            thedevice.updateStateImageOnServer(indigo.kStateImageSel.Auto)
+            logger(traceLog = lambda: u'device "%s" has automatic image for %s with value %s' % (thedevice.name, thekey, formatdump(thedict[thekey])))
+            theimage = indigo.kStateImageSel.Auto
+        with _updateLock:
+            thestart = perfstats.start()
+            thedevice.updateStateImageOnServer(theimage)
+            perfstats.phase(u'statePush', thestart)
 
 
 ########################################
@@ -301,7 +480,9 @@ def updatedeviceprops(thedevice, thevaluesDict):
             logger(traceRaw = u'"%s" value : %s == %s' % (thekey, formatdump(localprops[thekey]),formatdump(thevalue)))
 
         if len(updateDict)>0:
+            thestart = perfstats.start()
             indigo.activePlugin.sleep(0.2)
+            perfstats.phase(u'fixedSleep', thestart)
             dumpdict(updateDict,theformat=u'"'+thedevice.name+'" property %s updated to %s', level=MSG_MAIN_EVENTS)
 
     return updateDict
@@ -334,7 +515,9 @@ def updatepluginprops(thevaluesDict):
             logger(traceRaw = u'property %s value: %s == %s' % (thekey, formatdump(indigo.activePlugin.pluginPrefs[thekey]),formatdump(thevalue)))
 
         if len(updateDict)>0:
+            thestart = perfstats.start()
             indigo.activePlugin.sleep(0.2)
+            perfstats.phase(u'fixedSleep', thestart)
             dumpdict(updateDict,theformat=u'pluging property %s updated to %s', level=MSG_MAIN_EVENTS)
 
     return updateDict
@@ -390,11 +573,11 @@ def upgradeDeviceStates(thedevice, theUpgradeStatesList):
 
     dumplist(theUpgradeStatesList, u'"' + thedevice.name + u'" requires state %s',level=MSG_STATES_DEBUG)
 
-    theupdatelist=()
+    theupdatelist=[]
     for newStateName in theUpgradeStatesList:
-        if not (newStateName in self.indigoDevice.states):
+        if not (newStateName in thedevice.states):
             logger(traceRaw=u'"%s" state %s missing' % (thedevice.name,newStateName))
-            theupdatelist = theupdatelist + newStateName
+            theupdatelist.append(newStateName)
     if len(theupdatelist)>0:
         thedevice.stateListOrDisplayStateIdChanged();
         dumplist(theupdatelist, u'"%s" states added' % (thedevice.name),level=MSG_DEBUG)
@@ -23,14 +23,74 @@
 
 import indigo
 import core
+import accounting
 import time
-from threading import Timer
+import sys
+import heapq
+import itertools
+import ctypes
+import ctypes.util
+import threading
+import Queue
+
+
+########################################
+def _monotonicClock():
+    """ Find a monotonic clock function for the platform
+
+        Returns:
+            a function returning a time in seconds that never goes backward
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+
+    try:
+        if sys.platform == 'darwin':
+            # mach absolute time converted to seconds using the timebase
+            class _machTimebaseInfo(ctypes.Structure):
+                _fields_ = [('numer', ctypes.c_uint32), ('denom', ctypes.c_uint32)]
+
+            libc = ctypes.CDLL(ctypes.util.find_library('c'))
+            machabsolutetime = libc.mach_absolute_time
+            machabsolutetime.restype = ctypes.c_uint64
+            timebase = _machTimebaseInfo()
+            libc.mach_timebase_info(ctypes.byref(timebase))
+            factor = float(timebase.numer) / timebase.denom / 1e9
+
+            return lambda: machabsolutetime() * factor
+        else:
+            # posix CLOCK_MONOTONIC
+            class _timespec(ctypes.Structure):
+                _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            clockgettime = libc.clock_gettime
+            clockgettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+            thetimespec = _timespec()
+            if clockgettime(1, ctypes.byref(thetimespec)) != 0:
+                raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+
+            def _clock():
+                t = _timespec()
+                clockgettime(1, ctypes.byref(t))
+                return t.tv_sec + t.tv_nsec * 1e-9
+            return _clock
+    except Exception:
+        return time.time
+
+monotonic = _monotonicClock()
 
 
 def init():
     """ Initiate
     """
     indigo.activePlugin._requestedUpdate = dict()
+    indigo.activePlugin._scheduler = dialogScheduler()
+    indigo.activePlugin._deviceTimers = dict()
+    indigo.activePlugin._devicePace = (10, 10, 1)
+    indigo.activePlugin._sleepWaiter = None
+    indigo.activePlugin._devicePool = None
+    indigo.activePlugin.wakeup = monotonic()
 
 ########################################
 def setUpdateRequest(thedevice, nbTime=1):
@@ -40,8 +100,9 @@ def setUpdateRequest(thedevice, nbTime=1):
         thedevice: current device
     """
 
-    core.logger(traceLog = u'Device "%s" has %s update requests stacked' % (thedevice.name,nbTime))
+    core.logger(traceLog = (u'Device "%s" has %s update requests stacked', thedevice.name, nbTime))
     indigo.activePlugin._requestedUpdate[thedevice.id]=nbTime
+    resetDevicePace(thedevice)
 
 
 ########################################
@@ -57,35 +118,386 @@ def isUpdateRequested(thedevice):
     if thedevice.id in indigo.activePlugin._requestedUpdate:
         if indigo.activePlugin._requestedUpdate[thedevice.id]>0:
             indigo.activePlugin._requestedUpdate[thedevice.id] = indigo.activePlugin._requestedUpdate[thedevice.id]-1
-            core.logger(traceLog = u'Device "%s" is going to process an update request' % (thedevice.name))
+            core.logger(traceLog = (u'Device "%s" is going to process an update request', thedevice.name))
             return True
 
     return False
 
 
+def hasUpdateRequest(thedevice):
+    """ Test if the device has update requests stacked, without using one
+
+        Args:
+            thedevice: current device
+        Returns:
+            True if some update requests are stacked
+    """
+    return indigo.activePlugin._requestedUpdate.get(thedevice.id, 0) > 0
+
+
 ########################################
-def sleepNext(thetime):
-    """ Calculate sleep time according main dialog pace
-        
+def setDevicePace(mininterval, maxinterval, factor):
+    """ Set the adaptive polling pace of the devices
+
+        Args:
+            mininterval: interval in seconds after a change
+            maxinterval: maximum interval in seconds for devices without change
+            factor: growth factor of the interval at each poll without change
+    """
+    core.logger(traceLog = (u'device polling pace set from %s to %s seconds by a %s factor', mininterval, maxinterval, factor))
+    indigo.activePlugin._devicePace = (mininterval, maxinterval, factor)
+    for thetimer in indigo.activePlugin._deviceTimers.values():
+        thetimer.setPace(mininterval, maxinterval, factor)
+
+
+def isDeviceTime(thedevice):
+    """ Test if the device is due for polling according its adaptive pace
+
+        Args:
+            thedevice: current device
+        Returns:
+            True if the device is to be polled
+    """
+    if thedevice.id not in indigo.activePlugin._deviceTimers:
+        (mininterval, maxinterval, factor) = indigo.activePlugin._devicePace
+        indigo.activePlugin._deviceTimers[thedevice.id] = adaptiveTimer(u'Poll "%s"' % (thedevice.name), mininterval, maxinterval, factor)
+    return indigo.activePlugin._deviceTimers[thedevice.id].isTime()
+
+
+def isDeviceDue(thedevice):
+    """ Test if the device is due for polling, without taking the poll as done
+
+        Args:
+            thedevice: current device
+        Returns:
+            True if the device is to be polled
+    """
+    if thedevice.id not in indigo.activePlugin._deviceTimers:
+        return True
+    return indigo.activePlugin._deviceTimers[thedevice.id].isDue()
+
+
+def devicePolled(thedevice, hasChanged):
+    """ Adapt the polling pace of the device after a poll
+
+        Args:
+            thedevice: current device
+            hasChanged: True if the poll changed some device states
+    """
+    if thedevice.id in indigo.activePlugin._deviceTimers:
+        indigo.activePlugin._deviceTimers[thedevice.id].polled(hasChanged)
+
+
+def resetDevicePace(thedevice):
+    """ Set the device back to the fast pace and make it due now
+
+        Args:
+            thedevice: current device
+    """
+    if thedevice.id in indigo.activePlugin._deviceTimers:
+        indigo.activePlugin._deviceTimers[thedevice.id].reset()
+
+
+def removeDevicePace(thedevice):
+    """ Stop the adaptive polling pace of a device
+
+        Args:
+            thedevice: current device
+    """
+    if thedevice.id in indigo.activePlugin._deviceTimers:
+        indigo.activePlugin._deviceTimers[thedevice.id].cancel()
+        del indigo.activePlugin._deviceTimers[thedevice.id]
+
+
+########################################
+def sleepNext(thetime=None):
+    """ Sleep until the next dialog timer is due
+
         Args:
-            thetime: time in seconds between two dialog calls
+            thetime: maximum time in seconds between two dialog calls,
+                     or None for the fast device pace (as actions may reset device timers)
     """
 
-    nextdelay = thetime - (time.time() - indigo.activePlugin.wakeup)
+    thenow = monotonic()
+    nextdelay = nextDelay(thetime)
 
-    nextdelay = round(nextdelay,2)
-    if nextdelay < 1:
-        nextdelay = 0.5
+    core.logger(traceLog = (u'going to sleep for %s seconds', nextdelay))
+    if indigo.activePlugin._sleepWaiter is None:
+        indigo.activePlugin.sleep(nextdelay)
+        return
 
-    core.logger(traceLog = u'going to sleep for %s seconds' % (nextdelay))
-    indigo.activePlugin.sleep(nextdelay)
+    # wait for events by slices, letting the host stop the thread between them
+    thedeadline = thenow + nextdelay
+    while True:
+        theremaining = thedeadline - monotonic()
+        if theremaining <= 0:
+            # the events of the last slice are taken by the cycle starting, as the event
+            # engine does, instead of waking the next sleep up at once
+            indigo.activePlugin._sleepWaiter(0)
+            break
+        if indigo.activePlugin._sleepWaiter(min(theremaining, 1.0)):
+            core.logger(traceLog = u'sleep interrupted by an event')
+            break
+        indigo.activePlugin.sleep(0.01)
+
+
+def nextDelay(thetime=None):
+    """ Time until the next dialog timer is due
+
+        Args:
+            thetime: maximum time in seconds between two dialog calls,
+                     or None for the fast device pace
+        Returns:
+            delay in seconds from now
+    """
+    if thetime is None:
+        thetime = indigo.activePlugin._devicePace[0]
+
+    thedeadline = indigo.activePlugin._scheduler.nextDeadline()
+    if (thedeadline is None) or (thedeadline > indigo.activePlugin.wakeup + thetime):
+        thedeadline = indigo.activePlugin.wakeup + thetime
+
+    nextdelay = round(thedeadline - monotonic(),2)
+    if nextdelay < 0.05:
+        nextdelay = 0.05
+    return nextdelay
+
+
+def setWaiter(thewaiter):
+    """ Set a function to be used by sleepNext instead of sleeping, to be woken up by events
+
+        Args:
+            thewaiter: function(timeout) waiting at most timeout seconds and returning True
+                       if an event occured, or None to sleep only
+    """
+    indigo.activePlugin._sleepWaiter = thewaiter
 
 
 def sleepWake():
     """ Take the time before one ConcurrentThread run
     """
 
-    indigo.activePlugin.wakeup = time.time()
+    indigo.activePlugin.wakeup = monotonic()
+
+
+def nextDeadline():
+    """ Monotonic time of the next dialog timer due
+
+        Returns:
+            time in seconds (see monotonic) or None if no timer
+    """
+    return indigo.activePlugin._scheduler.nextDeadline()
+
+
+########################################
+def setDevicePool(thesize):
+    """ Set the number of devices polled at once
+
+        Args:
+            thesize: number of worker threads, 1 to poll the devices one after the other
+    """
+    if indigo.activePlugin._devicePool is not None:
+        if indigo.activePlugin._devicePool.size == thesize:
+            return
+        indigo.activePlugin._devicePool.stop()
+        indigo.activePlugin._devicePool = None
+    if thesize > 1:
+        indigo.activePlugin._devicePool = devicePool(thesize)
+    core.logger(traceLog = (u'devices polled by %s threads', thesize))
+
+
+def pollDevice(thedevice, thefunction, *theargs):
+    """ Poll a device, in a worker thread if a device pool is set
+
+        Args:
+            thedevice: current device
+            thefunction: polling function, called with thedevice and theargs
+            theargs: other arguments of the polling function
+    """
+    if indigo.activePlugin._devicePool is None:
+        _poll(thedevice, thefunction, theargs)
+    else:
+        indigo.activePlugin._devicePool.submit(thedevice, thefunction, theargs)
+
+
+def _poll(thedevice, thefunction, theargs):
+    """ Calls the polling function, the subprocesses it starts being accounted for the device
+    """
+    accounting.setDevice(thedevice)
+    try:
+        thefunction(thedevice, *theargs)
+    finally:
+        accounting.setDevice(None)
+
+
+def waitDevicePolls(thetimeout=None):
+    """ Wait for the device polls of the cycle
+
+        Args:
+            thetimeout: maximum time in seconds to wait,
+                        or None for the fast device pace (the cycle deadline)
+        Returns:
+            list of the names of the devices still being polled
+    """
+    if indigo.activePlugin._devicePool is None:
+        return []
+    if thetimeout is None:
+        thetimeout = indigo.activePlugin._devicePace[0]
+    return indigo.activePlugin._devicePool.join(monotonic() + thetimeout)
+
+
+########################################
+class devicePool(object):
+    """ Bounded pool of worker threads polling devices concurrently
+        A device is polled by one worker at a time: a device whose previous poll
+        is not finished is not polled again until it is.
+    """
+    def __init__(self, thesize):
+        """ Constructor
+
+            Args:
+                thesize: number of worker threads
+        """
+        self.size = thesize
+        self._queue = Queue.Queue()
+        self._busy = dict()
+        self._condition = threading.Condition()
+        self._workers = []
+        for theindex in range(thesize):
+            theworker = threading.Thread(target=self._work, name=u'device poll %s' % (theindex+1))
+            theworker.daemon = True
+            theworker.start()
+            self._workers.append(theworker)
+
+    def submit(self, thedevice, thefunction, theargs):
+        """ Queue the poll of a device
+
+            Returns:
+                True if queued, False if the previous poll of the device is still running
+        """
+        with self._condition:
+            if thedevice.id in self._busy:
+                core.logger(traceLog = (u'device "%s" is still being polled', thedevice.name))
+                return False
+            self._busy[thedevice.id] = thedevice.name
+        self._queue.put((thedevice, thefunction, theargs))
+        return True
+
+    def join(self, thedeadline):
+        """ Wait until all the polls are done or the deadline is passed
+
+            Args:
+                thedeadline: monotonic time in seconds
+            Returns:
+                list of the names of the devices still being polled
+        """
+        with self._condition:
+            while len(self._busy) > 0:
+                theremaining = thedeadline - monotonic()
+                if theremaining <= 0:
+                    break
+                self._condition.wait(theremaining)
+            return self._busy.values()
+
+    def stop(self):
+        """ Stop the worker threads once the queued polls are done
+        """
+        for theworker in self._workers:
+            self._queue.put(None)
+
+    def _work(self):
+        while True:
+            thejob = self._queue.get()
+            if thejob is None:
+                return
+            (thedevice, thefunction, theargs) = thejob
+            try:
+                _poll(thedevice, thefunction, theargs)
+            except Exception as e:
+                core.logger(errLog = u'device "%s" poll failed because %s' % (thedevice.name, e))
+            finally:
+                with self._condition:
+                    del self._busy[thedevice.id]
+                    self._condition.notify_all()
+
+
+########################################
+class dialogScheduler(object):
+    """ Heap of the dialog timers deadlines on the monotonic clock, used by runConcurrentThread
+        to know how long it can sleep - no thread is involved
+
+        A timer has one live entry: postponing it leaves its entry in place, to be moved to
+        the new deadline when it reaches the top, and the entries left by the timers
+        brought forward or cancelled are dropped once they outnumber the live ones
+    """
+    # timers due within this delay are considered as due, so that they run in the same pass
+    tolerance = 0.5
+
+    def __init__(self):
+        """ Constructor
+        """
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        # entries of the timers rescheduled or cancelled since pushed
+        self._stale = 0
+
+    def push(self, thetimer):
+        """ Take the current deadline of a timer into account
+
+            Args:
+                thetimer: dialogTimer instance
+        """
+        with self._lock:
+            if thetimer.queuedDeadline is not None:
+                if thetimer.queuedDeadline <= thetimer.deadline:
+                    # postponed: its entry comes first anyway
+                    return
+                self._stale = self._stale + 1
+            thetimer.generation = thetimer.generation + 1
+            thetimer.queuedDeadline = thetimer.deadline
+            heapq.heappush(self._heap, (thetimer.deadline, next(self._counter), thetimer, thetimer.generation))
+            self._compact()
+
+    def remove(self, thetimer):
+        """ Forget a timer
+
+            Args:
+                thetimer: dialogTimer instance
+        """
+        with self._lock:
+            if thetimer.queuedDeadline is not None:
+                self._stale = self._stale + 1
+                thetimer.generation = thetimer.generation + 1
+                thetimer.queuedDeadline = None
+                self._compact()
+
+    def _compact(self):
+        if self._stale > len(self._heap) - self._stale:
+            self._heap = [theentry for theentry in self._heap if theentry[3] == theentry[2].generation]
+            heapq.heapify(self._heap)
+            self._stale = 0
+
+    def nextDeadline(self):
+        """ Time of the first deadline
+
+            Returns:
+                monotonic time in seconds or None if no timer
+        """
+        with self._lock:
+            while len(self._heap)>0:
+                (thedeadline, thecount, thetimer, thegeneration) = self._heap[0]
+                if thegeneration != thetimer.generation:
+                    # timer rescheduled earlier or cancelled since
+                    heapq.heappop(self._heap)
+                    self._stale = self._stale - 1
+                elif thedeadline < thetimer.deadline:
+                    # timer postponed since: its entry goes to its deadline
+                    heapq.heapreplace(self._heap, (thetimer.deadline, next(self._counter), thetimer, thegeneration))
+                    thetimer.queuedDeadline = thetimer.deadline
+                else:
+                    return thedeadline
+        return None
 
 
 ########################################
@@ -102,27 +514,26 @@ class dialogTimer(object):
             Returns:
                 dialogTimer class instance
         """
-        self._timer     = None
         self.timername = timername
-        self.initialinterval = initialinterval
         self.interval   = interval
         self.timeEllapsed = True
-        core.logger(traceLog = u'initiating dialog timer "%s" on a %s seconds pace' % (self.timername, interval))
-        self._run()
-
-    def __del__(self):
-        core.logger(traceLog = u'deleting dialog timer "%s"' % (self.timername))
-        self._timer.cancel()
-    
-    def _run(self):
-        core.logger(traceLog = u'time ellapsed for dialog timer "%s"' % (self.timername))
-        self.timeEllapsed = True
-        if self.initialinterval>0:
-            self._timer = Timer(self.initialinterval, self._run)
-            self.initialinterval=0
+        # scheduler entry (see dialogScheduler)
+        self.generation = 0
+        self.queuedDeadline = None
+        core.logger(traceLog = (u'initiating dialog timer "%s" on a %s seconds pace', self.timername, interval))
+        if initialinterval>0:
+            self._schedule(monotonic() + initialinterval)
         else:
-            self._timer = Timer(self.interval, self._run)
-        self._timer.start()
+            self._schedule(monotonic() + interval)
+
+    def _schedule(self, thedeadline):
+        self.deadline = thedeadline
+        indigo.activePlugin._scheduler.push(self)
+
+    def cancel(self):
+        """ Remove the timer from the scheduler
+        """
+        indigo.activePlugin._scheduler.remove(self)
 
     def changeInterval(self, interval):
         """ Change interval value - restart the timer to take the new value in account
@@ -131,24 +542,90 @@ class dialogTimer(object):
             interval: interval in seconds
         """
         self.interval = interval
-        core.logger(traceLog = u'restarting with new timing value %s for dialog timer "%s"' % (interval, self.timername))
-        self._timer.cancel()
-        self._run()
+        core.logger(traceLog = (u'restarting with new timing value %s for dialog timer "%s"', interval, self.timername))
+        self.timeEllapsed = True
+        self._schedule(monotonic() + self.interval)
 
     def doNow(self):
         """ Stop the current timing and set isTime to true
         """
-        core.logger(traceLog = u'forced time ellapsed for dialog timer "%s"' % (self.timername))
-        self._timer.cancel()
-        self._run()
+        core.logger(traceLog = (u'forced time ellapsed for dialog timer "%s"', self.timername))
+        self.timeEllapsed = True
+        self._schedule(monotonic() + self.interval)
+
+    def isDue(self):
+        """ Same as isTime, without starting the next interval
+        """
+        return self.timeEllapsed or (monotonic() + indigo.activePlugin._scheduler.tolerance >= self.deadline)
 
     def isTime(self):
         """ True if the timing is ellapsed
             
             Note : returns true When the class instance is created
         """
+        thenow = monotonic()
+        if thenow + indigo.activePlugin._scheduler.tolerance >= self.deadline:
+            core.logger(traceLog = (u'time ellapsed for dialog timer "%s"', self.timername))
+            self.timeEllapsed = True
+            # next deadline keeps the pace, skipping the missed ones
+            thedeadline = self.deadline + self.interval
+            if thedeadline <= thenow:
+                thedeadline = thenow + self.interval
+            self._schedule(thedeadline)
+
         if self.timeEllapsed:
             self.timeEllapsed = False
             return True
         else:
             return False
+
+
+########################################
+class adaptiveTimer(dialogTimer):
+    """ Dialog timer whose interval stretches while the polls do not change anything
+        and snaps back to the fast pace after a change
+    """
+    def __init__(self, timername, mininterval, maxinterval, factor):
+        """ Constructor
+
+            Args:
+                timername : name of the timer (for logging use)
+                mininterval: interval in seconds after a change
+                maxinterval: maximum interval in seconds
+                factor: growth factor of the interval at each poll without change
+            Returns:
+                adaptiveTimer class instance
+        """
+        self.setPace(mininterval, maxinterval, factor)
+        dialogTimer.__init__(self, timername, mininterval)
+
+    def setPace(self, mininterval, maxinterval, factor):
+        """ Change the pace values - the fast pace is used again
+
+            Args:
+                mininterval: interval in seconds after a change
+                maxinterval: maximum interval in seconds
+                factor: growth factor of the interval at each poll without change
+        """
+        self.mininterval = mininterval
+        self.maxinterval = max(mininterval, maxinterval)
+        self.factor = factor
+        self.interval = mininterval
+
+    def polled(self, hasChanged):
+        """ Compute the next deadline after a poll
+
+            Args:
+                hasChanged: True if the poll changed something
+        """
+        if hasChanged:
+            self.interval = self.mininterval
+        else:
+            self.interval = min(self.interval * self.factor, self.maxinterval)
+        self._schedule(monotonic() + self.interval)
+
+    def reset(self):
+        """ Snap back to the fast pace and set isTime to true
+        """
+        self.interval = self.mininterval
+        self.doNow()
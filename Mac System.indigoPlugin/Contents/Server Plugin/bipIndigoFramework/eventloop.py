@@ -0,0 +1,435 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################################################################################
+""" Single thread event loop for Indigo plugins concurrentThread
+
+    By Bernard Philippe (bip.philippe) (C) 2015
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.#
+
+    Tasks are generators, resumed by the loop with the result of what they yield:
+        yield command(...)          runs a subprocess, resumes with (output, error) or None on timeout
+        yield othergenerator        runs a sub-task, resumes with its result
+        yield [generators]          runs the sub-tasks concurrently, resumes with the list of their results
+        yield 1.5                   sleeps 1.5 seconds
+        raise taskReturn(value)     ends the task with a result
+    Many subprocesses can so be run at once from the concurrentThread.
+"""
+####################################################################################
+
+import indigo
+import core
+import corethread
+import accounting
+import subprocess
+import os
+import fcntl
+import select
+import errno
+import signal
+import time
+import heapq
+import itertools
+import collections
+import threading
+import types
+
+# time in seconds between the checks of the end of a subprocess which outputs are open
+_exitCheck = 0.5
+
+
+########################################
+def init(maxProcesses=16):
+    """ Initiate the event loop - it runs when runForever is called
+
+        Args:
+            maxProcesses: maximum number of subprocesses running at once
+    """
+    indigo.activePlugin._eventLoop = eventLoop(maxProcesses)
+
+
+def isRunning():
+    """ Test if the event loop is running the concurrentThread
+
+        Returns:
+            True if running
+    """
+    return (getattr(indigo.activePlugin, '_eventLoop', None) is not None) and indigo.activePlugin._eventLoop.running
+
+
+def callSoon(thefunction, *theargs):
+    """ Call a function in the event loop thread - can be called from any thread
+
+        Args:
+            thefunction: function to call
+            theargs: arguments
+    """
+    indigo.activePlugin._eventLoop.callSoonThreadsafe(thefunction, *theargs)
+
+
+def spawn(thetask):
+    """ Run a task in the event loop - can be called from any thread
+
+        Args:
+            thetask: generator
+    """
+    indigo.activePlugin._eventLoop.callSoonThreadsafe(indigo.activePlugin._eventLoop.spawn, thetask)
+
+
+########################################
+class taskReturn(Exception):
+    """ Raised by a task to end with a result
+    """
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+
+class command(object):
+    """ Subprocess to be run by the event loop
+    """
+    def __init__(self, thecommand, shell=False, timeout=None, label=None):
+        """ Constructor
+
+            Args:
+                thecommand: command as text (shell) or list of arguments
+                shell: True if the command is to be run by the shell
+                timeout: time in seconds before the subprocess is killed,
+                         or None for the default shell timeout
+                label: label the subprocess is accounted for, or None for its first command
+        """
+        self.command = thecommand
+        self.shell = shell
+        self.label = label
+        self.device = accounting.currentDevice()
+        if timeout is None:
+            timeout = indigo.activePlugin._shellTimeout
+        self.timeout = timeout
+
+    def start(self, theloop, thecallback):
+        """ Start the subprocess, thecallback is called with (output, error) or None on timeout
+        """
+        self._loop = theloop
+        self._callback = thecallback
+        self._started = time.time()
+        self._process = subprocess.Popen(self.command,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE,
+                                         shell=self.shell,
+                                         close_fds=True,
+                                         preexec_fn=os.setpgrp)
+        self._buffers = dict()
+        self._closed = False
+        for thefile in (self._process.stdout, self._process.stderr):
+            thefd = thefile.fileno()
+            fcntl.fcntl(thefd, fcntl.F_SETFL, fcntl.fcntl(thefd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            self._buffers[thefd] = []
+            theloop.addReader(thefd, self._read)
+        self._timeout = theloop.callLater(self.timeout, self._kill)
+        self._exitTimer = theloop.callLater(_exitCheck, self._checkExit)
+
+    def _read(self, thefd):
+        try:
+            thedata = os.read(thefd, 65536)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            thedata = b''
+        if len(thedata) > 0:
+            self._buffers[thefd].append(thedata)
+            return
+        self._loop.removeReader(thefd)
+        if not any([self._loop.hasReader(thefile.fileno()) for thefile in (self._process.stdout, self._process.stderr)]):
+            self._waitExit()
+
+    def _waitExit(self):
+        if self._closed:
+            return
+        if self._process.poll() is None:
+            self._loop.callLater(0.005, self._waitExit)
+            return
+        self._timeout.cancel()
+        theresult = self._outputs()
+        self._close()
+        self._callback(theresult)
+
+    def _checkExit(self):
+        if self._closed:
+            return
+        if self._process.poll() is None:
+            self._exitTimer = self._loop.callLater(_exitCheck, self._checkExit)
+            return
+        # ended, the outputs being kept open by the processes it started (daemons),
+        # which are left running
+        for thefile in (self._process.stdout, self._process.stderr):
+            self._loop.removeReader(thefile.fileno())
+        self._timeout.cancel()
+        theresult = self._outputs()
+        self._close()
+        self._callback(theresult)
+
+    def _kill(self):
+        if self._closed:
+            return
+        if self._process.poll() is not None:
+            self._checkExit()
+            return
+        for thefile in (self._process.stdout, self._process.stderr):
+            self._loop.removeReader(thefile.fileno())
+        try:
+            os.killpg(self._process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self._process.wait()
+        self._outputs()
+        self._close()
+        self._callback(None)
+
+    def _outputs(self):
+        theresult = (b''.join(self._buffers[self._process.stdout.fileno()]), b''.join(self._buffers[self._process.stderr.fileno()]))
+        accounting.record(self.command, time.time() - self._started, theresult[0], theresult[1], self.label, self.device)
+        return theresult
+
+    def _close(self):
+        self._closed = True
+        self._exitTimer.cancel()
+        self._process.stdout.close()
+        self._process.stderr.close()
+        self._loop.commandDone()
+
+
+########################################
+class _timerHandle(object):
+    def __init__(self, thefunction, theargs):
+        self.function = thefunction
+        self.args = theargs
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class _task(object):
+    """ Runs a generator, resuming it with the results of what it yields
+    """
+    def __init__(self, theloop, thegenerator, thecallback):
+        self._loop = theloop
+        self._stack = [thegenerator]
+        self._callback = thecallback
+        theloop.callSoon(self._step, None, None)
+
+    def _resume(self, thevalue):
+        self._step(thevalue, None)
+
+    def _step(self, thevalue, theerror):
+        while True:
+            thegenerator = self._stack[-1]
+            try:
+                if theerror is None:
+                    theyielded = thegenerator.send(thevalue)
+                else:
+                    theyielded = thegenerator.throw(theerror)
+            except (taskReturn, StopIteration) as e:
+                thevalue = getattr(e, 'value', None)
+                theerror = None
+                self._stack.pop()
+                if len(self._stack) == 0:
+                    self._finish(thevalue)
+                    return
+                continue
+            except Exception as e:
+                self._stack.pop()
+                if len(self._stack) == 0:
+                    core.logger(errLog = u'event loop task failed because %s' % (e))
+                    self._finish(None)
+                    return
+                # the error goes to the calling task
+                (thevalue, theerror) = (None, e)
+                continue
+
+            (thevalue, theerror) = (None, None)
+            if isinstance(theyielded, types.GeneratorType):
+                self._stack.append(theyielded)
+            elif isinstance(theyielded, command):
+                self._loop.startCommand(theyielded, self._resume)
+                return
+            elif isinstance(theyielded, list):
+                self._gather(theyielded)
+                return
+            elif isinstance(theyielded, (int, float)):
+                self._loop.callLater(theyielded, self._resume, None)
+                return
+
+    def _gather(self, thegenerators):
+        theresults = [None] * len(thegenerators)
+        theremaining = [len(thegenerators)]
+        if len(thegenerators) == 0:
+            self._loop.callSoon(self._resume, theresults)
+            return
+
+        def _done(theindex, thevalue):
+            theresults[theindex] = thevalue
+            theremaining[0] = theremaining[0] - 1
+            if theremaining[0] == 0:
+                self._resume(theresults)
+
+        for (theindex, thegenerator) in enumerate(thegenerators):
+            _task(self._loop, thegenerator, lambda thevalue, theindex=theindex: _done(theindex, thevalue))
+
+    def _finish(self, thevalue):
+        if self._callback is not None:
+            self._callback(thevalue)
+
+
+########################################
+class eventLoop(object):
+    """ select based event loop: timers on the monotonic clock, subprocess outputs,
+        and calls posted by other threads
+    """
+    def __init__(self, maxProcesses=16):
+        """ Constructor
+
+            Args:
+                maxProcesses: maximum number of subprocesses running at once
+        """
+        self.running = False
+        self._ready = collections.deque()
+        self._timers = []
+        self._counter = itertools.count()
+        self._readers = dict()
+        self._maxProcesses = maxProcesses
+        self._processes = 0
+        self._pendingCommands = collections.deque()
+        # calls posted by other threads, and the pipe waking the loop up
+        self._lock = threading.Lock()
+        self._posted = []
+        (self._wakeupRead, self._wakeupWrite) = os.pipe()
+        for thefd in (self._wakeupRead, self._wakeupWrite):
+            fcntl.fcntl(thefd, fcntl.F_SETFL, fcntl.fcntl(thefd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    ########################################
+    def callSoon(self, thefunction, *theargs):
+        self._ready.append((thefunction, theargs))
+
+    def callLater(self, thedelay, thefunction, *theargs):
+        thehandle = _timerHandle(thefunction, theargs)
+        heapq.heappush(self._timers, (corethread.monotonic() + thedelay, next(self._counter), thehandle))
+        return thehandle
+
+    def callSoonThreadsafe(self, thefunction, *theargs):
+        with self._lock:
+            self._posted.append((thefunction, theargs))
+        try:
+            os.write(self._wakeupWrite, b'x')
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def addReader(self, thefd, thecallback):
+        self._readers[thefd] = thecallback
+
+    def removeReader(self, thefd):
+        self._readers.pop(thefd, None)
+
+    def hasReader(self, thefd):
+        return thefd in self._readers
+
+    def spawn(self, thegenerator, thecallback=None):
+        """ Run a task
+
+            Args:
+                thegenerator: task generator
+                thecallback: function called with the result of the task, or None
+        """
+        _task(self, thegenerator, thecallback)
+
+    ########################################
+    def startCommand(self, thecommand, thecallback):
+        if self._processes >= self._maxProcesses:
+            self._pendingCommands.append((thecommand, thecallback))
+            return
+        self._processes = self._processes + 1
+        try:
+            thecommand.start(self, thecallback)
+        except OSError as e:
+            core.logger(errLog = u'command %s could not be started because %s' % (thecommand.command, e))
+            self._processes = self._processes - 1
+            self.callSoon(thecallback, None)
+
+    def commandDone(self):
+        self._processes = self._processes - 1
+        if len(self._pendingCommands) > 0:
+            self.startCommand(*self._pendingCommands.popleft())
+
+    ########################################
+    def runOnce(self, themaxtimeout):
+        """ Wait for the next events and process them
+
+            Args:
+                themaxtimeout: maximum time in seconds to wait
+        """
+        if len(self._ready) > 0:
+            thetimeout = 0
+        elif len(self._timers) > 0:
+            thetimeout = min(max(self._timers[0][0] - corethread.monotonic(), 0), themaxtimeout)
+        else:
+            thetimeout = themaxtimeout
+
+        thefds = [self._wakeupRead] + self._readers.keys()
+        try:
+            (thereadyfds, thewfds, thexfds) = select.select(thefds, [], [], thetimeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            thereadyfds = []
+
+        for thefd in thereadyfds:
+            if thefd == self._wakeupRead:
+                try:
+                    while len(os.read(self._wakeupRead, 4096)) > 0:
+                        pass
+                except OSError:
+                    pass
+            elif thefd in self._readers:
+                self._readers[thefd](thefd)
+
+        with self._lock:
+            (theposted, self._posted) = (self._posted, [])
+        self._ready.extend(theposted)
+
+        thenow = corethread.monotonic()
+        while (len(self._timers) > 0) and (self._timers[0][0] <= thenow):
+            thehandle = heapq.heappop(self._timers)[2]
+            if not thehandle.cancelled:
+                self._ready.append((thehandle.function, thehandle.args))
+
+        # calls added meanwhile wait for the next run
+        for theindex in range(len(self._ready)):
+            (thefunction, theargs) = self._ready.popleft()
+            thefunction(*theargs)
+
+    def runForever(self, thecheck):
+        """ Run the loop until thecheck raises an exception
+
+            Args:
+                thecheck: function called between the loop runs (at least each second)
+        """
+        self.running = True
+        try:
+            while True:
+                self.runOnce(1.0)
+                thecheck()
+        finally:
+            self.running = False
@@ -21,24 +21,54 @@
 """
 ####################################################################################
 
-import subprocess
 import indigo
 import core
+import shellscript
+import scripthost
+import scriptcache
+import eventloop
+import perfstats
 import re
 
 _repCloseAppErrorFilter = re.compile(r".Library.ScriptingAdditions.")
 _valueConvertDict = {u'True':True, u'true':True, u'False':False, u'false':False}
 
 ########################################
-def init():
+def init(useScriptHost=False, hostCommand=None, python=None, cacheDirectory=None, compilerCommand=None):
     """ Initiate special applescript error handling
+
+        Args:
+            useScriptHost: True to run the scripts in a persistent script host
+            hostCommand: host process command, or None for the default host
+            python: python interpreter of the default host, or None for the one of the plugin
+            cacheDirectory: directory of the compiled scripts, or None for the default one
+                            (see scriptcache)
+            compilerCommand: list of arguments of the script compiler command,
+                             or None for osacompile (see scriptcache)
     """
     indigo.activePlugin._retryLog=dict()
     indigo.activePlugin._errorMsg=dict()
+    scriptcache.init(cacheDirectory, compilerCommand)
+    setScriptHost(useScriptHost, hostCommand, python)
+
+
+def setScriptHost(useScriptHost, hostCommand=None, python=None):
+    """ Starts or stops using the persistent script host
+
+        Args:
+            useScriptHost: True to run the scripts in a persistent script host,
+                           False to start osascript for each script
+            hostCommand: host process command, or None for the default host
+            python: python interpreter of the default host, or None for the one of the plugin
+    """
+    if useScriptHost:
+        scripthost.init(hostCommand, python)
+    else:
+        scripthost.stop()
 
 
 ########################################
-def run(ascript, akeys =  None, errorHandling = None):
+def run(ascript, akeys =  None, errorHandling = None, timeout = None):
     """ Calls applescript script and returns the result as a python dictionnary
 
         Args:
@@ -48,6 +78,8 @@ def run(ascript, akeys =  None, errorHandling = None):
             errorHandling : a compiled regular expression matching errors to ignore
                     or number of retry (integer)
                     or None if no special management
+            timeout: time in seconds before the script is killed,
+                     or None for the default timeout
         Returns:
             python dictionnay of the states names and values,
             or unicode string returned by the script is akeys is None,
@@ -55,14 +87,52 @@ def run(ascript, akeys =  None, errorHandling = None):
     """
 
     osaname = ascript.splitlines()[0]
-    core.logger(traceRaw = u'going to call applescript %s' % (ascript),traceLog = u'going to call applescript %s' % (osaname))
+    core.logger(traceRaw = (u'going to call applescript %s', ascript),traceLog = (u'going to call applescript %s', osaname))
+
+    thestart = perfstats.start()
+    osaresult = scripthost.execute(ascript, timeout=timeout)
+    if osaresult is False:
+        osaresult = shellscript.execute(_command(ascript), timeout=timeout, label=osaname)
+    perfstats.command(osaname, thestart)
+
+    return _result(ascript, osaresult, akeys, errorHandling)
+
+
+def runTask(ascript, akeys =  None, errorHandling = None, timeout = None):
+    """ Same as run, as an event loop task - the script host is not used, so that
+        several scripts can run at once
+
+        Returns (see eventloop):
+            same as run
+    """
+    osaname = ascript.splitlines()[0]
+    core.logger(traceRaw = (u'going to call applescript %s', ascript),traceLog = (u'going to call applescript %s', osaname))
+
+    thestart = perfstats.start()
+    osaresult = yield eventloop.command(_command(ascript), timeout=timeout, label=osaname)
+    perfstats.command(osaname, thestart)
+    raise eventloop.taskReturn(_result(ascript, osaresult, akeys, errorHandling))
+
+
+def _command(ascript):
+    """ osascript command running the precompiled script if any, or the script text
+    """
+    osacompiled = scriptcache.lookup(ascript)
+    if osacompiled is None:
+        return [u'osascript','-e',ascript]
+    core.logger(traceLog = (u'applescript %s is precompiled', ascript.splitlines()[0]))
+    return [u'osascript',osacompiled]
+
+
+def _result(ascript, osaresult, akeys, errorHandling):
+    """ Checks and converts the output of an applescript (see run)
+    """
+    osaname = ascript.splitlines()[0]
 
-    osa = subprocess.Popen([u'osascript','-e',ascript],
-                           stdout=subprocess.PIPE,
-                           stderr=subprocess.PIPE,
-                           close_fds=True)
-    indigo.activePlugin.sleep(0.25)
-    (osavalues, osaerror) = osa.communicate()
+    if osaresult is None:
+        core.logger(errLog = u'applescript %s killed after timeout' % (osaname))
+        return None
+    (osavalues, osaerror) = osaresult
 
     # error management
     if len(osaerror)>0:
@@ -76,7 +146,7 @@ def run(ascript, akeys =  None, errorHandling = None):
             else:
                 filterederror = filterederror + theline + u'\n'
         if filterederror>u'':
-            core.logger(traceLog=u'warning: applescript %s error filtered as not significant' % (osaname), traceRaw = u'warning: applescript %s following error filtered: %s' % (osaname, filterederror[:-1]))
+            core.logger(traceLog=(u'warning: applescript %s error filtered as not significant', osaname), traceRaw = (u'warning: applescript %s following error filtered: %s', osaname, filterederror[:-1]))
 
     # test if error
     if len(osaerror)>0:
@@ -85,7 +155,7 @@ def run(ascript, akeys =  None, errorHandling = None):
             core.logger(traceLog=u'no error handling', errLog = u'applescript %s failed because %s' % (osaname, osaerror))
             return None
         else:
-            core.logger(traceLog = u'applescript %s error handling %s because %s' % (osaname, type(errorHandling), osaerror))
+            core.logger(traceLog = (u'applescript %s error handling %s because %s', osaname, type(errorHandling), osaerror))
             if type(errorHandling) is int:
                 # test if dictionnary exists
                 if osaname in indigo.activePlugin._retryLog:
@@ -96,7 +166,7 @@ def run(ascript, akeys =  None, errorHandling = None):
                 else:
                     indigo.activePlugin._retryLog[osaname]=1
                 indigo.activePlugin._errorMsg[osaname]= osaerror
-                core.logger(traceLog = u'applescript %s failed %s time' % (osaname, indigo.activePlugin._retryLog[osaname]))
+                core.logger(traceLog = (u'applescript %s failed %s time', osaname, indigo.activePlugin._retryLog[osaname]))
             else:
                 if errorHandling.search(osaerror) is None:
                     core.logger(errLog = u'applescript %s failed because %s' % (osaname ,osaerror))
@@ -126,6 +196,6 @@ def run(ascript, akeys =  None, errorHandling = None):
                 thevalue = _valueConvertDict[thevalue]
             osavalues[thekey] = core.strutf8(thevalue)
 
-    core.logger(traceRaw = u'returned from applescript: %s' % (osavalues),traceLog = u'returned from applescript %s' % (osaname))
+    core.logger(traceRaw = (u'returned from applescript: %s', osavalues),traceLog = (u'returned from applescript %s', osaname))
 
     return osavalues
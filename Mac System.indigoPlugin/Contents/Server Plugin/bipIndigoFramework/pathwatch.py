@@ -0,0 +1,138 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################################################################################
+""" Directory change watcher for Indigo plugins
+
+    By Bernard Philippe (bip.philippe) (C) 2015
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.#
+"""
+####################################################################################
+
+import core
+import os
+import sys
+import errno
+import select
+import ctypes
+import ctypes.util
+
+_O_EVTONLY = 0x8000
+
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_IN_CHANGES = 0x4 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400 | 0x800   # attrib, moved from/to, create, delete, delete/move self
+
+
+########################################
+def watchDirectory(thepath):
+    """ Creates a watcher of the entries of a directory using the best notification of the platform
+
+        Args:
+            thepath: path of the directory
+        Returns:
+            watcher instance, which hasChanged() method tells if the directory changed since the previous call
+    """
+    thewatcher = None
+    for thewatcherclass in (_kqueueWatcher, _inotifyWatcher):
+        try:
+            thewatcher = thewatcherclass(thepath)
+            break
+        except Exception:
+            pass
+    if thewatcher is None:
+        thewatcher = _statWatcher(thepath)
+
+    core.logger(traceLog = (u'directory %s watcher uses %s', thepath, thewatcher.name))
+    return thewatcher
+
+
+########################################
+class _kqueueWatcher(object):
+    """ macOS (BSD) watcher: kqueue EVFILT_VNODE events on the directory
+    """
+    name = u'kqueue'
+
+    def __init__(self, thepath):
+        self._kqueue = select.kqueue()
+        if sys.platform == 'darwin':
+            self._fd = os.open(thepath, _O_EVTONLY)
+        else:
+            self._fd = os.open(thepath, os.O_RDONLY)
+        thefflags = select.KQ_NOTE_WRITE | select.KQ_NOTE_DELETE | select.KQ_NOTE_RENAME | select.KQ_NOTE_LINK | select.KQ_NOTE_EXTEND
+        self._kqueue.control([select.kevent(self._fd, select.KQ_FILTER_VNODE, select.KQ_EV_ADD | select.KQ_EV_CLEAR, thefflags)], 0, 0)
+        self._first = True
+
+    def hasChanged(self):
+        theevents = self._kqueue.control(None, 16, 0)
+        if self._first:
+            self._first = False
+            return True
+        return len(theevents) > 0
+
+
+########################################
+class _inotifyWatcher(object):
+    """ Linux watcher: inotify events on the directory, read without blocking
+    """
+    name = u'inotify'
+
+    def __init__(self, thepath):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self._fd, thepath.encode('utf-8'), _IN_CHANGES) < 0:
+            theerrno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(theerrno, 'inotify_add_watch failed')
+        self._first = True
+
+    def hasChanged(self):
+        thechange = self._first
+        self._first = False
+        while True:
+            try:
+                if len(os.read(self._fd, 4096)) == 0:
+                    break
+                thechange = True
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+        return thechange
+
+
+########################################
+class _statWatcher(object):
+    """ Fallback watcher: compares the directory stat (modification time, inode, links)
+    """
+    name = u'stat'
+
+    def __init__(self, thepath):
+        self._path = thepath
+        self._stat = None
+
+    def hasChanged(self):
+        try:
+            thestat = os.stat(self._path)
+            thestat = (thestat.st_mtime, thestat.st_ino, thestat.st_dev, thestat.st_nlink)
+        except OSError:
+            # unknown state: consider it changed
+            self._stat = None
+            return True
+        thechange = (thestat != self._stat)
+        self._stat = thestat
+        return thechange
@@ -0,0 +1,355 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################################################################################
+""" Performance statistics for Indigo plugins
+
+    By Bernard Philippe (bip.philippe) (C) 2015
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.#
+
+    Measures are taken by pairs of calls:
+        thestart = perfstats.start()
+        ... work ...
+        perfstats.phase(u'status', thestart)
+    start returns None when the statistics are off, and the other calls then do nothing,
+    so that the cost is a test when they are off.
+    A phase measured within another one by the same thread (the state pushes of the
+    status phase) is counted in its own phase only, so that the phases of a cycle add up.
+    The times are taken on the monotonic clock of corethread.
+"""
+####################################################################################
+
+import indigo
+import corethread
+import os
+import sys
+import re
+import threading
+import resource
+import ctypes
+import ctypes.util
+
+# upper bounds in seconds of the command latency histogram buckets
+_latencyBuckets = (0.01, 0.03, 0.1, 0.3, 1.0, 3.0, 10.0)
+_latencyLabels = (u'<10ms', u'<30ms', u'<100ms', u'<300ms', u'<1s', u'<3s', u'<10s', u'>=10s')
+# numbers (process ids, volume numbers) are removed from the labels, and the commands
+# with other labels are counted together beyond this number of labels
+_maxLabels = 200
+_repNumbers = re.compile(r"[0-9]{2,}(?:,[0-9]+)*")
+# proc_pidinfo flavor giving a proc_taskinfo structure (12 64 bits words on mac),
+# the resident size being its second word
+_PROC_PIDTASKINFO = 4
+_libproc = None
+
+# time in seconds of the phases measured so far, per thread
+_context = threading.local()
+
+
+########################################
+def init(enabled=False):
+    """ Starts or stops collecting the statistics
+
+        Args:
+            enabled: True to collect the statistics
+    """
+    if not enabled:
+        indigo.activePlugin._perfStats = None
+    elif getattr(indigo.activePlugin, '_perfStats', None) is None:
+        indigo.activePlugin._perfStats = perfStats()
+
+
+def isEnabled():
+    """ Test if the statistics are collected
+
+        Returns:
+            True if collected
+    """
+    return getattr(indigo.activePlugin, '_perfStats', None) is not None
+
+
+def start():
+    """ Takes the start time of a measure
+
+        Returns:
+            (time, phases time of the thread) tuple, or None if the statistics are off
+    """
+    if getattr(indigo.activePlugin, '_perfStats', None) is None:
+        return None
+    return (corethread.monotonic(), getattr(_context, 'phases', 0.0))
+
+
+def phase(thename, thestart):
+    """ Adds the time since thestart to a phase of the current cycle
+
+        Args:
+            thename: phase name
+            thestart: value returned by start
+    """
+    if thestart is not None:
+        thestats = getattr(indigo.activePlugin, '_perfStats', None)
+        if thestats is not None:
+            (thetime, thephases) = thestart
+            theduration = corethread.monotonic() - thetime
+            # without the phases measured meanwhile, which count in the enclosing ones
+            thestats.addPhase(thename, theduration - (getattr(_context, 'phases', 0.0) - thephases))
+            _context.phases = thephases + theduration
+
+
+def command(thelabel, thestart):
+    """ Adds the time since thestart to the latency of a command
+
+        Args:
+            thelabel: command label (shell script first command or applescript first line)
+            thestart: value returned by start
+    """
+    if thestart is not None:
+        thestats = getattr(indigo.activePlugin, '_perfStats', None)
+        if thestats is not None:
+            thestats.addCommand(thelabel, corethread.monotonic() - thestart[0])
+
+
+def startCycle():
+    """ Marks the beginning of a dialog cycle
+    """
+    thestats = getattr(indigo.activePlugin, '_perfStats', None)
+    if thestats is not None:
+        thestats.startCycle()
+
+
+def endCycle():
+    """ Marks the end of a dialog cycle
+    """
+    thestats = getattr(indigo.activePlugin, '_perfStats', None)
+    if thestats is not None:
+        thestats.endCycle()
+
+
+def healthStates():
+    """ States of a health device, for the cycles since the previous call
+
+        Returns:
+            dictionary of the states names and values, empty if the statistics are off
+    """
+    thestats = getattr(indigo.activePlugin, '_perfStats', None)
+    if thestats is None:
+        return {}
+    return thestats.healthStates()
+
+
+def summary():
+    """ Summary of the statistics since they are collected
+
+        Returns:
+            list of text lines, empty if the statistics are off
+    """
+    thestats = getattr(indigo.activePlugin, '_perfStats', None)
+    if thestats is None:
+        return []
+    return thestats.summary()
+
+
+def commandLabel(thetext):
+    """ Label under which a command is counted: its numbers (process ids, volume numbers)
+        are replaced by #, so that the same command with other numbers is counted once
+
+        Args:
+            thetext: command label (shell script first command or applescript first line)
+        Returns:
+            label as text
+    """
+    return _repNumbers.sub(u'#', thetext.strip())
+
+
+########################################
+def _processUsage():
+    """ CPU time in seconds, current and peak resident sizes in MB of the process
+    """
+    (theuser, thesystem) = os.times()[:2]
+    thepeak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on mac, kilobytes on linux
+    if sys.platform == 'darwin':
+        thepeak = thepeak / 1048576.0
+    else:
+        thepeak = thepeak / 1024.0
+    therss = _residentSize()
+    if therss is None:
+        therss = thepeak
+    else:
+        therss = therss / 1048576.0
+    # the kernel updates the peak lazily
+    return (theuser + thesystem, therss, max(therss, thepeak))
+
+
+def _residentSize():
+    """ Current resident size in bytes of the process, or None if it cannot be read
+    """
+    global _libproc
+    if sys.platform == 'darwin':
+        try:
+            if _libproc is None:
+                _libproc = ctypes.CDLL(ctypes.util.find_library('proc') or '/usr/lib/libproc.dylib')
+            theinfo = (ctypes.c_uint64 * 12)()
+            if _libproc.proc_pidinfo(os.getpid(), _PROC_PIDTASKINFO, ctypes.c_uint64(0), ctypes.byref(theinfo), ctypes.sizeof(theinfo)) != ctypes.sizeof(theinfo):
+                return None
+            return theinfo[1]
+        except (OSError, AttributeError):
+            return None
+    try:
+        # size and resident pages
+        with open('/proc/self/statm') as thefile:
+            return int(thefile.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+class _durations(object):
+    """ Count, total and maximum of durations
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, theduration):
+        self.count = self.count + 1
+        self.total = self.total + theduration
+        if theduration > self.maximum:
+            self.maximum = theduration
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+
+class latencyHistogram(_durations):
+    """ Durations of a command, with their distribution in buckets
+    """
+    def __init__(self):
+        _durations.__init__(self)
+        self.buckets = [0] * (len(_latencyBuckets) + 1)
+
+    def add(self, theduration):
+        _durations.add(self, theduration)
+        for (theindex, thebound) in enumerate(_latencyBuckets):
+            if theduration < thebound:
+                self.buckets[theindex] = self.buckets[theindex] + 1
+                return
+        self.buckets[-1] = self.buckets[-1] + 1
+
+    def text(self):
+        return u', '.join([u'%s %s' % (thelabel, thecount) for (thelabel, thecount) in zip(_latencyLabels, self.buckets) if thecount > 0])
+
+
+########################################
+class perfStats(object):
+    """ Phase durations of the dialog cycles and command latencies, since the statistics
+        are collected, and for the current window of the health devices
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = corethread.monotonic()
+        # since the statistics are collected
+        self._phases = dict()
+        self._commands = dict()
+        self._cycles = _durations()
+        # current cycle: phase -> seconds
+        self._cycleStart = None
+        self._cyclePhases = dict()
+        self._newWindow()
+
+    def _newWindow(self):
+        (thecpu, therss, thepeak) = _processUsage()
+        self._windowStart = corethread.monotonic()
+        self._windowCpu = thecpu
+        self._windowPhases = dict()
+        self._windowCycles = _durations()
+        self._windowCommands = _durations()
+        self._windowSlowest = (u'', 0.0)
+
+    def _label(self, thelabel):
+        thelabel = commandLabel(thelabel)
+        if (thelabel not in self._commands) and (len(self._commands) >= _maxLabels):
+            return u'other commands'
+        return thelabel
+
+    ########################################
+    def addPhase(self, thename, theduration):
+        with self._lock:
+            self._cyclePhases[thename] = self._cyclePhases.get(thename, 0.0) + theduration
+
+    def addCommand(self, thelabel, theduration):
+        with self._lock:
+            thelabel = self._label(thelabel)
+            if thelabel not in self._commands:
+                self._commands[thelabel] = latencyHistogram()
+            self._commands[thelabel].add(theduration)
+            self._windowCommands.add(theduration)
+            if theduration > self._windowSlowest[1]:
+                self._windowSlowest = (thelabel, theduration)
+
+    def startCycle(self):
+        with self._lock:
+            self._cycleStart = corethread.monotonic()
+            self._cyclePhases = dict()
+
+    def endCycle(self):
+        with self._lock:
+            if self._cycleStart is None:
+                return
+            theduration = corethread.monotonic() - self._cycleStart
+            self._cycleStart = None
+            self._cycles.add(theduration)
+            self._windowCycles.add(theduration)
+            for (thename, theseconds) in self._cyclePhases.items():
+                self._phases.setdefault(thename, _durations()).add(theseconds)
+                self._windowPhases[thename] = self._windowPhases.get(thename, 0.0) + theseconds
+
+    ########################################
+    def healthStates(self):
+        with self._lock:
+            (thecpu, therss, thepeak) = _processUsage()
+            thewall = corethread.monotonic() - self._windowStart
+            thecycles = self._windowCycles.count
+            thevaluesDict = {u'cycles':thecycles,
+                             u'cycleTime':round(self._windowCycles.mean() * 1000, 1),
+                             u'cycleTimeMax':round(self._windowCycles.maximum * 1000, 1),
+                             u'commands':self._windowCommands.count,
+                             u'commandTime':round(self._windowCommands.mean() * 1000, 1),
+                             u'slowestCommand':self._windowSlowest[0],
+                             u'slowestCommandTime':round(self._windowSlowest[1] * 1000, 1),
+                             u'cpuPercent':round((thecpu - self._windowCpu) * 100 / thewall, 1) if thewall > 0 else 0,
+                             u'rssMB':round(therss, 1)}
+            # mean time per cycle of each phase
+            for thename in (u'diskSleep', u'status', u'details', u'statePush', u'fixedSleep'):
+                if thecycles > 0:
+                    thevaluesDict[thename + u'Time'] = round(self._windowPhases.get(thename, 0.0) * 1000 / thecycles, 1)
+                else:
+                    thevaluesDict[thename + u'Time'] = 0
+            self._newWindow()
+        return thevaluesDict
+
+    def summary(self):
+        with self._lock:
+            (thecpu, therss, thepeak) = _processUsage()
+            thelines = [u'performance statistics for the last %s seconds, %s cycles: cycle %.1f ms (max %.1f ms), process CPU %.1f s, memory %.1f MB (peak %.1f MB)'
+                        % (int(corethread.monotonic() - self._started), self._cycles.count, self._cycles.mean() * 1000, self._cycles.maximum * 1000, thecpu, therss, thepeak)]
+            for (thename, thedurations) in sorted(self._phases.items()):
+                thelines.append(u'phase %s: %.1f ms per cycle (max %.1f ms) in %s cycles'
+                                % (thename, thedurations.mean() * 1000, thedurations.maximum * 1000, thedurations.count))
+            for (thelabel, thehistogram) in sorted(self._commands.items(), key=lambda theitem: -theitem[1].total):
+                thelines.append(u'command %s: %s calls, %.1f ms (max %.1f ms) - %s'
+                                % (thelabel, thehistogram.count, thehistogram.mean() * 1000, thehistogram.maximum * 1000, thehistogram.text()))
+        return thelines
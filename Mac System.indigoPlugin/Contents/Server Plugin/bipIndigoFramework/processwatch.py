@@ -0,0 +1,310 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################################################################################
+""" Process exit watcher for Indigo plugins concurrentThread
+
+    By Bernard Philippe (bip.philippe) (C) 2015
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.#
+"""
+####################################################################################
+
+import indigo
+import core
+import corethread
+import os
+import sys
+import errno
+import fcntl
+import select
+import time
+import threading
+import ctypes
+import ctypes.util
+
+_SYS_PIDFD_OPEN = 434
+# time in seconds between two tests of the processes existence by the fallback watcher
+_pollingPeriod = 1.0
+
+
+########################################
+def init():
+    """ Initiate the watcher using the best kernel notification of the platform
+    """
+    thewatcher = None
+    for thewatcherclass in (_kqueueWatcher, _pidfdWatcher):
+        try:
+            thewatcher = thewatcherclass()
+            break
+        except Exception:
+            pass
+    if thewatcher is None:
+        thewatcher = _pollingWatcher()
+
+    core.logger(traceLog = (u'process exit watcher uses %s', thewatcher.name))
+    indigo.activePlugin._processWatcher = thewatcher
+    indigo.activePlugin._watchedDevices = dict()
+    indigo.activePlugin._watchedLock = threading.Lock()
+    corethread.setWaiter(wait)
+
+
+########################################
+def watch(thedevice, thepid):
+    """ Watch the exit of the process of a device - replaces the process watched before
+
+        Args:
+            thedevice: current device
+            thepid: process id, 0 or empty to stop watching
+    """
+    try:
+        thepid = int(thepid)
+    except (TypeError, ValueError):
+        thepid = 0
+
+    with indigo.activePlugin._watchedLock:
+        if thedevice.id in indigo.activePlugin._watchedDevices:
+            (theoldpid, theolddevice) = indigo.activePlugin._watchedDevices[thedevice.id]
+            if theoldpid == thepid:
+                indigo.activePlugin._watchedDevices[thedevice.id] = (thepid, thedevice)
+                return
+            del indigo.activePlugin._watchedDevices[thedevice.id]
+            indigo.activePlugin._processWatcher.remove(theoldpid)
+
+        if thepid > 0:
+            if indigo.activePlugin._processWatcher.add(thepid):
+                indigo.activePlugin._watchedDevices[thedevice.id] = (thepid, thedevice)
+                core.logger(traceLog = (u'device "%s" process %s exit is watched', thedevice.name, thepid))
+            else:
+                # the process is already gone
+                corethread.setUpdateRequest(thedevice)
+
+
+def unwatch(thedevice):
+    """ Stop watching the process of a device
+
+        Args:
+            thedevice: current device
+    """
+    watch(thedevice, 0)
+
+
+########################################
+def wait(thetimeout):
+    """ Wait for the exit of watched processes, and request an update of their devices
+
+        The watcher only collects the events while waiting, as the devices may be watched
+        or unwatched meanwhile by other threads: they are matched with the processes still
+        watched, and these processes removed, under the lock
+
+        Args:
+            thetimeout: maximum waiting time in seconds
+        Returns:
+            True if some watched processes exited
+    """
+    theevents = indigo.activePlugin._processWatcher.wait(thetimeout)
+
+    with indigo.activePlugin._watchedLock:
+        thepids = indigo.activePlugin._processWatcher.exited(theevents)
+        if len(thepids) == 0:
+            return False
+        thedevices = [(thedeviceid, thedevice) for (thedeviceid, (thepid, thedevice)) in indigo.activePlugin._watchedDevices.items() if thepid in thepids]
+        for (thedeviceid, thedevice) in thedevices:
+            del indigo.activePlugin._watchedDevices[thedeviceid]
+
+    for (thedeviceid, thedevice) in thedevices:
+        core.logger(traceLog = (u'device "%s" process exited', thedevice.name))
+        corethread.setUpdateRequest(thedevice)
+
+    return len(thedevices) > 0
+
+
+########################################
+class _pidfdWatcher(object):
+    """ Linux watcher: a pidfd per process, readable when the process exits
+
+        The pidfds removed while waiting are closed once the wait is over, so that their
+        numbers are not reused by other pidfds while poll still waits on them, and a pipe
+        wakes the wait up when a pidfd is added
+    """
+    name = u'pidfd'
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'pidfd is Linux only')
+        if hasattr(os, 'pidfd_open'):
+            self._pidfdopen = os.pidfd_open
+        else:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            thesyscall = libc.syscall
+            thesyscall.restype = ctypes.c_long
+
+            def _pidfdopen(thepid):
+                thefd = thesyscall(_SYS_PIDFD_OPEN, ctypes.c_int(thepid), ctypes.c_uint(0))
+                if thefd < 0:
+                    theerrno = ctypes.get_errno()
+                    raise OSError(theerrno, os.strerror(theerrno))
+                return thefd
+            self._pidfdopen = _pidfdopen
+
+        # test if the kernel provides pidfd
+        os.close(self._pidfdopen(os.getpid()))
+        self._poll = select.poll()
+        self._fds = dict()
+        self._pids = dict()
+        self._removed = []
+        (self._wakeRead, self._wakeWrite) = os.pipe()
+        for thefd in (self._wakeRead, self._wakeWrite):
+            fcntl.fcntl(thefd, fcntl.F_SETFL, fcntl.fcntl(thefd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._poll.register(self._wakeRead, select.POLLIN)
+
+    def add(self, thepid):
+        try:
+            thefd = self._pidfdopen(thepid)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                return False
+            raise
+        self._fds[thepid] = thefd
+        self._pids[thefd] = thepid
+        self._poll.register(thefd, select.POLLIN)
+        # the poll running takes the new pidfd at its next call
+        try:
+            os.write(self._wakeWrite, b'x')
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        return True
+
+    def remove(self, thepid):
+        if thepid in self._fds:
+            thefd = self._fds.pop(thepid)
+            del self._pids[thefd]
+            self._poll.unregister(thefd)
+            self._removed.append(thefd)
+
+    def wait(self, thetimeout):
+        try:
+            theevents = self._poll.poll(int(thetimeout * 1000))
+        except (select.error, IOError, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        thefds = [thefd for (thefd, theevent) in theevents]
+        if self._wakeRead in thefds:
+            try:
+                os.read(self._wakeRead, 4096)
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+            thefds.remove(self._wakeRead)
+        return thefds
+
+    def exited(self, thefds):
+        # the pidfds removed meanwhile are not in _pids anymore, and not reused yet
+        thepids = [self._pids[thefd] for thefd in thefds if thefd in self._pids]
+        for thepid in thepids:
+            self.remove(thepid)
+        for thefd in self._removed:
+            os.close(thefd)
+        self._removed = []
+        return thepids
+
+
+########################################
+class _kqueueWatcher(object):
+    """ macOS (BSD) watcher: kqueue EVFILT_PROC events with NOTE_EXIT
+    """
+    name = u'kqueue'
+
+    def __init__(self):
+        self._kqueue = select.kqueue()
+        self._pids = set()
+
+    def add(self, thepid):
+        try:
+            self._kqueue.control([select.kevent(thepid, select.KQ_FILTER_PROC, select.KQ_EV_ADD | select.KQ_EV_ONESHOT, select.KQ_NOTE_EXIT)], 0, 0)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                return False
+            raise
+        self._pids.add(thepid)
+        return True
+
+    def remove(self, thepid):
+        if thepid in self._pids:
+            self._pids.discard(thepid)
+            try:
+                self._kqueue.control([select.kevent(thepid, select.KQ_FILTER_PROC, select.KQ_EV_DELETE)], 0, 0)
+            except OSError:
+                pass
+
+    def wait(self, thetimeout):
+        try:
+            theevents = self._kqueue.control(None, max(len(self._pids), 1), thetimeout)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                return []
+            raise
+        return [theevent.ident for theevent in theevents]
+
+    def exited(self, thepids):
+        thepids = [thepid for thepid in thepids if thepid in self._pids]
+        for thepid in thepids:
+            self._pids.discard(thepid)
+        return thepids
+
+
+########################################
+class _pollingWatcher(object):
+    """ Fallback watcher: tests the processes existence at most once a second, even if
+        waited for without timeout at each event loop iteration
+    """
+    name = u'polling'
+
+    def __init__(self):
+        self._pids = set()
+        self._nextCheck = 0
+
+    def _exists(self, thepid):
+        try:
+            os.kill(thepid, 0)
+        except OSError as e:
+            return e.errno != errno.ESRCH
+        return True
+
+    def add(self, thepid):
+        if not self._exists(thepid):
+            return False
+        self._pids.add(thepid)
+        return True
+
+    def remove(self, thepid):
+        self._pids.discard(thepid)
+
+    def wait(self, thetimeout):
+        thedelay = self._nextCheck - corethread.monotonic()
+        if thedelay > thetimeout:
+            time.sleep(thetimeout)
+            return []
+        if thedelay > 0:
+            time.sleep(thedelay)
+        self._nextCheck = corethread.monotonic() + _pollingPeriod
+        return [thepid for thepid in list(self._pids) if not self._exists(thepid)]
+
+    def exited(self, thepids):
+        thepids = [thepid for thepid in thepids if thepid in self._pids]
+        for thepid in thepids:
+            self._pids.discard(thepid)
+        return thepids
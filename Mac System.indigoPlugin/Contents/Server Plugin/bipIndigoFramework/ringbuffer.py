@@ -0,0 +1,125 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################################################################################
+""" Fixed size sample history for Indigo plugins
+
+    By Bernard Philippe (bip.philippe) (C) 2015
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.#
+
+    A ring buffer keeps the last samples of one or several series of values in arrays
+    allocated once, so that its memory does not grow however long the plugin runs.
+    The total and the sorted values of each series over each time window are updated as
+    the samples are added and leave the windows, so that the minimum, maximum and 95th
+    percentile are read without sorting the window.
+"""
+####################################################################################
+
+import array
+import math
+import bisect
+
+
+########################################
+class _window(object):
+    """ Samples of a series in the last seconds: first sample number, total and sorted values
+    """
+    __slots__ = ('seconds', 'first', 'total', 'sorted')
+
+    def __init__(self, theseconds):
+        self.seconds = theseconds
+        self.first = 0
+        self.total = 0.0
+        self.sorted = array.array('f')
+
+
+class ringBuffer(object):
+    """ Last timed samples of series of values
+    """
+    __slots__ = ('size', '_times', '_values', '_count', '_windows')
+
+    def __init__(self, thesize, theseries, thewindows):
+        """ Constructor
+
+            Args:
+                thesize: maximum number of samples kept
+                theseries: number of values of a sample
+                thewindows: list of the windows durations in seconds
+        """
+        self.size = thesize
+        self._times = array.array('d', [0.0]) * thesize
+        self._values = [array.array('f', [0.0]) * thesize for theindex in range(theseries)]
+        # number of samples added since the start, the sample n being at n % size
+        self._count = 0
+        self._windows = [[_window(theseconds) for theseconds in thewindows] for theindex in range(theseries)]
+
+    def add(self, thetime, thevalues):
+        """ Adds a sample
+
+            Args:
+                thetime: time of the sample in seconds, not before the previous sample
+                thevalues: sequence of one value per series
+        """
+        theindex = self._count % self.size
+        # the sample overwritten leaves the windows first
+        if self._count >= self.size:
+            self._expire(self._count - self.size + 1, None)
+        self._times[theindex] = thetime
+        self._count = self._count + 1
+        for (theseries, thevalue) in enumerate(thevalues):
+            self._values[theseries][theindex] = thevalue
+            # the value as stored, so that the totals match the array
+            thevalue = self._values[theseries][theindex]
+            for thewindow in self._windows[theseries]:
+                thewindow.total = thewindow.total + thevalue
+                bisect.insort(thewindow.sorted, thevalue)
+        self._expire(0, thetime)
+
+    def _expire(self, thefirst, thetime):
+        """ Removes from the windows the samples before the sample number thefirst,
+            and the samples older than the window duration before thetime if not None
+        """
+        for (theseries, thewindows) in enumerate(self._windows):
+            thevalues = self._values[theseries]
+            for thewindow in thewindows:
+                thelimit = None if thetime is None else thetime - thewindow.seconds
+                while (thewindow.first < self._count) and ((thewindow.first < thefirst) or ((thelimit is not None) and (self._times[thewindow.first % self.size] < thelimit))):
+                    thevalue = thevalues[thewindow.first % self.size]
+                    thewindow.total = thewindow.total - thevalue
+                    del thewindow.sorted[bisect.bisect_left(thewindow.sorted, thevalue)]
+                    thewindow.first = thewindow.first + 1
+                if len(thewindow.sorted) == 0:
+                    # no rounding error left over
+                    thewindow.total = 0.0
+
+    def statistics(self, theseries, thewindow, thetime):
+        """ Statistics of a series over a window
+
+            Args:
+                theseries: series index
+                thewindow: window index
+                thetime: current time, the samples older than the window duration are removed
+            Returns:
+                (minimum, average, maximum, 95th percentile) tuple,
+                or None if there is no sample in the window
+        """
+        self._expire(0, thetime)
+        thestats = self._windows[theseries][thewindow]
+        thecount = self._count - thestats.first
+        if thecount <= 0:
+            return None
+        thesorted = thestats.sorted
+        thep95 = thesorted[int(math.ceil(0.95 * thecount)) - 1]
+        return (thesorted[0], thestats.total / thecount, thesorted[-1], thep95)
@@ -0,0 +1,199 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################################################################################
+""" Compiled applescript cache for Indigo plugins
+
+    By Bernard Philippe (bip.philippe) (C) 2015
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.#
+
+    Compiled scripts are stored in the cache directory, named by the sha1 of their text,
+    so a changed script text gets a new compiled file.
+    The compiled files of the previous runs are kept until the devices are started, then
+    the ones no device owns are removed (see prune).
+"""
+####################################################################################
+
+import indigo
+import core
+import shellscript
+import os
+import hashlib
+import threading
+
+_defaultCompilerCommand = [u'/usr/bin/osacompile', u'-o', u'%(output)s', u'%(source)s']
+_compiledExtension = u'.scpt'
+
+
+########################################
+def init(cacheDirectory=None, compilerCommand=None):
+    """ Initiate the cache and reads the scripts already compiled
+
+        Args:
+            cacheDirectory: directory of the compiled scripts,
+                            or None for the plugin directory in the user caches
+            compilerCommand: list of arguments of the compiler command, where %(source)s and
+                             %(output)s are replaced by the source and compiled file paths,
+                             or None for osacompile
+    """
+    if cacheDirectory is None:
+        cacheDirectory = os.path.join(os.path.expanduser(u'~/Library/Caches'), indigo.activePlugin.pluginId, u'scripts')
+    if compilerCommand is None:
+        compilerCommand = _defaultCompilerCommand
+
+    indigo.activePlugin._scriptCacheDirectory = cacheDirectory
+    indigo.activePlugin._scriptCompiler = compilerCommand
+    indigo.activePlugin._scriptCacheLock = threading.Lock()
+    # script hash -> compiled file path
+    indigo.activePlugin._compiledScripts = dict()
+    # owner (device id, script use) -> script hash
+    indigo.activePlugin._scriptOwners = dict()
+    # compiled files not owned anymore are removed - once the devices are started
+    indigo.activePlugin._scriptRemoval = False
+
+    try:
+        if not os.path.isdir(cacheDirectory):
+            os.makedirs(cacheDirectory)
+        for thefilename in os.listdir(cacheDirectory):
+            if thefilename.endswith(_compiledExtension) and not thefilename.startswith(u'.'):
+                indigo.activePlugin._compiledScripts[thefilename[:-len(_compiledExtension)]] = os.path.join(cacheDirectory, thefilename)
+    except OSError as e:
+        core.logger(errLog = u'script cache directory %s is not usable because %s' % (cacheDirectory, e))
+
+    core.logger(traceLog = (u'script cache has %s compiled scripts', len(indigo.activePlugin._compiledScripts)))
+
+
+def _hash(thescript):
+    return hashlib.sha1(thescript.encode('utf-8')).hexdigest()
+
+
+########################################
+def lookup(thescript):
+    """ Gives the compiled file of a script if it was compiled
+
+        Args:
+            thescript: applescript as text
+        Returns:
+            path of the compiled file, or None if not compiled
+    """
+    if getattr(indigo.activePlugin, '_compiledScripts', None) is None:
+        return None
+    return indigo.activePlugin._compiledScripts.get(_hash(thescript))
+
+
+def compile(thescript, theowner=None):
+    """ Compiles a script if not already in the cache
+
+        Args:
+            thescript: applescript as text
+            theowner: the owner of the script (as (device id, script use)), whose previous
+                      compiled script is removed if not used anymore, or None
+        Returns:
+            path of the compiled file, or None if the compilation failed
+    """
+    thehash = _hash(thescript)
+    with indigo.activePlugin._scriptCacheLock:
+        if theowner is not None:
+            theoldhash = indigo.activePlugin._scriptOwners.get(theowner)
+            indigo.activePlugin._scriptOwners[theowner] = thehash
+            if (theoldhash is not None) and (theoldhash != thehash):
+                _release(theoldhash)
+
+        if thehash in indigo.activePlugin._compiledScripts:
+            return indigo.activePlugin._compiledScripts[thehash]
+        thedirectory = indigo.activePlugin._scriptCacheDirectory
+        thecompiler = indigo.activePlugin._scriptCompiler
+
+    # compiled without the lock, so that the lookups and the other compilations do not
+    # wait for the compiler: the files of the thread are hidden until complete, with the
+    # extension expected by the compiler
+    thepath = os.path.join(thedirectory, thehash + _compiledExtension)
+    thetemppath = os.path.join(thedirectory, u'.%s-%s%s' % (thehash, threading.current_thread().ident, _compiledExtension))
+    thesourcepath = thetemppath + u'.source'
+    try:
+        with open(thesourcepath, 'wb') as thefile:
+            thefile.write(thescript.encode('utf-8'))
+        thecommand = [theargument % {u'source':thesourcepath, u'output':thetemppath} for theargument in thecompiler]
+        theresult = shellscript.execute(thecommand)
+        if (theresult is None) or (not os.path.isfile(thetemppath)):
+            core.logger(errLog = u'script %s could not be compiled: %s' % (thescript.splitlines()[0], u'timeout' if theresult is None else core.strutf8(theresult[1]).strip()))
+            return None
+        # the same script compiled meanwhile by another thread is replaced at once
+        os.rename(thetemppath, thepath)
+    except (IOError, OSError) as e:
+        core.logger(errLog = u'script %s could not be compiled because %s' % (thescript.splitlines()[0], e))
+        return None
+    finally:
+        for thefilepath in (thesourcepath, thetemppath):
+            if os.path.exists(thefilepath):
+                os.remove(thefilepath)
+
+    with indigo.activePlugin._scriptCacheLock:
+        indigo.activePlugin._compiledScripts[thehash] = thepath
+        if (theowner is not None) and (indigo.activePlugin._scriptOwners.get(theowner) != thehash) and indigo.activePlugin._scriptRemoval:
+            # released or replaced while compiled
+            _release(thehash)
+    core.logger(traceLog = (u'script %s compiled to %s', thescript.splitlines()[0], thepath))
+    return thepath
+
+
+def release(thedeviceid, thedeleted=False):
+    """ Releases the scripts of a device, their compiled files are removed if no other
+        device uses them - or kept for the next start when the plugin is stopping
+
+        Args:
+            thedeviceid: id of the device
+            thedeleted: True if the device is deleted, the files are then always removed
+    """
+    with indigo.activePlugin._scriptCacheLock:
+        thehashes = set()
+        for theowner in indigo.activePlugin._scriptOwners.keys():
+            if theowner[0] == thedeviceid:
+                thehashes.add(indigo.activePlugin._scriptOwners.pop(theowner))
+        if thedeleted or indigo.activePlugin._scriptRemoval:
+            for thehash in thehashes:
+                _release(thehash)
+
+
+def prune():
+    """ Removes the compiled files no device owns, left by the previous runs or by
+        devices deleted while the plugin was off - to call once the devices are started.
+        The files released later are removed at once.
+    """
+    with indigo.activePlugin._scriptCacheLock:
+        indigo.activePlugin._scriptRemoval = True
+        thehashes = list(indigo.activePlugin._compiledScripts.keys())
+        for thehash in thehashes:
+            _release(thehash)
+        core.logger(traceLog = (u'script cache pruned to %s compiled scripts', len(indigo.activePlugin._compiledScripts)))
+
+
+def keep():
+    """ Keeps the compiled files released from now on for the next start - to call
+        when the plugin is stopping, before the devices are stopped
+    """
+    with indigo.activePlugin._scriptCacheLock:
+        indigo.activePlugin._scriptRemoval = False
+
+
+def _release(thehash):
+    if thehash in indigo.activePlugin._scriptOwners.values():
+        return
+    thepath = indigo.activePlugin._compiledScripts.pop(thehash, None)
+    if thepath is not None:
+        try:
+            os.remove(thepath)
+        except OSError:
+            pass
@@ -0,0 +1,254 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################################################################################
+""" Persistent applescript host for Indigo plugins
+
+    By Bernard Philippe (bip.philippe) (C) 2015
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.#
+
+    Sends the scripts to a long-lived host process (scripthostserver.py by default)
+    instead of starting osascript for each script. See scripthostserver.py for the protocol.
+"""
+####################################################################################
+
+import indigo
+import core
+import subprocess
+import os
+import select
+import errno
+import signal
+import time
+import sys
+import threading
+
+_hostServer = os.path.join(os.path.dirname(os.path.abspath(__file__)), u'scripthostserver.py')
+_maxFailures = 3
+
+
+########################################
+def init(hostCommand=None, python=None):
+    """ Initiate the script host - it is started on its first use
+
+        Args:
+            hostCommand: list of arguments of the host process command,
+                         or None for the default applescript host
+            python: python interpreter of the default host,
+                    or None or empty for the one running the plugin
+    """
+    if hostCommand is None:
+        hostCommand = [python or _defaultPython(), _hostServer]
+    stop()
+    indigo.activePlugin._scriptHost = scriptHost(hostCommand)
+
+
+def _defaultPython():
+    """ Interpreter running the plugin, or the python of the path if the plugin
+        is not run by a python command (as in the plugin host of the server)
+    """
+    if os.path.basename(sys.executable).startswith(u'python'):
+        return sys.executable
+    return u'python'
+
+
+def stop():
+    """ Stops the script host if any
+    """
+    if getattr(indigo.activePlugin, '_scriptHost', None) is not None:
+        indigo.activePlugin._scriptHost.stop()
+    indigo.activePlugin._scriptHost = None
+
+
+def execute(thescript, timeout=None):
+    """ Runs a script in the script host
+
+        Args:
+            thescript: script as text
+            timeout: time in seconds before the script is abandoned,
+                     or None for the default shell timeout
+        Returns:
+            (output, error) tuple of the script texts,
+            None if the script timed out or the host died while running it,
+            or False if there is no usable host and the script was not sent - the script
+            is then to be run otherwise
+    """
+    thehost = getattr(indigo.activePlugin, '_scriptHost', None)
+    if thehost is None:
+        return False
+    if timeout is None:
+        timeout = indigo.activePlugin._shellTimeout
+    return thehost.execute(thescript, timeout)
+
+
+########################################
+class _hostDied(Exception):
+    """ The host died after the script was sent: the script may have run
+    """
+    pass
+
+
+class _notSent(_hostDied):
+    """ The host could not be started or died before the script was sent
+    """
+    pass
+
+
+class scriptHost(object):
+    """ Supervised host process: started when needed, restarted after a crash or
+        a timeout, given up after repeated failures
+    """
+    def __init__(self, thecommand):
+        self._command = thecommand
+        self._process = None
+        self._failures = 0
+        self._lock = threading.Lock()
+
+    def _start(self):
+        core.logger(traceLog = (u'starting script host %s', u' '.join(self._command)))
+        self._process = subprocess.Popen(self._command,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         close_fds=True,
+                                         preexec_fn=os.setpgrp)
+        self._buffer = b''
+
+    def stop(self):
+        """ Kills the host process
+        """
+        with self._lock:
+            self._kill()
+
+    def _kill(self):
+        if self._process is not None:
+            try:
+                os.killpg(self._process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            self._process.wait()
+            self._process.stdin.close()
+            self._process.stdout.close()
+            self._process = None
+
+    def _fill(self, thedeadline):
+        """ Reads the available bytes from the host into the buffer
+
+            Returns:
+                False on timeout, True if not
+        """
+        thefd = self._process.stdout.fileno()
+        while True:
+            theremaining = thedeadline - time.time()
+            if theremaining <= 0:
+                return False
+            try:
+                (thereadyfds, thewfds, thexfds) = select.select([thefd], [], [], theremaining)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if len(thereadyfds) > 0:
+                thedata = os.read(thefd, 65536)
+                if len(thedata) == 0:
+                    raise _hostDied()
+                self._buffer = self._buffer + thedata
+                return True
+
+    def _read(self, thelength, thedeadline):
+        """ Reads thelength bytes from the host, None on timeout
+        """
+        while len(self._buffer) < thelength:
+            if not self._fill(thedeadline):
+                return None
+        thedata = self._buffer[:thelength]
+        self._buffer = self._buffer[thelength:]
+        return thedata
+
+    def _readHeader(self, thedeadline):
+        """ Reads the response header line, None on timeout
+        """
+        while b'\n' not in self._buffer:
+            if not self._fill(thedeadline):
+                return None
+        (theheader, self._buffer) = self._buffer.split(b'\n', 1)
+        return theheader
+
+    def _exchange(self, thescript, thedeadline):
+        thepayload = thescript.encode('utf-8')
+        try:
+            if self._process is None:
+                self._start()
+            self._process.stdin.write(b'%d\n' % len(thepayload) + thepayload)
+            self._process.stdin.flush()
+        except (IOError, OSError) as e:
+            raise _notSent(e)
+
+        theheader = self._readHeader(thedeadline)
+        if theheader is None:
+            return None
+        try:
+            (theoutlength, theerrlength) = [int(thevalue) for thevalue in theheader.split()]
+        except ValueError:
+            raise _hostDied(u'invalid response header')
+        thedata = self._read(theoutlength + theerrlength, thedeadline)
+        if thedata is None:
+            return None
+        return (thedata[:theoutlength], thedata[theoutlength:])
+
+    def execute(self, thescript, thetimeout):
+        """ Sends a script to the host and waits for its result
+
+            Args:
+                thescript: script as text
+                thetimeout: time in seconds before the script is abandoned
+            Returns:
+                (output, error) tuple, None if timeout, False if the host is not usable
+        """
+        with self._lock:
+            if self._failures >= _maxFailures:
+                return False
+
+            thedeadline = time.time() + thetimeout
+            # a script is sent again to a restarted host only if it was not sent: the
+            # scripts have side effects (quit an application, eject a volume)
+            for theattempt in (1, 2):
+                try:
+                    theresult = self._exchange(thescript, thedeadline)
+                except _notSent as e:
+                    core.logger(traceLog = (u'script host not usable: %s', e))
+                    self._failed()
+                    if self._failures >= _maxFailures:
+                        return False
+                    continue
+                except (_hostDied, OSError) as e:
+                    core.logger(errLog = u'script host died while running a script: %s' % (e))
+                    self._failed()
+                    return None
+
+                if theresult is None:
+                    # the host is busy with an abandoned script: start a new one next time
+                    self._kill()
+                else:
+                    self._failures = 0
+                return theresult
+            return False
+
+    def _failed(self):
+        """ Kills the host after a failure, and gives up after repeated failures
+        """
+        self._kill()
+        self._failures = self._failures + 1
+        if self._failures == _maxFailures:
+            core.logger(errLog = u'script host failed %s times, scripts will be run by osascript' % (self._failures))
@@ -0,0 +1,143 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################################################################################
+""" Applescript host process for Indigo plugins
+
+    By Bernard Philippe (bip.philippe) (C) 2015
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.#
+
+    Runs as a separate long-lived process, started by scripthost.py
+    Protocol on stdin/stdout:
+        request:  "<script length>\n<script utf-8 text>"
+        response: "<output length> <error length>\n<output><error>"
+    output and error are the texts osascript would write on stdout and stderr.
+
+    Usage: scripthostserver.py [--shell]
+        --shell runs the scripts with /bin/sh instead of applescript (stand-in for tests)
+"""
+####################################################################################
+
+import sys
+import subprocess
+
+_maxCompiledScripts = 64
+
+
+########################################
+def _readFrame(thestdin):
+    """ Reads a request, returns the script as bytes or None at end of input
+    """
+    theheader = thestdin.readline()
+    if len(theheader) == 0:
+        return None
+    thelength = int(theheader.strip())
+    thescript = b''
+    while len(thescript) < thelength:
+        thechunk = thestdin.read(thelength - len(thescript))
+        if len(thechunk) == 0:
+            return None
+        thescript = thescript + thechunk
+    return thescript
+
+
+def _writeFrame(thestdout, theoutput, theerror):
+    thestdout.write(('%d %d\n' % (len(theoutput), len(theerror))).encode('ascii') + theoutput + theerror)
+    thestdout.flush()
+
+
+########################################
+class _processRunner(object):
+    """ Runs each script in a subprocess: osascript, or the shell for tests
+    """
+    def __init__(self, thecommand):
+        self._command = thecommand
+
+    def run(self, thescript):
+        p = subprocess.Popen(self._command + [thescript], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+        return p.communicate()
+
+
+class _appleScriptRunner(object):
+    """ Runs the scripts in process with NSAppleScript, keeping them compiled
+    """
+    def __init__(self):
+        import Foundation
+        self._Foundation = Foundation
+        self._compiled = dict()
+
+    def run(self, thescript):
+        thesource = thescript.decode('utf-8')
+        if thesource in self._compiled:
+            theapplescript = self._compiled[thesource]
+        else:
+            theapplescript = self._Foundation.NSAppleScript.alloc().initWithSource_(thesource)
+            (thesuccess, theerror) = theapplescript.compileAndReturnError_(None)
+            if not thesuccess:
+                return (b'', _errorText(theerror, u'syntax error'))
+            if len(self._compiled) >= _maxCompiledScripts:
+                self._compiled.clear()
+            self._compiled[thesource] = theapplescript
+
+        (theresult, theerror) = theapplescript.executeAndReturnError_(None)
+        if theresult is None:
+            return (b'', _errorText(theerror, u'execution error'))
+        thetext = theresult.stringValue()
+        if thetext is None:
+            return (b'', b'')
+        return ((thetext + u'\n').encode('utf-8'), b'')
+
+
+def _errorText(theerror, thekind):
+    """ Error text in the format of osascript: "start:end: kind: message (number)",
+        the range being the characters of the script in error
+    """
+    themessage = theerror.get(u'NSAppleScriptErrorMessage', u'unknown error')
+    thenumber = theerror.get(u'NSAppleScriptErrorNumber', -2700)
+    therange = theerror.get(u'NSAppleScriptErrorRange')
+    if therange is None:
+        (thestart, theend) = (0, 0)
+    else:
+        therange = therange.rangeValue()
+        (thestart, theend) = (therange.location, therange.location + therange.length)
+    return (u'%d:%d: %s: %s (%d)\n' % (thestart, theend, thekind, themessage, thenumber)).encode('utf-8')
+
+
+########################################
+def main(theargs):
+    thestdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    thestdout = getattr(sys.stdout, 'buffer', sys.stdout)
+
+    if '--shell' in theargs:
+        therunner = _processRunner(['/bin/sh', '-c'])
+    else:
+        try:
+            therunner = _appleScriptRunner()
+        except ImportError:
+            therunner = _processRunner(['osascript', '-e'])
+
+    while True:
+        thescript = _readFrame(thestdin)
+        if thescript is None:
+            break
+        try:
+            (theoutput, theerror) = therunner.run(thescript)
+        except Exception as e:
+            (theoutput, theerror) = (b'', (u'script host error: %s\n' % (e,)).encode('utf-8'))
+        _writeFrame(thestdout, theoutput, theerror)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -25,16 +25,142 @@ import subprocess
 import indigo
 import core
 import re
+import os
+import select
+import errno
+import signal
+import time
+import threading
+import eventloop
+import perfstats
+import accounting
+
+# time in seconds without output after which the end of the subprocess is checked
+_exitCheck = 0.5
 
 
 ########################################
-def init():
+def init(maxProcesses=4, timeout=30):
     """ Initiate some handlings
+
+        Args:
+            maxProcesses: maximum number of subprocesses running at once
+            timeout: default time in seconds before a subprocess is killed
+    """
+    indigo.activePlugin._shellSemaphore = threading.BoundedSemaphore(maxProcesses)
+    indigo.activePlugin._shellTimeout = timeout
+    accounting.init()
+
+########################################
+def execute(thecommand, shell=False, timeout=None, label=None):
+    """ Runs a subprocess and waits for its completion or its timeout - the processes it
+        started in the background and which keep its outputs open (daemons) are left
+        running, their outputs are not read once the subprocess ended
+
+        Args:
+            thecommand: command as text (shell) or list of arguments
+            shell: True if the command is to be run by the shell
+            timeout: time in seconds before the subprocess is killed,
+                     or None for the default timeout
+            label: label the subprocess is accounted for, or None for its first command
+        Returns:
+            (output, error) tuple of the subprocess texts,
+            or None if the subprocess timed out
+    """
+    if timeout is None:
+        timeout = indigo.activePlugin._shellTimeout
+
+    with indigo.activePlugin._shellSemaphore:
+        p = subprocess.Popen(thecommand,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               shell=shell,
+                               close_fds=True,
+                               preexec_fn=os.setpgrp)
+        thestarted = time.time()
+        thedeadline = thestarted + timeout
+        theoutfd = p.stdout.fileno()
+        theerrfd = p.stderr.fileno()
+        thebuffers = {theoutfd:[], theerrfd:[]}
+        theopenfds = [theoutfd, theerrfd]
+
+        try:
+            # read both outputs as they come until they are closed
+            while len(theopenfds)>0:
+                theremaining = thedeadline - time.time()
+                if theremaining <= 0:
+                    break
+                try:
+                    (thereadyfds, thewfds, thexfds) = select.select(theopenfds, [], [], min(theremaining, _exitCheck))
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if (len(thereadyfds)==0) and (p.poll() is not None):
+                    # ended, the outputs being kept open by the processes it started
+                    break
+                for thefd in thereadyfds:
+                    thedata = os.read(thefd, 65536)
+                    if len(thedata)>0:
+                        thebuffers[thefd].append(thedata)
+                    else:
+                        theopenfds.remove(thefd)
+
+            theoutput = ''.join(thebuffers[theoutfd])
+            theerror = ''.join(thebuffers[theerrfd])
+            if (len(theopenfds)>0) and (p.poll() is None):
+                # timeout: kill the whole process group, as the shell may have children
+                accounting.record(thecommand, time.time() - thestarted, theoutput, theerror, label)
+                os.killpg(p.pid, signal.SIGKILL)
+                p.wait()
+                return None
+
+            # then wait for the end of the process, which closed its outputs
+            thestart = perfstats.start()
+            p.wait()
+            perfstats.phase(u'processWait', thestart)
+            accounting.record(thecommand, time.time() - thestarted, theoutput, theerror, label)
+        finally:
+            p.stdout.close()
+            p.stderr.close()
+
+    return (theoutput, theerror)
+
+########################################
+def launch(pscript):
+    """ Starts a shell script in its own session and returns at once, without reading its
+        outputs nor killing it - for the programs and daemons started by the actions,
+        which may run in the foreground for ever
+
+        Args:
+            pscript: shell script as text
+        Returns:
+            True if started, False if not
     """
-    pass
+    logscript=(pscript.split(u'|'))[0]
+
+    core.logger(traceRaw = (u'going to launch shell %s', pscript), traceLog = (u'going to launch shell %s...', logscript))
+
+    thestarted = time.time()
+    try:
+        with open(os.devnull, 'r+b') as thenull:
+            # the subprocess module reaps it when it ends, at one of the next starts
+            p = subprocess.Popen(pscript,
+                                   stdin=thenull,
+                                   stdout=thenull,
+                                   stderr=thenull,
+                                   shell=True,
+                                   close_fds=True,
+                                   preexec_fn=os.setsid)
+    except OSError as e:
+        core.logger(errLog = u'shell script %s... could not be launched because %s' % (logscript, e))
+        return False
+    accounting.record(pscript, time.time() - thestarted, '', '', logscript)
+    core.logger(traceLog = (u'shell %s... launched with pid %s', logscript, p.pid))
+    return True
 
 ########################################
-def run(pscript, rule=None, akeys=None):
+def run(pscript, rule=None, akeys=None, timeout=None):
     """ Calls shell script and returns the result
 
         Args:
@@ -45,6 +171,8 @@ def run(pscript, rule=None, akeys=None):
                   or None for no action on text
             akeys: list of keys, ordered the same way that output data of the shell,
                    or None
+            timeout: time in seconds before the script is killed,
+                     or None for the default timeout
         Returns:
             python dictionnay of the states names and values,
             or unicode string returned by the script is akeys is None,
@@ -53,16 +181,39 @@ def run(pscript, rule=None, akeys=None):
     
     logscript=(pscript.split(u'|'))[0]
 
-    core.logger(traceRaw = u'going to call shell %s' % (pscript), traceLog = u'going to call shell %s...' % (logscript))
+    core.logger(traceRaw = (u'going to call shell %s', pscript), traceLog = (u'going to call shell %s...', logscript))
+
+    thestart = perfstats.start()
+    presult = execute(pscript, shell=True, timeout=timeout, label=logscript)
+    perfstats.command(logscript, thestart)
+    return _result(pscript, presult, rule, akeys)
+
+
+def runTask(pscript, rule=None, akeys=None, timeout=None):
+    """ Same as run, as an event loop task
+
+        Returns (see eventloop):
+            same as run
+    """
+    logscript=(pscript.split(u'|'))[0]
+
+    core.logger(traceRaw = (u'going to call shell %s', pscript), traceLog = (u'going to call shell %s...', logscript))
+
+    thestart = perfstats.start()
+    presult = yield eventloop.command(pscript, shell=True, timeout=timeout, label=logscript)
+    perfstats.command(logscript, thestart)
+    raise eventloop.taskReturn(_result(pscript, presult, rule, akeys))
 
 
-    p = subprocess.Popen(pscript,
-                           stdout=subprocess.PIPE,
-                           stderr=subprocess.PIPE,
-                           shell=True,
-                           close_fds=True)
-    indigo.activePlugin.sleep(0.1)
-    (pvalues, perror) = p.communicate()
+def _result(pscript, presult, rule, akeys):
+    """ Checks and converts the output of a shell script (see run)
+    """
+    logscript=(pscript.split(u'|'))[0]
+
+    if presult is None:
+        core.logger(errLog = u'shell script %s... killed after timeout' % (logscript))
+        return None
+    (pvalues, perror) = presult
 
     if len(perror)>0:
         # test if error
@@ -94,7 +245,7 @@ def run(pscript, rule=None, akeys=None):
             for thekey in akeys:
                 returnvalue[thekey]=''
 
-    core.logger(traceRaw = u'returned from shell: %s' % (core.formatdump(returnvalue)), traceLog = u'returned from shell %s...' % (logscript))
+    core.logger(traceRaw = lambda: u'returned from shell: %s' % (core.formatdump(returnvalue)), traceLog = (u'returned from shell %s...', logscript))
 
     return returnvalue
 
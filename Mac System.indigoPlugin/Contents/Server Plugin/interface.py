@@ -22,11 +22,21 @@
 ####################################################################################
 
 import indigo
+import os
 import time
+import threading
 from bipIndigoFramework import core
+from bipIndigoFramework import accounting
 from bipIndigoFramework import osascript
+from bipIndigoFramework import scriptcache
 from bipIndigoFramework import shellscript
+from bipIndigoFramework import pathwatch
+from bipIndigoFramework import eventloop
+from bipIndigoFramework import corethread
+import processsource
+import registry
 import re
+import math
 import pipes
 
 
@@ -34,57 +44,328 @@ import pipes
 # Note the "indigo" module is automatically imported and made available inside
 # our global name space by the host process.
 
-_repProcessStatus = re.compile(r" *([0-9]+) +(.).+$")
-_repProcessData = re.compile(r"(.+?)  +([0-9.,]+) +([0-9.,]+) +(.+)$")
-_repVolumeData2 = re.compile(r".+? [0-9]+ +([0-9]+) +([0-9]+) .+")
+_repVolumeData2 = re.compile(r"(.+?) +[0-9]+ +([0-9]+) +([0-9]+) .+")
+_volumeSourceCommands = {u'diskutil':u"/usr/sbin/diskutil list", u'df':u"/bin/df -k"}
+_mountedVolumesCommand = u"ls -1 /Volumes"
 
-def init():
-    osascript.init()
+def init(theprocesssource=u'auto', thescripthost=False, thescriptpython=None):
     shellscript.init()
+    osascript.init(thescripthost, python=thescriptpython)
+    indigo.activePlugin._processSource = processsource.getProcessSource(theprocesssource)
+    indigo.activePlugin._processTable = None
+    indigo.activePlugin._processData = None
+    indigo.activePlugin._processClassifier = processsource.processClassifier()
+    indigo.activePlugin._processMatches = None
+    indigo.activePlugin._processInstances = None
+    indigo.activePlugin._processLock = threading.RLock()
+    indigo.activePlugin._volumeInventory = dict()
+    indigo.activePlugin._volumeLock = threading.RLock()
+    indigo.activePlugin._volumeWatcher = pathwatch.watchDirectory(u'/Volumes')
+    indigo.activePlugin._mountedVolumes = None
+    indigo.activePlugin._volumesChanged = None
+
+
+def setProcessSource(theprocesssource):
+    """ Changes the source used to read the system tasklist
+
+        Args:
+            theprocesssource: u'auto' for the system library, u'ps' for the ps command
+    """
+    indigo.activePlugin._processSource = processsource.getProcessSource(theprocesssource)
+
+
+def newCycle(checkVolumes=True):
+    """ Invalidates the snapshots taken during the previous dialog cycle - the devices
+        still polled by a worker thread past the previous cycle deadline keep reading
+        a whole snapshot, the old or the new one
+
+        Args:
+            checkVolumes: True to check the mounted volumes now, False if checked by
+                          checkMountedVolumesTask
+    """
+    with indigo.activePlugin._processLock:
+        indigo.activePlugin._processTable = None
+        indigo.activePlugin._processMatches = None
+        indigo.activePlugin._processInstances = None
+        indigo.activePlugin._processData = None
+    with indigo.activePlugin._volumeLock:
+        indigo.activePlugin._volumeInventory = dict()
+        if checkVolumes:
+            _checkMountedVolumes()
 
 
 ##########
 # Application device
 ########################
 pStatusDict ={'I':u'idle','R':u'running', 'S':u'running', 'T':u'stopped', 'U':u'waiting', 'Z':u'zombie' }
+# usage statistics states: PCpuMinShort ... PMemP95Long, in the order of the ring buffer series and windows
+_usageStates = (u'PCpu', u'PMem')
+_usageStatistics = (u'Min', u'Avg', u'Max', u'P95')
+_usageWindows = (u'Short', u'Long')
+usageStates = [thestate + thestatistic + thewindow for thestate in _usageStates for thewindow in _usageWindows for thestatistic in _usageStatistics]
 
-def getProcessStatus(thedevice, thevaluesDict):
-    """ Searches for the task in system tasklist and returns onOff states
+def addProcessDevice(therecord):
+    """ Adds or updates the process name of a device in the process classifier
+
+        Args:
+            therecord: current device record (see registry)
+    """
+    indigo.activePlugin._processClassifier.add(therecord.id, therecord.processName, therecord.aggregate==True)
+
+
+def updateProcessDevice(therecord):
+    """ Updates the process name of a device in the process classifier if it changed -
+        the snapshot of the cycle is then to be read again
+
+        Args:
+            therecord: current device record (see registry)
+        Returns:
+            True if the process name changed
+    """
+    with indigo.activePlugin._processLock:
+        if indigo.activePlugin._processClassifier.hasPattern(therecord.id, therecord.processName, therecord.aggregate==True):
+            return False
+        # device not started yet or changed meanwhile: classify the snapshot again with it
+        addProcessDevice(therecord)
+        indigo.activePlugin._processTable = None
+        return True
+
+
+def removeProcessDevice(thedevice):
+    """ Removes a device from the process classifier
 
         Args:
             thedevice: current device
+    """
+    indigo.activePlugin._processClassifier.remove(thedevice.id)
+
+
+def readProcessTable():
+    """ Reads the system tasklist once and finds the processes of all the devices in one pass
+
+        Returns:
+            True if success, False if not
+    """
+    thedevice = accounting.setPlugin()
+    try:
+        return _setProcessTable(indigo.activePlugin._processSource.readTable())
+    finally:
+        accounting.restoreDevice(thedevice)
+
+
+def readProcessTableTask():
+    """ Same as readProcessTable, as an event loop task
+
+        Returns (see eventloop):
+            True if success, False if not
+    """
+    thesource = indigo.activePlugin._processSource
+    thedevice = accounting.setPlugin()
+    try:
+        if thesource.forks:
+            pslist = yield shellscript.runTask(thesource.tableCommand())
+            therows = thesource.parseTable(pslist)
+        else:
+            therows = thesource.readTable()
+        theresult = _setProcessTable(therows)
+    finally:
+        accounting.restoreDevice(thedevice)
+    raise eventloop.taskReturn(theresult)
+
+
+def _setProcessTable(therows):
+    """ Keeps the tasklist read for the cycle and finds the processes of the devices
+
+        Args:
+            therows: list of (pid, state, command) rows, or None if error
+        Returns:
+            True if success, False if not
+    """
+    if therows is None:
+        indigo.activePlugin._processTable = None
+        indigo.activePlugin._processMatches = None
+        indigo.activePlugin._processInstances = None
+        return False
+
+    indigo.activePlugin._processTable = therows
+    (indigo.activePlugin._processMatches, indigo.activePlugin._processInstances) = indigo.activePlugin._processClassifier.classify(therows)
+    core.logger(traceLog = (u'process table read with %s processes, %s devices matched', len(therows), len(indigo.activePlugin._processMatches)))
+    _sampleProcessUsage()
+    return True
+
+
+def _instancePids(therecord, thepid):
+    """ Process ids of a device: all its instances if aggregated, its process id if not
+    """
+    if therecord.aggregate and (indigo.activePlugin._processInstances is not None) and (therecord.id in indigo.activePlugin._processInstances):
+        return [therow[0] for therow in indigo.activePlugin._processInstances[therecord.id]]
+    return [thepid]
+
+
+def _sampleProcessUsage():
+    """ Adds the cpu and memory usage of the processes found to the usage history of their devices,
+        summed over the instances of the aggregated devices
+    """
+    thematches = indigo.activePlugin._processMatches
+    therecords = [therecord for therecord in registry.records(u'process') if therecord.id in thematches]
+    thepids = [thematches[therecord.id][0] for therecord in therecords]
+    thepids.extend([thepid for therecord in therecords if therecord.aggregate for thepid in _instancePids(therecord, thematches[therecord.id][0])])
+    theusage = indigo.activePlugin._processSource.readUsage(thepids)
+    thenow = corethread.monotonic()
+    for therecord in therecords:
+        if therecord.aggregate:
+            thesamples = [theusage[thepid] for thepid in _instancePids(therecord, thematches[therecord.id][0]) if thepid in theusage]
+            if len(thesamples) > 0:
+                therecord.usage.add(thenow, [math.fsum(thevalues) for thevalues in zip(*thesamples)])
+        else:
+            thesample = theusage.get(thematches[therecord.id][0])
+            if thesample is not None:
+                therecord.usage.add(thenow, thesample)
+
+
+def getProcessStatus(therecord, thevaluesDict):
+    """ Searches for the task in system tasklist snapshot and returns onOff states
+
+        Args:
+            therecord: current device record (see registry)
             thevaluesDict: dictionary of the status values so far
         Returns:
             success: True if success, False if not
             thevaluesDict updated with new data if success, equals to the input if not
     """
-    pslist = shellscript.run(u"ps -awxc -opid,state,args | egrep %s" % (pipes.quote(u' ' + thedevice.pluginProps[u'ApplicationProcessName']+u'$')),_repProcessStatus,[u'ProcessID',u'PStatus'])
+    # the snapshot is read once even if devices are polled by several threads
+    with indigo.activePlugin._processLock:
+        updateProcessDevice(therecord)
+
+        if indigo.activePlugin._processTable is None:
+            if not readProcessTable():
+                return (False,thevaluesDict)
 
-    if pslist[u'ProcessID']==u'':
+        therow = indigo.activePlugin._processMatches.get(therecord.id)
+
+    if therow is None:
         thevaluesDict[u'onOffState']=False
         thevaluesDict[u'ProcessID']=0
         thevaluesDict[u'PStatus']="off"
     else:
         thevaluesDict[u'onOffState']=True
-        thevaluesDict.update(pslist)
+        thevaluesDict[u'ProcessID']=therow[0]
         # special update for process status
-        thevaluesDict[u'PStatus']= pStatusDict[thevaluesDict[u'PStatus']]
+        thevaluesDict[u'PStatus']= pStatusDict[therow[1][0]]
+
+    # helpers and daemons: instances found in the snapshot
+    if therecord.aggregate is not None:
+        if therow is None:
+            thevaluesDict[u'Instances']=0
+        else:
+            thevaluesDict[u'Instances']=len(_instancePids(therecord, therow[0]))
 
     return (True,thevaluesDict)
 
-def getProcessData(thedevice, thevaluesDict):
-    """ Searches for the task in system tasklist and returns states data
+def processDataPids(processDataList):
+    """ Process ids which detailed data is to be read for a list of devices, with all
+        the instances of the aggregated devices
 
         Args:
-            thedevice: current device
+            processDataList: list of (device record, states values) tuples
+        Returns:
+            list of process ids
+    """
+    thepids = []
+    for (therecord, thevaluesDict) in processDataList:
+        if therecord.aggregate:
+            thepids.extend(_instancePids(therecord, thevaluesDict[u'ProcessID']))
+        else:
+            thepids.append(thevaluesDict[u'ProcessID'])
+    return thepids
+
+def readProcessData(thepidlist):
+    """ Reads the detailed data of a list of processes with a single process source read
+        and adds it to the detailed data of the cycle
+
+        Args:
+            thepidlist: list of process ids (0 or empty ids are ignored)
+        Returns:
+            True if success, False if not
+    """
+    thepidlist = _pidList(thepidlist)
+    if len(thepidlist)==0:
+        return True
+
+    return _setProcessData(thepidlist, indigo.activePlugin._processSource.readData(thepidlist))
+
+
+def readProcessDataTask(thepidlist):
+    """ Same as readProcessData, as an event loop task
+
+        Returns (see eventloop):
+            True if success, False if not
+    """
+    thepidlist = _pidList(thepidlist)
+    if len(thepidlist)==0:
+        raise eventloop.taskReturn(True)
+
+    thesource = indigo.activePlugin._processSource
+    if thesource.forks:
+        pslist = yield shellscript.runTask(thesource.dataCommand(thepidlist))
+        thedata = thesource.parseData(pslist)
+    else:
+        thedata = thesource.readData(thepidlist)
+    raise eventloop.taskReturn(_setProcessData(thepidlist, thedata))
+
+
+def _pidList(thepidlist):
+    if indigo.activePlugin._processData is None:
+        indigo.activePlugin._processData = dict()
+    return [core.strutf8(thepid) for thepid in thepidlist if core.strutf8(thepid) not in (u'',u'0')]
+
+
+def _setProcessData(thepidlist, thedata):
+    """ Adds the detailed data read to the detailed data of the cycle
+
+        Args:
+            thepidlist: list of the process ids read
+            thedata: dictionary pid -> data, or None if error
+        Returns:
+            True if success, False if not
+    """
+    if thedata is None:
+        return False
+
+    indigo.activePlugin._processData.update(thedata)
+
+    # processes that vanished since the status read are kept as None
+    for thepid in thepidlist:
+        if thepid not in indigo.activePlugin._processData:
+            indigo.activePlugin._processData[thepid] = None
+
+    core.logger(traceLog = (u'process data read for %s processes', len(thepidlist)))
+    return True
+
+
+def getProcessData(therecord, thevaluesDict):
+    """ Searches for the task in the detailed data read for the cycle and returns states data -
+        for the aggregated devices, cpu and memory are summed over the instances and the
+        start is the one of the oldest instance
+
+        Args:
+            therecord: current device record (see registry)
             thevaluesDict: dictionary of the status values so far
         Returns:
             success: True if success, False if not
             thevaluesDict updated with new data if success, equals to the input if not
     """
-    pslist = shellscript.run(u"ps -wxc -olstart,pcpu,pmem,etime -p%s | sed 1d" % (thevaluesDict[u'ProcessID']),_repProcessData,[u'LStart','PCpu','PMem','ETime'])
+    thepid = core.strutf8(thevaluesDict[u'ProcessID'])
 
-    if pslist[u'LStart']=='':
+    if therecord.aggregate and (thepid not in (u'',u'0')):
+        return _getInstancesData(therecord, thepid, thevaluesDict)
+
+    # read the process alone if not part of the batch read of the cycle
+    if (thepid not in (u'',u'0')) and ((indigo.activePlugin._processData is None) or (thepid not in indigo.activePlugin._processData)):
+        if not readProcessData([thepid]):
+            return (False,thevaluesDict)
+
+    if (thepid in (u'',u'0')) or (indigo.activePlugin._processData[thepid] is None):
         thevaluesDict[u'onOffState']=False
         thevaluesDict[u'ProcessID']=0
         thevaluesDict[u'PStatus']="off"
@@ -92,38 +373,344 @@ def getProcessData(thedevice, thevaluesDict):
         thevaluesDict[u'ETime']=0
         thevaluesDict[u'PCpu']=0
         thevaluesDict[u'PMem']=0
+        if therecord.aggregate is not None:
+            thevaluesDict[u'Instances']=0
     else:
-        thevaluesDict.update(pslist)
-        # special update for ellapsed time : convert to seconds
-        try:
-            (longday,longtime)=thevaluesDict[u'ETime'].split('-')
-        except:
-            longtime=thevaluesDict[u'ETime']
-            longday=0
-        try:
-        	(longh,longm,longs)=longtime.split(':')
-        except:
-        	(longm,longs)=longtime.split(':')
-        	longh=0
-		thevaluesDict[u'ETime']= ((int(longday)*24 + int(longh))*60 + int(longm))*60 + int(longs)
+        thevaluesDict.update(indigo.activePlugin._processData[thepid])
 
     return (True,thevaluesDict)
 
+def _getInstancesData(therecord, thepid, thevaluesDict):
+    """ Same as getProcessData, for all the instances of an aggregated device
+    """
+    thepids = [core.strutf8(theinstance) for theinstance in _instancePids(therecord, thepid)]
+
+    # read the instances not part of the batch read of the cycle together
+    if indigo.activePlugin._processData is None:
+        themissing = thepids
+    else:
+        themissing = [theinstance for theinstance in thepids if theinstance not in indigo.activePlugin._processData]
+    if len(themissing)>0:
+        if not readProcessData(themissing):
+            return (False,thevaluesDict)
+
+    thedata = [indigo.activePlugin._processData[theinstance] for theinstance in thepids if indigo.activePlugin._processData[theinstance] is not None]
+    if len(thedata)==0:
+        thevaluesDict[u'onOffState']=False
+        thevaluesDict[u'ProcessID']=0
+        thevaluesDict[u'PStatus']="off"
+        thevaluesDict[u'Instances']=0
+        thevaluesDict[u'LStart']=""
+        thevaluesDict[u'ETime']=0
+        thevaluesDict[u'PCpu']=0
+        thevaluesDict[u'PMem']=0
+    else:
+        theoldest = max(thedata, key=lambda thevalues: thevalues[u'ETime'])
+        thevaluesDict[u'Instances']=len(thedata)
+        thevaluesDict[u'LStart']=theoldest[u'LStart']
+        thevaluesDict[u'ETime']=theoldest[u'ETime']
+        thevaluesDict[u'PCpu']=u'%.1f' % (math.fsum([_percentage(thevalues[u'PCpu']) for thevalues in thedata]))
+        thevaluesDict[u'PMem']=u'%.1f' % (math.fsum([_percentage(thevalues[u'PMem']) for thevalues in thedata]))
+
+    return (True,thevaluesDict)
+
+def _percentage(thetext):
+    # ps writes the decimal separator of the locale
+    try:
+        return float(core.strutf8(thetext).replace(u',',u'.'))
+    except ValueError:
+        return 0.0
+
+def getProcessUsage(therecord, thevaluesDict):
+    """ Computes the usage statistics states of a process over the short and long windows
+
+        Args:
+            therecord: current device record (see registry)
+            thevaluesDict: dictionary of the status values so far
+        Returns:
+            success: True if success, False if not
+            thevaluesDict updated with new data
+    """
+    thenow = corethread.monotonic()
+    for (theseries, thestate) in enumerate(_usageStates):
+        for (thewindow, thewindowname) in enumerate(_usageWindows):
+            thestatistics = therecord.usage.statistics(theseries, thewindow, thenow)
+            if thestatistics is None:
+                thestatistics = (0, 0, 0, 0)
+            for (thestatistic, thevalue) in zip(_usageStatistics, thestatistics):
+                thevaluesDict[thestate + thestatistic + thewindowname] = round(thevalue, 1)
+
+    return (True,thevaluesDict)
+
+
+def stopScript(theprops):
+    """ Applescript quitting an application
+
+        Args:
+            theprops: device properties
+        Returns:
+            applescript as text
+    """
+    return u'''(* Tell to quit *)
+        %s''' % (theprops[u'ApplicationStopPathName'])
+
+
+def closeWindowsScript(theprops):
+    """ Applescript closing the windows of an application
+
+        Args:
+            theprops: device properties
+        Returns:
+            applescript as text
+    """
+    return u'''(* Tell to close window *)
+        %s''' % (theprops[u'windowcloseScript'])
+
+
+def compileApplicationScripts(thedeviceid, theprops):
+    """ Compiles the applescripts of an application device in the script cache
+
+        Args:
+            thedeviceid: id of the device
+            theprops: device properties
+    """
+    if u'ApplicationStopPathName' in theprops:
+        scriptcache.compile(stopScript(theprops), (thedeviceid, u'stop'))
+    if u'windowcloseScript' in theprops:
+        scriptcache.compile(closeWindowsScript(theprops), (thedeviceid, u'close'))
+
 ##########
 # Volume device
 ########################
-def getVolumeStatus(thedevice, thevaluesDict):
-    """ Searches for the volume to return states OnOff only
+def _checkMountedVolumes():
+    """ Reads the mounted volumes again only if the mount root changed,
+        and keeps the names of the volumes mounted or unmounted since the previous cycle
+    """
+    indigo.activePlugin._volumesChanged = set()
+
+    if (indigo.activePlugin._volumeWatcher.hasChanged()) or (indigo.activePlugin._mountedVolumes is None):
+        thedevice = accounting.setPlugin()
+        try:
+            _setMountedVolumes(shellscript.run(_mountedVolumesCommand))
+        finally:
+            accounting.restoreDevice(thedevice)
+
+
+def checkMountedVolumesTask():
+    """ Same as _checkMountedVolumes, as an event loop task
+    """
+    indigo.activePlugin._volumesChanged = set()
+
+    if (indigo.activePlugin._volumeWatcher.hasChanged()) or (indigo.activePlugin._mountedVolumes is None):
+        thedevice = accounting.setPlugin()
+        try:
+            pslist = yield shellscript.runTask(_mountedVolumesCommand)
+        finally:
+            accounting.restoreDevice(thedevice)
+        _setMountedVolumes(pslist)
+
+
+def _setMountedVolumes(pslist):
+    """ Keeps the mounted volumes and the ones mounted or unmounted since the previous read
 
         Args:
-            thedevice: current device
+            pslist: output of the mounted volumes command, or None if error
+    """
+    if pslist is None:
+        return
+    themounted = set(pslist.splitlines())
+
+    if indigo.activePlugin._mountedVolumes is None:
+        # first read: all the volumes are to be evaluated
+        indigo.activePlugin._volumesChanged = None
+    else:
+        indigo.activePlugin._volumesChanged = themounted ^ indigo.activePlugin._mountedVolumes
+    indigo.activePlugin._mountedVolumes = themounted
+    core.logger(traceLog = (u'mounted volumes changed: %s', indigo.activePlugin._volumesChanged))
+
+
+def hasVolumeChanged(therecord):
+    """ Test if the volume has been mounted or unmounted since the previous cycle
+
+        Args:
+            therecord: current device record (see registry)
+        Returns:
+            True if the volume mount state may have changed
+    """
+    if indigo.activePlugin._volumesChanged is None:
+        return True
+    return therecord.volumeId in indigo.activePlugin._volumesChanged
+
+
+def _readVolumeSource(thesource):
+    """ Reads one of the volume sources (mounted volumes, diskutil, df) once per cycle
+        and indexes it
+
+        Args:
+            thesource: u'mounted', u'diskutil' or u'df'
+        Returns:
+            the index of the source, or None if error
+    """
+    # the sources are read once even if devices are polled by several threads
+    with indigo.activePlugin._volumeLock:
+        if thesource == u'mounted':
+            # set of the names of the mounted volumes, kept while the mount root is not changed
+            if indigo.activePlugin._mountedVolumes is None:
+                _checkMountedVolumes()
+            return indigo.activePlugin._mountedVolumes
+
+        if thesource in indigo.activePlugin._volumeInventory:
+            return indigo.activePlugin._volumeInventory[thesource]
+
+        thedevice = accounting.setPlugin()
+        try:
+            pslist = shellscript.run(_volumeSourceCommands[thesource])
+        finally:
+            accounting.restoreDevice(thedevice)
+        return _setVolumeSource(thesource, pslist)
+
+
+def readVolumeSourceTask(thesource):
+    """ Same as _readVolumeSource for diskutil or df, as an event loop task
+
+        Returns (see eventloop):
+            the index of the source, or None if error
+    """
+    if thesource in indigo.activePlugin._volumeInventory:
+        raise eventloop.taskReturn(indigo.activePlugin._volumeInventory[thesource])
+
+    thedevice = accounting.setPlugin()
+    try:
+        pslist = yield shellscript.runTask(_volumeSourceCommands[thesource])
+    finally:
+        accounting.restoreDevice(thedevice)
+    raise eventloop.taskReturn(_setVolumeSource(thesource, pslist))
+
+
+def readVolumeSourcesTask(therecords):
+    """ Reads the volume sources the data of a list of volume devices needs, as an event
+        loop task: the diskutil inventory, then df if the free space of a volume cannot
+        be read from its mount point
+
+        Args:
+            therecords: list of the volume device records (see registry)
+        Returns (see eventloop):
+            True if success, False if not
+    """
+    theindex = yield readVolumeSourceTask(u'diskutil')
+    if theindex is None:
+        raise eventloop.taskReturn(False)
+    if any([_needsDf(therecord) for therecord in therecords]):
+        theindex = yield readVolumeSourceTask(u'df')
+    raise eventloop.taskReturn(theindex is not None)
+
+
+def _setVolumeSource(thesource, pslist):
+    """ Indexes the output of a volume source and keeps it for the cycle
+
+        Args:
+            thesource: u'diskutil' or u'df'
+            pslist: output of the source command, or None if error
+        Returns:
+            the index of the source, or None if error
+    """
+    if pslist is None:
+        return None
+
+    if thesource == u'diskutil':
+        # volume name -> (lines, VolumeType, VolumeSize, VolumeDevice)
+        thelines = pslist.splitlines()
+        theindex = {}
+        for theline in thelines:
+            if len(theline)>68:
+                thename = theline[32:57].strip()
+                if (len(thename)>0) and (thename not in theindex):
+                    theindex[thename] = (theline[6:32].strip(), theline[57:67].strip(), theline[68:].strip())
+        theindex = (thelines, theindex)
+    else:
+        # device node -> (Used, Available) in 1024-blocks
+        theindex = {}
+        for theline in pslist.splitlines():
+            thematch = _repVolumeData2.match(theline)
+            if thematch is not None:
+                (thenode, theused, theavailable) = thematch.groups()
+                if thenode.startswith(u'/dev/'):
+                    thenode = thenode[5:]
+                if thenode not in theindex:
+                    theindex[thenode] = (theused, theavailable)
+
+    indigo.activePlugin._volumeInventory[thesource] = theindex
+    return theindex
+
+
+def _findVolume(thevolumename):
+    """ Searches the diskutil inventory for a volume
+
+        Args:
+            thevolumename: name of the volume
+        Returns:
+            (VolumeType, VolumeSize, VolumeDevice) tuple, None if not found
+            or False if error
+    """
+    theinventory = _readVolumeSource(u'diskutil')
+    if theinventory is None:
+        return False
+    (thelines, theindex) = theinventory
+
+    if thevolumename in theindex:
+        return theindex[thevolumename]
+
+    # long names may shift the diskutil columns: search as grep did
+    for theline in thelines:
+        if (u' '+thevolumename+u'  ') in theline:
+            return (theline[6:32].strip(), theline[57:67].strip(), theline[68:].strip())
+    return None
+
+
+def _statVolume(thevolumename):
+    """ Reads the used and available space of a mounted volume with statvfs
+
+        Args:
+            thevolumename: name of the volume
+        Returns:
+            (used bytes, available bytes, used inodes percentage or None) tuple,
+            None if the volume is not mounted or the call failed
+    """
+    # the boot volume entry in /Volumes is a link to /
+    themountpoint = os.path.realpath(u'/Volumes/' + thevolumename)
+    if not os.path.ismount(themountpoint):
+        return None
+    try:
+        thestat = os.statvfs(themountpoint)
+    except OSError:
+        return None
+
+    # same definition as df: used blocks and blocks available to non-root users
+    theused = (thestat.f_blocks - thestat.f_bfree) * thestat.f_frsize
+    theavailable = thestat.f_bavail * thestat.f_frsize
+    if thestat.f_files > 0:
+        thepcinodes = ((thestat.f_files - thestat.f_ffree)*100)/thestat.f_files
+    else:
+        thepcinodes = None
+    return (theused, theavailable, thepcinodes)
+
+
+def getVolumeStatus(therecord, thevaluesDict):
+    """ Searches for the volume in the mounted volumes to return states OnOff only
+
+        Args:
+            therecord: current device record (see registry)
             thevaluesDict: dictionary of the status values so far
         Returns:
             success: True if success, False if not
             thevaluesDict updated with new data if success, equals to the input if not
     """
+    themounted = _readVolumeSource(u'mounted')
+    if themounted is None:
+        return (False,thevaluesDict)
+
     # check if mounted
-    if shellscript.run(u"ls -1 /Volumes | grep %s" % (pipes.quote(u'^'+thedevice.pluginProps[u'VolumeID']+u'$')))>'':
+    if therecord.volumeId in themounted:
         thevaluesDict[u'onOffState']=True
         thevaluesDict[u'VStatus']="on"
     else:
@@ -131,27 +718,55 @@ def getVolumeStatus(thedevice, thevaluesDict):
 
     return (True,thevaluesDict)
 
-def getVolumeData(thedevice, thevaluesDict):
-    """ Searches for the volume using system diskutil and df to return states data
+def getVolumeStatusTask(therecord, thevaluesDict):
+    """ Same as getVolumeStatus, as an event loop task
+
+        Returns (see eventloop):
+            (success, thevaluesDict) tuple
+    """
+    if indigo.activePlugin._mountedVolumes is None:
+        yield checkMountedVolumesTask()
+        if indigo.activePlugin._mountedVolumes is None:
+            raise eventloop.taskReturn((False,thevaluesDict))
+    raise eventloop.taskReturn(getVolumeStatus(therecord, thevaluesDict))
+
+def getVolumeData(therecord, thevaluesDict):
+    """ Searches for the volume in the diskutil inventory and reads its free space to return states data
 
         Args:
-            thedevice: current device
+            therecord: current device record (see registry)
             thevaluesDict: dictionary of the status values so far
         Returns:
             success: True if success, False if not
             thevaluesDict updated with new data if success, equals to the input if not
         """
-    pslist = shellscript.run(u"/usr/sbin/diskutil list | grep %s" % (pipes.quote(u' '+thedevice.pluginProps[u'VolumeID']+u'  ')),[(6,32),(57,67),(68,-1)],[u'VolumeType',u'VolumeSize',u'VolumeDevice'])
+    thevolume = _findVolume(therecord.volumeId)
+    if thevolume is False:
+        return (False,thevaluesDict)
 
-    if pslist[u'VolumeDevice']=='':
+    if (thevolume is None) or (thevolume[2]==u''):
         thevaluesDict[u'onOffState']=False
         thevaluesDict[u'VStatus']=u'off'
     else:
-        thevaluesDict.update(pslist)
-        # find free space
-        pslist = shellscript.run(u"/bin/df | grep '%s'" % (thevaluesDict[u'VolumeDevice']),_repVolumeData2,[u'Used','Available'])
-        if pslist[u'Used'] !=u'':
-            thevaluesDict[u'pcUsed']= (int(pslist[u'Used'])*100)/(int(pslist[u'Used']) + int(pslist[u'Available']))
+        (thevaluesDict[u'VolumeType'], thevaluesDict[u'VolumeSize'], thevaluesDict[u'VolumeDevice']) = thevolume
+        # find free space on the mount point, or in df output if not available
+        thefreespace = _statVolume(therecord.volumeId)
+        if thefreespace is None:
+            thedf = _readVolumeSource(u'df')
+            if thedf is None:
+                return (False,thevaluesDict)
+            if thevaluesDict[u'VolumeDevice'] in thedf:
+                (theused, theavailable) = thedf[thevaluesDict[u'VolumeDevice']]
+                thefreespace = (int(theused)*1024, int(theavailable)*1024, None)
+        if thefreespace is not None:
+            (theused, theavailable, thepcinodes) = thefreespace
+            if (theused + theavailable) > 0:
+                thevaluesDict[u'pcUsed']= (theused*100)/(theused + theavailable)
+            else:
+                thevaluesDict[u'pcUsed']= 0
+            thevaluesDict[u'BytesFree']=theavailable
+            if thepcinodes is not None:
+                thevaluesDict[u'pcInodesUsed']=thepcinodes
             thevaluesDict[u'onOffState']=True
             thevaluesDict[u'VStatus']=u'on'
         else:
@@ -160,23 +775,67 @@ def getVolumeData(thedevice, thevaluesDict):
 
     return (True,thevaluesDict)
 
+def getVolumeDataTask(therecord, thevaluesDict):
+    """ Same as getVolumeData, as an event loop task: the diskutil inventory, and df if
+        the free space cannot be read from the mount point, are read by the loop
+
+        Returns (see eventloop):
+            (success, thevaluesDict) tuple
+    """
+    for thesource in (u'diskutil', u'df'):
+        if (thesource in indigo.activePlugin._volumeInventory) or ((thesource == u'df') and not _needsDf(therecord)):
+            continue
+        theindex = yield readVolumeSourceTask(thesource)
+        if theindex is None:
+            raise eventloop.taskReturn((False,thevaluesDict))
+    raise eventloop.taskReturn(getVolumeData(therecord, thevaluesDict))
 
-def spinVolume(thedevice, thevaluesDict):
+def _needsDf(therecord):
+    # volume mounted, which free space cannot be read from the mount point
+    thevolume = _findVolume(therecord.volumeId)
+    if (thevolume in (False, None)) or (thevolume[2]==u''):
+        return False
+    return _statVolume(therecord.volumeId) is None
+
+
+def spinVolume(therecord, thevaluesDict):
     """ Touch a file to keep the disk awaken
 
         Args:
-            thedevice: current device
+            therecord: current device record (see registry)
             thevaluesDict: dictionary of the status values so far
         Returns:
             success: True if success, False if not
             thevaluesDict updated with new data if success, equals to the input if not
         """
 
-    if (thedevice.states[u'VStatus']==u'on') and (thedevice.pluginProps[u'keepAwaken']):
-        psvalue = shellscript.run(u"touch %s" % (pipes.quote(u'/Volumes/'+thedevice.pluginProps[u'VolumeID']+u'/.spinner')))
-        if psvalue is None:
-            return (False, thevaluesDict)
-        else:
-            thevaluesDict[u'LastPing']=time.strftime('%c',time.localtime())
+    thecommand = _spinCommand(therecord, thevaluesDict)
+    if thecommand is None:
+        return (True, thevaluesDict)
+    return _setSpun(shellscript.run(thecommand), thevaluesDict)
+
+def spinVolumeTask(therecord, thevaluesDict):
+    """ Same as spinVolume, as an event loop task
+
+        Returns (see eventloop):
+            (success, thevaluesDict) tuple
+    """
+    thecommand = _spinCommand(therecord, thevaluesDict)
+    if thecommand is None:
+        raise eventloop.taskReturn((True, thevaluesDict))
+    psvalue = yield shellscript.runTask(thecommand)
+    raise eventloop.taskReturn(_setSpun(psvalue, thevaluesDict))
+
+def _spinCommand(therecord, thevaluesDict):
+    # the status just read, or the last pushed one
+    thestatus = thevaluesDict[u'VStatus'] if u'VStatus' in thevaluesDict else core.shadowstate(therecord.device, u'VStatus')
+    if (thestatus==u'on') and therecord.keepAwaken:
+        return u"touch %s" % (pipes.quote(u'/Volumes/'+therecord.volumeId+u'/.spinner'))
+    return None
+
+def _setSpun(psvalue, thevaluesDict):
+    if psvalue is None:
+        return (False, thevaluesDict)
+    thevaluesDict[u'LastPing']=time.strftime('%c',time.localtime())
     return (True, thevaluesDict)
 
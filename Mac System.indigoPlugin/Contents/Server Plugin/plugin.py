@@ -82,10 +82,49 @@ from bipIndigoFramework import core
 from bipIndigoFramework import corethread
 from bipIndigoFramework import shellscript
 from bipIndigoFramework import osascript
+from bipIndigoFramework import scriptcache
 from bipIndigoFramework import relaydimmer
+from bipIndigoFramework import processwatch
+from bipIndigoFramework import eventloop
+from bipIndigoFramework import perfstats
+from bipIndigoFramework import accounting
 import interface
+import registry
 import re
+import os
 import pipes
+import threading
+
+_diskSleepCommand = u"pmset -g | grep disksleep | sed -e s/[a-z]//g | sed -e 's/ //g'"
+# samples of the usage statistics kept per process, at most
+_maxUsageSamples = 720
+# noisy numeric states -> default deadband (see core.setdeadbands)
+_deadbandDefaults = ((u'PCpu',u'2'), (u'PMem',u'1'), (u'ETime',u'10%'), (u'pcUsed',u'1'))
+
+
+def _deadband(thetext):
+    """ Reads a deadband preference: a number for an absolute change, or a percentage
+        of the last pushed value
+
+        Args:
+            thetext: preference text, empty or 0 for no deadband
+        Returns:
+            (absolute, relative) tuple, or None for no deadband
+        Raises:
+            ValueError if not a positive number
+    """
+    thetext = thetext.strip()
+    if len(thetext) == 0:
+        return None
+    if thetext.endswith(u'%'):
+        theband = (0.0, float(thetext[:-1]) / 100.0)
+    else:
+        theband = (float(thetext), 0.0)
+    if min(theband) < 0:
+        raise ValueError
+    if max(theband) == 0:
+        return None
+    return theband
 
 
 # Note the "indigo" module is automatically imported and made available inside
@@ -112,8 +151,16 @@ class Plugin(indigo.PluginBase):
         core.debugFlags(self.pluginPrefs)
         # startup call
         core.logger(traceLog = u'startup called')
-        interface.init()
+        interface.init(self.pluginPrefs.get(u'processSource',u'auto'), self.pluginPrefs.get(u'useScriptHost',False), self.pluginPrefs.get(u'scriptHostPython',u'').strip())
         corethread.init()
+        registry.init()
+        processwatch.init()
+        eventloop.init()
+        perfstats.init(self.pluginPrefs.get(u'perfStats',False))
+        accounting.setExport(self.pluginPrefs.get(u'accountingFile',u''), self.pluginPrefs.get(u'accountingFormat',u'json'))
+        self.devicePace(self.pluginPrefs)
+        self.deadbands(self.pluginPrefs)
+        self.usageWindows(self.pluginPrefs)
         core.dumppluginproperties()
 
         core.logger(traceLog = u'end of startup')
@@ -122,6 +169,9 @@ class Plugin(indigo.PluginBase):
         core.logger(traceLog = u'shutdown called')
         core.dumppluginproperties()
         # do some cleanup here
+        osascript.setScriptHost(False)
+        corethread.setDevicePool(1)
+        accounting.export()
         core.logger(traceLog = u'end of shutdown')
 
 
@@ -142,6 +192,20 @@ class Plugin(indigo.PluginBase):
                         u'windowcloseScript':u'Tell application "' + dev.pluginProps[u'ApplicationID'] + u'" to close every window',
                         u'ApplicationStopPathName':u'tell application "'+ dev.pluginProps[u'ApplicationID'] + u'" to quit',
                         u'ApplicationStartPathName':u'open ' + pipes.quote(dev.pluginProps[u'ApplicationPathName'])})
+            interface.compileApplicationScripts(dev.id, dev.pluginProps)
+
+        if dev.deviceTypeId == u'bip.ms.volume':
+            core.upgradeDeviceStates(dev, [u'BytesFree', u'pcInodesUsed'])
+        elif dev.deviceTypeId == u'bip.ms.application':
+            core.upgradeDeviceStates(dev, interface.usageStates)
+        elif dev.deviceTypeId in (u'bip.ms.helper',u'bip.ms.daemon'):
+            core.upgradeDeviceStates(dev, interface.usageStates + [u'Instances'])
+
+        # polling data of the device
+        therecord = registry.add(dev)
+        if therecord.kind == u'process':
+            interface.addProcessDevice(therecord)
+        core.shadowstates(dev)
 
         core.logger(traceLog = (u'end of "%s" deviceStartComm'  % (dev.name)))
 
@@ -149,8 +213,25 @@ class Plugin(indigo.PluginBase):
         core.logger(traceLog = u'deviceStopComm called: %s (%d - %s)' % (dev.name, dev.id, dev.deviceTypeId))
         core.dumpdeviceproperties(dev)
         core.dumpdevicestates(dev)
+        corethread.removeDevicePace(dev)
+        processwatch.unwatch(dev)
+        registry.remove(dev)
+        core.dropshadowstates(dev)
+        if dev.deviceTypeId in (u'bip.ms.application',u'bip.ms.helper',u'bip.ms.daemon'):
+            interface.removeProcessDevice(dev)
+        scriptcache.release(dev.id)
         core.logger(traceLog = u'end of "%s" deviceStopComm'  % (dev.name))
 
+    def deviceDeleted(self, dev):
+        indigo.PluginBase.deviceDeleted(self, dev)
+        # the compiled scripts of the device are not needed anymore
+        scriptcache.release(dev.id, True)
+
+    def deviceUpdated(self, origDev, newDev):
+        indigo.PluginBase.deviceUpdated(self, origDev, newDev)
+        # keep the polling data of the device up to date
+        registry.refresh(origDev, newDev)
+
 
     ########################################
     # Update thread
@@ -176,86 +257,367 @@ class Plugin(indigo.PluginBase):
         # init full data read timer for applications
         readApplicationData = corethread.dialogTimer(u'Read application data',60,30)
 
+        thetimers = (nextDiskSpin, readVolumeData, readApplicationData)
+
+        # the devices are started: the compiled scripts of the previous runs can go
+        scriptcache.prune()
+
         # loop
         try:
+            if self.pluginPrefs.get(u'pollEngine',u'thread') == u'event':
+                self.runEventEngine(thetimers)
+
             while True:
                 corethread.sleepWake()
+                perfstats.startCycle()
+                interface.newCycle()
 
                 # Test if time to spin
                 timeToSpin = nextDiskSpin.isTime()
                 if timeToSpin:
                     # get disk sleep value
-                    psvalue = shellscript.run(u"pmset -g | grep disksleep | sed -e s/[a-z]//g | sed -e 's/ //g'")
-                    try:
-                        psvalue = int(psvalue)
-                    except:
-                        psvalue=0
-                    # set property and timer if needed
-                    theupdatesDict = core.updatepluginprops({u'disksleepTime':psvalue})
-                    if (len(theupdatesDict)>0):
-                        if psvalue>0:
-                            nextDiskSpin.changeInterval((psvalue-1)*60)
-                        else:
-                            nextDiskSpin.changeInterval(600)
+                    thestart = perfstats.start()
+                    self.diskSleepTime(nextDiskSpin, shellscript.run(_diskSleepCommand))
+                    perfstats.phase(u'diskSleep', thestart)
 
                 # test if time to read full data
-                timeToReadVolumeData = readVolumeData.isTime()
-                timeToReadApplicationData = readApplicationData.isTime()
-
-                for thedevice in indigo.devices.iter(u'self'):
-                    thevaluesDict = {}
-
-                    ##########
-                    # Application device
-                    ########################
-                    if (thedevice.deviceTypeId in (u'bip.ms.application',u'bip.ms.helper',u'bip.ms.daemon')) and thedevice.configured and thedevice.enabled:
-                        # states
-                        (success,thevaluesDict) = interface.getProcessStatus(thedevice, thevaluesDict)
-                        # update
-                        theupdatesDict = core.updatestates(thedevice, thevaluesDict)
-                        # special images
-                        core.specialimage(thedevice, u'PStatus', theupdatesDict, {u'idle':indigo.kStateImageSel.AvPaused,u'waiting':indigo.kStateImageSel.AvPaused,u'stopped':indigo.kStateImageSel.AvStopped,u'zombie':indigo.kStateImageSel.SensorTripped})
-
-                        # do we need to read full data ?
-                        if (u'onOffState' in theupdatesDict):
-                            # update to get more correct data
-                            corethread.setUpdateRequest(thedevice)
-                            # close windows if required
-                            if (thedevice.pluginProps[u'closeWindows']==True) and (theupdatesDict[u'onOffState']==True):
-                                self.closeWindowAction(thedevice)
-
-                        if timeToReadApplicationData or corethread.isUpdateRequested(thedevice):
-                            (success,thevaluesDict) = interface.getProcessData(thedevice, thevaluesDict)
-                            core.updatestates(thedevice, thevaluesDict)
-
-                    ##########
-                    # Volume device
-                    ########################
-                    elif (thedevice.deviceTypeId ==u'bip.ms.volume') and thedevice.configured and thedevice.enabled:
-                         # states
-                        (success,thevaluesDict) = interface.getVolumeStatus(thedevice, thevaluesDict)
-                        # spin if needed
-                        if timeToSpin:
-                            (success,thevaluesDict) = interface.spinVolume(thedevice, thevaluesDict)
-                        # update
-                        theupdatesDict = core.updatestates(thedevice, thevaluesDict)
-                        # special images
-                        core.specialimage(thedevice, u'VStatus', theupdatesDict, {u'notmounted':indigo.kStateImageSel.AvStopped})
-
-                        # do we need to read full data ?
-                        if (u'onOffState' in theupdatesDict):
-                            corethread.setUpdateRequest(thedevice,3)
-
-                        if timeToReadVolumeData or corethread.isUpdateRequested(thedevice):
-                            (success,thevaluesDict) = interface.getVolumeData(thedevice, thevaluesDict)
-                            core.updatestates(thedevice, thevaluesDict)
-
-                # wait
-                corethread.sleepNext(10) # in seconds
+                thecycle = self.newPollCycle(thetimers, timeToSpin)
+
+                thestart = perfstats.start()
+                for therecord in registry.records():
+                    if (therecord.kind == u'process') and therecord.active:
+                        corethread.pollDevice(therecord, self.pollApplication, thecycle)
+                    elif (therecord.kind == u'volume') and therecord.active:
+                        corethread.pollDevice(therecord, self.pollVolume, thecycle)
+
+                # wait for the devices polled by worker threads
+                thelatedevices = corethread.waitDevicePolls()
+                if len(thelatedevices)>0:
+                    core.logger(traceLog = (u'cycle deadline passed while polling %s', u', '.join(thelatedevices)))
+                perfstats.phase(u'status', thestart)
+
+                ##########
+                # Application full data
+                ########################
+                processDataList = self.takeProcessData(thecycle)
+                if len(processDataList)>0:
+                    thestart = perfstats.start()
+                    interface.readProcessData(interface.processDataPids(processDataList))
+                    self.pollApplicationData(processDataList)
+                    perfstats.phase(u'details', thestart)
+
+                perfstats.endCycle()
+                self.pollHealth(thecycle)
+                accounting.exportIfDue()
+
+                # wait until the next timer is due
+                corethread.sleepNext()
         except self.StopThread:
             # do any cleanup here
+            # the devices stopped with the plugin keep their compiled scripts for the next start
+            scriptcache.keep()
             core.logger(traceLog = u'end of runConcurrentThread')
 
+    def runEventEngine(self, thetimers):
+        """ Runs the polling cycles as tasks of an event loop, so that the external commands
+            of a cycle and of the actions run at once - never returns
+
+            Args:
+                thetimers: (disk spin, volume data, application data) dialog timers
+        """
+        theloop = indigo.activePlugin._eventLoop
+        thenext = [None]
+
+        def _cycleDone(thevalue):
+            thenext[0] = theloop.callLater(corethread.nextDelay(), _cycle)
+
+        def _cycle():
+            thenext[0] = None
+            theloop.spawn(self.pollCycleTask(thetimers), _cycleDone)
+
+        def _check():
+            # lets the host stop the thread, without delaying the loop
+            self.sleep(0)
+            # a watched process exited: do not wait for the next cycle
+            if (thenext[0] is not None) and (indigo.activePlugin._sleepWaiter is not None) and indigo.activePlugin._sleepWaiter(0):
+                core.logger(traceLog = u'sleep interrupted by an event')
+                thenext[0].cancel()
+                _cycle()
+
+        core.logger(traceLog = u'polling by the event loop')
+        _cycle()
+        theloop.runForever(_check)
+
+    def pollCycleTask(self, thetimers):
+        """ One polling cycle as an event loop task: the shared snapshots are read at once,
+            then the devices are evaluated
+
+            Args:
+                thetimers: (disk spin, volume data, application data) dialog timers
+        """
+        (nextDiskSpin, readVolumeData, readApplicationData) = thetimers
+        corethread.sleepWake()
+        perfstats.startCycle()
+        interface.newCycle(False)
+        yield interface.checkMountedVolumesTask()
+
+        # Test if time to spin
+        timeToSpin = nextDiskSpin.isTime()
+        if timeToSpin:
+            # get disk sleep value
+            thestart = perfstats.start()
+            psvalue = yield shellscript.runTask(_diskSleepCommand)
+            self.diskSleepTime(nextDiskSpin, psvalue)
+            perfstats.phase(u'diskSleep', thestart)
+
+        # test if time to read full data
+        thecycle = self.newPollCycle(thetimers, timeToSpin)
+
+        thestart = perfstats.start()
+        therecords = [therecord for therecord in registry.records() if therecord.active]
+
+        # read the snapshots the devices may need at once, classifying the processes
+        # with the process names changed since the previous cycle
+        thesnapshots = []
+        theprocesses = [therecord for therecord in therecords if (therecord.kind == u'process') and corethread.isDeviceDue(therecord)]
+        for therecord in theprocesses:
+            interface.updateProcessDevice(therecord)
+        if len(theprocesses) > 0:
+            thesnapshots.append(interface.readProcessTableTask())
+        thevolumes = [therecord for therecord in therecords if (therecord.kind == u'volume') and (thecycle[u'readVolumeData'] or corethread.hasUpdateRequest(therecord) or interface.hasVolumeChanged(therecord))]
+        if len(thevolumes) > 0:
+            thesnapshots.append(interface.readVolumeSourcesTask(thevolumes))
+        yield thesnapshots
+
+        # the volumes commands (spin, df) are run at once
+        thevolumetasks = []
+        for therecord in therecords:
+            accounting.setDevice(therecord)
+            if therecord.kind == u'process':
+                self.pollApplication(therecord, thecycle)
+            elif therecord.kind == u'volume':
+                thevolumetasks.append(self.pollVolumeTask(therecord, thecycle))
+        accounting.setDevice(None)
+        yield thevolumetasks
+        perfstats.phase(u'status', thestart)
+
+        ##########
+        # Application full data
+        ########################
+        processDataList = self.takeProcessData(thecycle)
+        if len(processDataList)>0:
+            thestart = perfstats.start()
+            yield interface.readProcessDataTask(interface.processDataPids(processDataList))
+            self.pollApplicationData(processDataList)
+            perfstats.phase(u'details', thestart)
+
+        perfstats.endCycle()
+        self.pollHealth(thecycle)
+        accounting.exportIfDue()
+
+    def newPollCycle(self, thetimers, timeToSpin):
+        """ Tests the full data timers for a new polling cycle
+
+            Args:
+                thetimers: (disk spin, volume data, application data) dialog timers
+                timeToSpin: True if the volumes are to be spinned
+            Returns:
+                dictionary of the timers due in the cycle, and of the list of devices
+                which process data is to be read
+        """
+        (nextDiskSpin, readVolumeData, readApplicationData) = thetimers
+        return {u'readVolumeData':readVolumeData.isTime(),
+                u'readApplicationData':readApplicationData.isTime(),
+                u'spin':timeToSpin,
+                u'processDataList':[],
+                u'processDataLock':threading.Lock(),
+                u'processDataClosed':False}
+
+    def addProcessData(self, thecycle, therecord, thevaluesDict):
+        """ Adds a device to the devices which process data is read after the polls of
+            the cycle - a device polled past the cycle deadline gets it at its next poll
+
+            Args:
+                thecycle: dictionary of the timers due in the current cycle
+                therecord: current device record (see registry)
+                thevaluesDict: states values of the device so far
+        """
+        with thecycle[u'processDataLock']:
+            if thecycle[u'processDataClosed']:
+                therecord.dataDue = True
+                core.logger(traceLog = (u'"%s" process data left for its next poll', therecord.name))
+                return
+            therecord.dataDue = False
+            thecycle[u'processDataList'].append((therecord, thevaluesDict))
+
+    def takeProcessData(self, thecycle):
+        """ Closes the list of the devices which process data is read in the cycle
+
+            Args:
+                thecycle: dictionary of the timers due in the current cycle
+            Returns:
+                list of (device record, states values) of the cycle
+        """
+        with thecycle[u'processDataLock']:
+            thecycle[u'processDataClosed'] = True
+            return thecycle[u'processDataList']
+
+    def diskSleepTime(self, nextDiskSpin, psvalue):
+        """ Sets the disk sleep time property and the spin timer
+
+            Args:
+                nextDiskSpin: disk spin dialog timer
+                psvalue: output of the disk sleep command
+        """
+        try:
+            psvalue = int(psvalue)
+        except:
+            psvalue=0
+        # set property and timer if needed
+        theupdatesDict = core.updatepluginprops({u'disksleepTime':psvalue})
+        if (len(theupdatesDict)>0):
+            if psvalue>0:
+                nextDiskSpin.changeInterval((psvalue-1)*60)
+            else:
+                nextDiskSpin.changeInterval(600)
+
+    def pollApplicationData(self, processDataList):
+        """ Updates the process data of applications once read for the cycle
+
+            Args:
+                processDataList: list of (device record, states values) of the cycle
+        """
+        for (therecord, thevaluesDict) in processDataList:
+            (success,thevaluesDict) = interface.getProcessData(therecord, thevaluesDict)
+            (success,thevaluesDict) = interface.getProcessUsage(therecord, thevaluesDict)
+            core.updatestates(therecord.device, thevaluesDict)
+
+    def pollApplication(self, therecord, thecycle):
+        """ Poll an application, helper or daemon device
+
+            Args:
+                therecord: current device record (see registry)
+                thecycle: dictionary of the timers due in the current cycle,
+                          and of the list of devices which process data is to be read
+        """
+        thevaluesDict = {}
+        # the details are read at the next poll of the device
+        if thecycle[u'readApplicationData']:
+            therecord.dataDue = True
+        # according the device pace
+        if not corethread.isDeviceTime(therecord):
+            return
+        # states
+        (success,thevaluesDict) = interface.getProcessStatus(therecord, thevaluesDict)
+        # update
+        theupdatesDict = core.updatestates(therecord.device, thevaluesDict)
+        corethread.devicePolled(therecord, len(theupdatesDict)>0)
+        # be woken up as soon as the process exits
+        if success:
+            therecord.pid = thevaluesDict[u'ProcessID']
+            processwatch.watch(therecord, therecord.pid)
+        # special images
+        core.specialimage(therecord.device, u'PStatus', theupdatesDict, {u'idle':indigo.kStateImageSel.AvPaused,u'waiting':indigo.kStateImageSel.AvPaused,u'stopped':indigo.kStateImageSel.AvStopped,u'zombie':indigo.kStateImageSel.SensorTripped})
+
+        # do we need to read full data ?
+        if (u'onOffState' in theupdatesDict):
+            # update to get more correct data
+            corethread.setUpdateRequest(therecord)
+            # close windows if required
+            if (therecord.closeWindows==True) and (theupdatesDict[u'onOffState']==True):
+                self.closeWindowAction(therecord.device)
+
+        # full data is read for all the devices at once after the loop
+        if therecord.dataDue or corethread.isUpdateRequested(therecord):
+            self.addProcessData(thecycle, therecord, thevaluesDict)
+
+    def pollVolume(self, therecord, thecycle):
+        """ Poll a volume device
+
+            Args:
+                therecord: current device record (see registry)
+                thecycle: dictionary of the timers due in the current cycle
+        """
+        thevaluesDict = {}
+        # mounted or unmounted: read full data for the next cycles
+        if interface.hasVolumeChanged(therecord):
+            corethread.setUpdateRequest(therecord,3)
+        timeToReadData = thecycle[u'readVolumeData'] or corethread.isUpdateRequested(therecord)
+        # status is only evaluated if the mounted volumes changed
+        if not (timeToReadData or thecycle[u'spin']):
+            return
+         # states
+        (success,thevaluesDict) = interface.getVolumeStatus(therecord, thevaluesDict)
+        # spin if needed
+        if thecycle[u'spin']:
+            (success,thevaluesDict) = interface.spinVolume(therecord, thevaluesDict)
+        # update
+        theupdatesDict = core.updatestates(therecord.device, thevaluesDict)
+        # special images
+        core.specialimage(therecord.device, u'VStatus', theupdatesDict, {u'notmounted':indigo.kStateImageSel.AvStopped})
+
+        # do we need to read full data ?
+        if (u'onOffState' in theupdatesDict):
+            corethread.setUpdateRequest(therecord,3)
+            timeToReadData = True
+
+        if timeToReadData:
+            (success,thevaluesDict) = interface.getVolumeData(therecord, thevaluesDict)
+            core.updatestates(therecord.device, thevaluesDict)
+
+    def pollVolumeTask(self, therecord, thecycle):
+        """ Same as pollVolume, as an event loop task: the commands are run by the loop
+
+            Args:
+                therecord: current device record (see registry)
+                thecycle: dictionary of the timers due in the current cycle
+        """
+        thevaluesDict = {}
+        # mounted or unmounted: read full data for the next cycles
+        if interface.hasVolumeChanged(therecord):
+            corethread.setUpdateRequest(therecord,3)
+        timeToReadData = thecycle[u'readVolumeData'] or corethread.isUpdateRequested(therecord)
+        # status is only evaluated if the mounted volumes changed
+        if not (timeToReadData or thecycle[u'spin']):
+            return
+        # states - the commands started are accounted for the device
+        accounting.setDevice(therecord)
+        (success,thevaluesDict) = yield interface.getVolumeStatusTask(therecord, thevaluesDict)
+        # spin if needed
+        if thecycle[u'spin']:
+            accounting.setDevice(therecord)
+            (success,thevaluesDict) = yield interface.spinVolumeTask(therecord, thevaluesDict)
+        accounting.setDevice(None)
+        # update
+        theupdatesDict = core.updatestates(therecord.device, thevaluesDict)
+        # special images
+        core.specialimage(therecord.device, u'VStatus', theupdatesDict, {u'notmounted':indigo.kStateImageSel.AvStopped})
+
+        # do we need to read full data ?
+        if (u'onOffState' in theupdatesDict):
+            corethread.setUpdateRequest(therecord,3)
+            timeToReadData = True
+
+        if timeToReadData:
+            accounting.setDevice(therecord)
+            (success,thevaluesDict) = yield interface.getVolumeDataTask(therecord, thevaluesDict)
+            accounting.setDevice(None)
+            core.updatestates(therecord.device, thevaluesDict)
+
+    def pollHealth(self, thecycle):
+        """ Updates the plugin health devices with the performance statistics,
+            at the volume data pace
+
+            Args:
+                thecycle: dictionary of the timers due in the current cycle
+        """
+        if not (perfstats.isEnabled() and thecycle[u'readVolumeData']):
+            return
+        thevaluesDict = perfstats.healthStates()
+        for therecord in registry.records(u'health'):
+            if therecord.active:
+                core.updatestates(therecord.device, thevaluesDict)
+
     ########################################
     # Relay / Dimmer Action callback
     ######################
@@ -271,21 +633,23 @@ class Plugin(indigo.PluginBase):
             corethread.setUpdateRequest(dev)
             return
 
+        # the device is going to change: back to the fast polling pace
+        corethread.resetDevicePace(dev)
+
         ##########
         # Application device
         ########################
         if (dev.deviceTypeId in (u'bip.ms.application',u'bip.ms.helper',u'bip.ms.daemon')):
             if (theactionid == indigo.kDimmerRelayAction.TurnOn):
-                shellscript.run(dev.pluginProps[u'ApplicationStartPathName'])
+                self.startAction(dev.pluginProps[u'ApplicationStartPathName'], dev)
                 # status update will be done by runConcurrentThread
 
             elif (theactionid == indigo.kDimmerRelayAction.TurnOff):
                 if dev.pluginProps[u'forceQuit']:
-                    shellscript.run(u"kill %s" % (dev.states[u'ProcessID']))
+                    self.shellAction(u"kill %s" % (dev.states[u'ProcessID']), dev)
                     # status update will be done by runConcurrentThread
                 else:
-                    osascript.run(u'''(* Tell to quit *)
-                        %s''' % (dev.pluginProps[u'ApplicationStopPathName']))
+                    self.scriptAction(interface.stopScript(dev.pluginProps), dev)
                     # status update will be done by runConcurrentThread
 
         ##########
@@ -293,15 +657,15 @@ class Plugin(indigo.PluginBase):
         ########################
         elif (dev.deviceTypeId ==u'bip.ms.volume'):
             if (theactionid == indigo.kDimmerRelayAction.TurnOn) and (dev.states[u'VStatus']==u'notmounted'):
-                shellscript.run(u"/usr/sbin/diskutil mount %s" % (dev.states[u'VolumeDevice']))
+                self.shellAction(u"/usr/sbin/diskutil mount %s" % (dev.states[u'VolumeDevice']), dev)
             # status update will be done by runConcurrentThread
 
             elif (theactionid == indigo.kDimmerRelayAction.TurnOff):
                 if dev.pluginProps[u'forceQuit']:
-                    shellscript.run(u"/usr/sbin/diskutil umount force %s" % (dev.states[u'VolumeDevice']))
+                    self.shellAction(u"/usr/sbin/diskutil umount force %s" % (dev.states[u'VolumeDevice']), dev)
                     # status update will be done by runConcurrentThread
                 else:
-                    shellscript.run(u"/usr/sbin/diskutil umount %s" % (dev.states[u'VolumeDevice']))
+                    self.shellAction(u"/usr/sbin/diskutil umount %s" % (dev.states[u'VolumeDevice']), dev)
                     # status update will be done by runConcurrentThread
 
 
@@ -312,10 +676,65 @@ class Plugin(indigo.PluginBase):
         self.closeWindowAction(indigo.devices[theaction.deviceId])
 
 
+    def perfSummaryCBM(self):
+        thelines = perfstats.summary()
+        if len(thelines) == 0:
+            indigo.server.log(u'performance statistics are not collected: check "Collect performance statistics" in the plugin configuration')
+        for theline in thelines:
+            indigo.server.log(theline)
+
+
     def closeWindowAction(self, thedevice):
         core.logger(traceLog = u'requesting device "%s" action %s' % (thedevice.name,u'closewindows'))
-        osascript.run(u'''(* Tell to close window *)
-            %s''' % (thedevice.pluginProps[u'windowcloseScript']))
+        self.scriptAction(interface.closeWindowsScript(thedevice.pluginProps), thedevice)
+
+    def shellAction(self, thescript, thedevice=None):
+        """ Runs an action shell script - by the event loop if it is running, so that
+            the callback returns at once
+
+            Args:
+                thescript: shell script as text
+                thedevice: device actioned, the script is accounted for
+        """
+        if eventloop.isRunning():
+            eventloop.spawn(shellscript.runTask(thescript))
+        else:
+            accounting.setDevice(thedevice)
+            try:
+                shellscript.run(thescript)
+            finally:
+                accounting.setDevice(None)
+
+    def startAction(self, thescript, thedevice=None):
+        """ Launches the start shell script of a process device, detached: the program
+            started may keep running in the foreground and is never killed
+
+            Args:
+                thescript: shell script as text
+                thedevice: device actioned, the script is accounted for
+        """
+        accounting.setDevice(thedevice)
+        try:
+            shellscript.launch(thescript)
+        finally:
+            accounting.setDevice(None)
+
+    def scriptAction(self, thescript, thedevice=None):
+        """ Runs an action applescript - by the event loop if it is running, so that
+            the callback returns at once
+
+            Args:
+                thescript: applescript as text
+                thedevice: device actioned, the script is accounted for
+        """
+        if eventloop.isRunning():
+            eventloop.spawn(osascript.runTask(thescript))
+        else:
+            accounting.setDevice(thedevice)
+            try:
+                osascript.run(thescript)
+            finally:
+                accounting.setDevice(None)
 
     ########################################
     # Prefs UI methods (works with PluginConfig.xml):
@@ -333,9 +752,138 @@ class Plugin(indigo.PluginBase):
         # manage debug flag
         valuesDict = core.debugFlags(valuesDict)
 
+        # manage polling pace
+        for thekey in (u'pollMinInterval',u'pollMaxInterval',u'pollGrowthFactor'):
+            try:
+                if float(valuesDict[thekey]) < 1:
+                    raise ValueError
+            except:
+                errorMsgDict[thekey] = u'A number greater or equal to 1 is required'
+                err = True
+        try:
+            if not (1 <= int(valuesDict[u'pollThreads']) <= 16):
+                raise ValueError
+        except:
+            errorMsgDict[u'pollThreads'] = u'A whole number from 1 to 16 is required'
+            err = True
+        for (thestate, thedefault) in _deadbandDefaults:
+            try:
+                _deadband(valuesDict.get(u'deadband' + thestate, thedefault))
+            except ValueError:
+                errorMsgDict[u'deadband' + thestate] = u'A positive number or percentage is required, or empty'
+                err = True
+        try:
+            if float(valuesDict.get(u'deadbandStaleness', u'15')) < 0:
+                raise ValueError
+        except ValueError:
+            errorMsgDict[u'deadbandStaleness'] = u'A positive number is required'
+            err = True
+        for (thekey, thedefault) in ((u'usageShortWindow',u'5'), (u'usageLongWindow',u'60')):
+            try:
+                if float(valuesDict.get(thekey, thedefault)) < 1:
+                    raise ValueError
+            except ValueError:
+                errorMsgDict[thekey] = u'A number greater or equal to 1 is required'
+                err = True
+        theexportfile = os.path.expanduser(valuesDict.get(u'accountingFile',u'').strip())
+        if (len(theexportfile)>0) and not (os.path.isabs(theexportfile) and os.path.isdir(os.path.dirname(theexportfile))):
+            errorMsgDict[u'accountingFile'] = u'A full path in an existing folder is required'
+            err = True
+        if err:
+            return (False, valuesDict, errorMsgDict)
+        self.devicePace(valuesDict)
+        self.deadbands(valuesDict)
+        self.usageWindows(valuesDict)
+
+        # manage process list source
+        if valuesDict.get(u'processSource',u'auto') != self.pluginPrefs.get(u'processSource',u'auto'):
+            interface.setProcessSource(valuesDict.get(u'processSource',u'auto'))
+
+        # manage applescript host
+        if (valuesDict.get(u'useScriptHost',False) != self.pluginPrefs.get(u'useScriptHost',False)) or (valuesDict.get(u'scriptHostPython',u'') != self.pluginPrefs.get(u'scriptHostPython',u'')):
+            osascript.setScriptHost(valuesDict.get(u'useScriptHost',False), python=valuesDict.get(u'scriptHostPython',u'').strip())
+
+        # manage performance statistics
+        perfstats.init(valuesDict.get(u'perfStats',False))
+
+        # manage subprocesses accounting export
+        theexportfile = valuesDict.get(u'accountingFile',u'').strip()
+        if (theexportfile, valuesDict.get(u'accountingFormat',u'json')) != (self.pluginPrefs.get(u'accountingFile',u'').strip(), self.pluginPrefs.get(u'accountingFormat',u'json')):
+            accounting.setExport(theexportfile, valuesDict.get(u'accountingFormat',u'json'))
+
         core.logger(traceLog = u'end of validating Prefs')
         return (True, valuesDict)
 
+    def devicePace(self, valuesDict):
+        """ Set the adaptive polling pace and the polling threads of the devices from the plugin preferences
+
+            Args:
+                valuesDict: plugin preferences
+        """
+        thepace = []
+        for (thekey, thedefault) in ((u'pollMinInterval',10), (u'pollMaxInterval',120), (u'pollGrowthFactor',1.5)):
+            try:
+                thevalue = float(valuesDict[thekey])
+            except:
+                thevalue = thedefault
+            if thevalue < 1:
+                thevalue = thedefault
+            thepace.append(thevalue)
+        corethread.setDevicePace(*thepace)
+
+        try:
+            thethreads = int(valuesDict[u'pollThreads'])
+        except:
+            thethreads = 1
+        corethread.setDevicePool(min(max(thethreads, 1), 16))
+
+    def usageWindows(self, valuesDict):
+        """ Set the windows of the process usage statistics from the plugin preferences
+
+            Args:
+                valuesDict: plugin preferences
+        """
+        thewindows = []
+        for (thekey, thedefault) in ((u'usageShortWindow',5), (u'usageLongWindow',60)):
+            try:
+                thevalue = float(valuesDict.get(thekey, thedefault))
+            except ValueError:
+                thevalue = thedefault
+            thewindows.append(max(thevalue, 1) * 60)
+        # a sample per cycle: enough samples for the long window at the fast polling pace
+        try:
+            theinterval = max(float(valuesDict[u'pollMinInterval']), 1)
+        except:
+            theinterval = 10
+        thesize = min(int(max(thewindows) / theinterval) + 1, _maxUsageSamples)
+        registry.setUsageWindows(tuple(thewindows), thesize)
+        core.logger(traceLog = (u'usage statistics over %s seconds, %s samples kept per process', thewindows, thesize))
+
+    def deadbands(self, valuesDict):
+        """ Set the changes of the noisy numeric states that are not pushed from the plugin preferences
+
+            Args:
+                valuesDict: plugin preferences
+        """
+        thedeadbands = {}
+        for (thestate, thedefault) in _deadbandDefaults:
+            try:
+                theband = _deadband(valuesDict.get(u'deadband' + thestate, thedefault))
+            except ValueError:
+                theband = _deadband(thedefault)
+            if theband is not None:
+                thedeadbands[thestate] = theband
+        # the usage statistics have the band of their state
+        for thestate in interface.usageStates:
+            if thestate[:4] in thedeadbands:
+                thedeadbands[thestate] = thedeadbands[thestate[:4]]
+        try:
+            thestaleness = float(valuesDict.get(u'deadbandStaleness', u'15')) * 60
+        except ValueError:
+            thestaleness = 15 * 60
+        core.setdeadbands(thedeadbands, max(thestaleness, 0))
+        core.logger(traceLog = (u'deadbands %s, pushed anyway after %s seconds', thedeadbands, thestaleness))
+
 
     def validateDeviceConfigUi(self, valuesDict, typeId, devId):
         core.logger(traceLog = (u'validating Device Config called for: (%d - %s)') % (devId, typeId))
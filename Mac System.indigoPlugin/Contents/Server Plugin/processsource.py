@@ -0,0 +1,541 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################################################################################
+"""
+    Mac OS System plug-in process sources module
+    By Bernard Philippe (bip.philippe) (C) 2015
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.#
+
+    A process source enumerates the system tasklist for the interface module:
+    - readTable() returns a list of (pid, state, command) rows, or None if error
+    - readData(pidlist) returns a dictionary pid -> {LStart, PCpu, PMem, ETime}
+      for the processes found, or None if error
+    - readUsage(pidlist) returns a dictionary pid -> (cpu percentage, memory percentage)
+      for the processes found, as of the last readTable - without reading again for ps
+    pids are unicode texts, state is the ps state text (first letter is used),
+    command is the executable name followed by the arguments, as ps -c -o args reports it,
+    so that the patterns of the daemons can match on the arguments.
+"""
+####################################################################################
+
+import os
+import sys
+import time
+import re
+import ctypes
+import ctypes.util
+import threading
+from bipIndigoFramework import core
+from bipIndigoFramework import shellscript
+
+_repProcessLine = re.compile(r" *([0-9]+) +(\S+) +([0-9.,]+) +([0-9.,]+) +(.+)$")
+_repProcessData = re.compile(r" *([0-9]+) +(\S+ +\S+ +\S+ +\S+ +\S+) +([0-9.,]+) +([0-9.,]+) +(\S+)$")
+
+_lstartFormat = '%a %b %e %H:%M:%S %Y'
+# cpu samples of the native sources not read for this time are forgotten
+_cpuSampleLifetime = 600
+
+
+########################################
+def getProcessSource(thesourcename=u'auto'):
+    """ Chooses the process source
+
+        Args:
+            thesourcename: u'ps' for the ps command source,
+                           u'auto' for the native source of the platform if available
+        Returns:
+            process source instance
+    """
+    thesource = None
+    if thesourcename != u'ps':
+        for thesourceclass in (procfsSource, libprocSource):
+            try:
+                thesource = thesourceclass()
+                break
+            except Exception:
+                pass
+    if thesource is None:
+        thesource = psSource()
+
+    core.logger(traceLog = (u'process source is %s', thesource.name))
+    return thesource
+
+
+def _elapsedSeconds(theetime):
+    """ Converts a ps elapsed time ([[dd-]hh:]mm:ss) to seconds
+
+        Args:
+            theetime: elapsed time as text
+        Returns:
+            number of seconds
+    """
+    try:
+        (longday,longtime)=theetime.split('-')
+    except:
+        longtime=theetime
+        longday=0
+    try:
+        (longh,longm,longs)=longtime.split(':')
+    except:
+        (longm,longs)=longtime.split(':')
+        longh=0
+    return ((int(longday)*24 + int(longh))*60 + int(longm))*60 + int(longs)
+
+
+########################################
+class psSource(object):
+    """ Process source forking the ps command
+    """
+    name = u'ps'
+    # the event loop runs the commands itself (see tableCommand, dataCommand)
+    forks = True
+
+    def __init__(self):
+        # pid -> ps line match of the last table read, for the usage
+        self._usage = {}
+
+    def readTable(self):
+        return self.parseTable(shellscript.run(self.tableCommand()))
+
+    def tableCommand(self):
+        return u"ps -awxc -opid,state,pcpu,pmem,args"
+
+    def parseTable(self, pslist):
+        if pslist is None:
+            return None
+
+        therows = []
+        theusage = {}
+        for theline in pslist.splitlines():
+            thematch = _repProcessLine.match(theline)
+            if thematch is not None:
+                therows.append(thematch.group(1, 2, 5))
+                # the usage is parsed only for the processes asked for
+                theusage[therows[-1][0]] = thematch
+        self._usage = theusage
+        return therows
+
+    def readUsage(self, thepidlist):
+        theusage = {}
+        for thepid in thepidlist:
+            thematch = self._usage.get(thepid)
+            if thematch is not None:
+                theusage[thepid] = (float(thematch.group(3).replace(u',', u'.')), float(thematch.group(4).replace(u',', u'.')))
+        return theusage
+
+    def readData(self, thepidlist):
+        return self.parseData(shellscript.run(self.dataCommand(thepidlist)))
+
+    def dataCommand(self, thepidlist):
+        return u"ps -wxc -opid,lstart,pcpu,pmem,etime -p%s" % (u','.join(thepidlist))
+
+    def parseData(self, pslist):
+        if pslist is None:
+            return None
+
+        thedata = {}
+        for theline in pslist.splitlines():
+            thematch = _repProcessData.match(theline)
+            if thematch is not None:
+                (thepid, thelstart, thepcpu, thepmem, theetime) = thematch.groups()
+                thedata[thepid] = {u'LStart':thelstart, u'PCpu':thepcpu, u'PMem':thepmem, u'ETime':_elapsedSeconds(theetime)}
+        return thedata
+
+
+########################################
+class _nativeSource(object):
+    """ Common part of the in-process sources: cpu percentage between two reads
+    """
+    forks = False
+
+    def __init__(self):
+        # pid -> (start time, cpu time, read time) of the previous read, kept apart for
+        # readData and readUsage so that each measures the cpu since its own previous read
+        self._cpuSamples = {}
+        self._usageSamples = {}
+
+    def _cpuPercent(self, thesamples, thepid, thestart, thecputime, thenow):
+        """ Cpu percentage since the previous read of the process in thesamples, or since its start
+        """
+        theprevious = thesamples.get(thepid)
+        thesamples[thepid] = (thestart, thecputime, thenow)
+        if (theprevious is not None) and (theprevious[0] == thestart) and (thenow > theprevious[2]):
+            return (thecputime - theprevious[1]) * 100.0 / (thenow - theprevious[2])
+        if thenow > thestart:
+            return thecputime * 100.0 / (thenow - thestart)
+        return 0.0
+
+    def _wallTime(self):
+        """ Current time, in the time of the process start dates
+        """
+        return time.time()
+
+    def _forgetSamples(self, thesamples, thenow):
+        """ Forget the processes that are not read anymore
+        """
+        for (thepid, theprevious) in thesamples.items():
+            if theprevious[2] < thenow - _cpuSampleLifetime:
+                del thesamples[thepid]
+
+    def readData(self, thepidlist):
+        thenow = self._wallTime()
+        thedata = {}
+        for thepid in thepidlist:
+            thesample = self._readSample(self._cpuSamples, int(thepid), thenow)
+            if thesample is not None:
+                (thestart, thepcpu, thepmem) = thesample
+                thedata[thepid] = {u'LStart':core.strutf8(time.strftime(_lstartFormat, time.localtime(thestart))),
+                                   u'PCpu':u'%.1f' % (thepcpu),
+                                   u'PMem':u'%.1f' % (thepmem),
+                                   u'ETime':max(0, int(thenow - thestart))}
+        self._forgetSamples(self._cpuSamples, thenow)
+        return thedata
+
+    def readUsage(self, thepidlist):
+        thenow = self._wallTime()
+        theusage = {}
+        for thepid in thepidlist:
+            thesample = self._readSample(self._usageSamples, int(thepid), thenow)
+            if thesample is not None:
+                theusage[thepid] = thesample[1:]
+        self._forgetSamples(self._usageSamples, thenow)
+        return theusage
+
+
+########################################
+class procfsSource(_nativeSource):
+    """ Linux process source reading /proc without forking
+    """
+    name = u'procfs'
+
+    _stateDict = {'R':'R', 'S':'S', 'D':'U', 'Z':'Z', 'T':'T', 't':'T', 'X':'Z', 'I':'I', 'W':'S', 'P':'S', 'K':'S'}
+
+    def __init__(self):
+        if not os.path.exists('/proc/self/stat'):
+            raise OSError('no procfs')
+        _nativeSource.__init__(self)
+        self._hz = float(os.sysconf('SC_CLK_TCK'))
+        self._pagesize = os.sysconf('SC_PAGE_SIZE')
+        with open('/proc/meminfo') as thefile:
+            for theline in thefile:
+                if theline.startswith('MemTotal:'):
+                    self._memtotal = int(theline.split()[1]) * 1024
+        with open('/proc/stat') as thefile:
+            for theline in thefile:
+                if theline.startswith('btime '):
+                    self._boottime = int(theline.split()[1])
+
+    def _readStat(self, thepid):
+        """ (command, state, fields after the command) of a process, or None if vanished
+        """
+        try:
+            with open('/proc/%d/stat' % (thepid)) as thefile:
+                thestat = thefile.read()
+        except (IOError, OSError):
+            return None
+        # the command is between parenthesis and can contain spaces or parenthesis
+        thecommand = thestat[thestat.index('(')+1:thestat.rindex(')')]
+        thefields = thestat[thestat.rindex(')')+2:].split()
+        return (thecommand, thefields)
+
+    def _command(self, thepid, thecomm):
+        """ Executable name and arguments from cmdline - kernel command names are truncated
+            to 15 characters, the full name is then taken from the first argument
+        """
+        try:
+            with open('/proc/%d/cmdline' % (thepid)) as thefile:
+                theargv = thefile.read().split('\0')
+        except (IOError, OSError):
+            return thecomm
+        # cmdline ends with a null character, and is empty for the kernel threads and zombies
+        if theargv[-1] == '':
+            del theargv[-1]
+        if len(theargv) == 0:
+            return thecomm
+        if len(thecomm) >= 15:
+            theargv0 = os.path.basename(theargv[0])
+            if theargv0.startswith(thecomm):
+                thecomm = theargv0
+        # the arguments can be any bytes
+        return ' '.join([thecomm] + theargv[1:]).decode('utf-8', 'replace')
+
+    def readTable(self):
+        therows = []
+        for theentry in os.listdir('/proc'):
+            if not theentry.isdigit():
+                continue
+            thepid = int(theentry)
+            thestat = self._readStat(thepid)
+            if thestat is None:
+                continue
+            (thecomm, thefields) = thestat
+            thestate = self._stateDict.get(thefields[0], 'S')
+            therows.append((core.strutf8(theentry), thestate, core.strutf8(self._command(thepid, thecomm))))
+        return therows
+
+    def _readSample(self, thesamples, thepid, thenow):
+        thestat = self._readStat(thepid)
+        if thestat is None:
+            return None
+        (thecomm, thefields) = thestat
+        # fields are numbered from the state (field 3 in proc(5))
+        thecputime = (int(thefields[11]) + int(thefields[12])) / self._hz
+        thestart = self._boottime + int(thefields[19]) / self._hz
+        thepmem = int(thefields[21]) * self._pagesize * 100.0 / self._memtotal
+        return (thestart, self._cpuPercent(thesamples, thepid, thestart, thecputime, thenow), thepmem)
+
+
+########################################
+class _procBsdInfo(ctypes.Structure):
+    _fields_ = [('pbi_flags', ctypes.c_uint32), ('pbi_status', ctypes.c_uint32), ('pbi_xstatus', ctypes.c_uint32),
+                ('pbi_pid', ctypes.c_uint32), ('pbi_ppid', ctypes.c_uint32),
+                ('pbi_uid', ctypes.c_uint32), ('pbi_gid', ctypes.c_uint32), ('pbi_ruid', ctypes.c_uint32),
+                ('pbi_rgid', ctypes.c_uint32), ('pbi_svuid', ctypes.c_uint32), ('pbi_svgid', ctypes.c_uint32),
+                ('rfu_1', ctypes.c_uint32), ('pbi_comm', ctypes.c_char * 16), ('pbi_name', ctypes.c_char * 32),
+                ('pbi_nfiles', ctypes.c_uint32), ('pbi_pgid', ctypes.c_uint32), ('pbi_pjobc', ctypes.c_uint32),
+                ('e_tdev', ctypes.c_uint32), ('e_tpgid', ctypes.c_uint32), ('pbi_nice', ctypes.c_int32),
+                ('pbi_start_tvsec', ctypes.c_uint64), ('pbi_start_tvusec', ctypes.c_uint64)]
+
+class _procTaskInfo(ctypes.Structure):
+    _fields_ = [('pti_virtual_size', ctypes.c_uint64), ('pti_resident_size', ctypes.c_uint64),
+                ('pti_total_user', ctypes.c_uint64), ('pti_total_system', ctypes.c_uint64),
+                ('pti_threads_user', ctypes.c_uint64), ('pti_threads_system', ctypes.c_uint64),
+                ('pti_policy', ctypes.c_int32), ('pti_faults', ctypes.c_int32), ('pti_pageins', ctypes.c_int32),
+                ('pti_cow_faults', ctypes.c_int32), ('pti_messages_sent', ctypes.c_int32),
+                ('pti_messages_received', ctypes.c_int32), ('pti_syscalls_mach', ctypes.c_int32),
+                ('pti_syscalls_unix', ctypes.c_int32), ('pti_csw', ctypes.c_int32), ('pti_threadnum', ctypes.c_int32),
+                ('pti_numrunning', ctypes.c_int32), ('pti_priority', ctypes.c_int32)]
+
+class _procTaskAllInfo(ctypes.Structure):
+    _fields_ = [('pbsd', _procBsdInfo), ('ptinfo', _procTaskInfo)]
+
+class _machTimebaseInfo(ctypes.Structure):
+    _fields_ = [('numer', ctypes.c_uint32), ('denom', ctypes.c_uint32)]
+
+
+class libprocSource(_nativeSource):
+    """ macOS process source using libproc and sysctl without forking
+
+        Note: libproc does not tell how long a process has been sleeping, so sleeping
+        processes are reported as 'S' and never as 'I' (idle) as ps does
+    """
+    name = u'libproc'
+
+    _PROC_PIDTASKALLINFO = 2
+    _CTL_KERN = 1
+    _KERN_PROCARGS2 = 49
+    _stateDict = {1:'R', 2:'R', 3:'S', 4:'T', 5:'Z'}
+
+    def __init__(self):
+        if sys.platform != 'darwin':
+            raise OSError('libproc is macOS only')
+        _nativeSource.__init__(self)
+        self._libproc = ctypes.CDLL(ctypes.util.find_library('proc') or '/usr/lib/libproc.dylib', use_errno=True)
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+        # cpu times are in mach absolute time units
+        thetimebase = _machTimebaseInfo()
+        self._libc.mach_timebase_info(ctypes.byref(thetimebase))
+        self._cpuTimeFactor = float(thetimebase.numer) / thetimebase.denom / 1e9
+
+        thememsize = ctypes.c_uint64(0)
+        thesize = ctypes.c_size_t(ctypes.sizeof(thememsize))
+        if self._libc.sysctlbyname(b'hw.memsize', ctypes.byref(thememsize), ctypes.byref(thesize), None, 0) != 0:
+            raise OSError(ctypes.get_errno(), 'sysctl hw.memsize failed')
+        self._memtotal = thememsize.value
+
+        # buffer of the arguments, shared by the reads of the table
+        theargmax = ctypes.c_int(0)
+        thesize = ctypes.c_size_t(ctypes.sizeof(theargmax))
+        if self._libc.sysctlbyname(b'kern.argmax', ctypes.byref(theargmax), ctypes.byref(thesize), None, 0) != 0:
+            raise OSError(ctypes.get_errno(), 'sysctl kern.argmax failed')
+        self._arguments = ctypes.create_string_buffer(theargmax.value)
+        self._argumentsLock = threading.Lock()
+
+    def _listPids(self):
+        thecount = self._libproc.proc_listallpids(None, 0)
+        if thecount <= 0:
+            return []
+        # some margin for the processes started meanwhile
+        thecount = thecount + 64
+        thebuffer = (ctypes.c_int * thecount)()
+        thecount = self._libproc.proc_listallpids(thebuffer, ctypes.sizeof(thebuffer))
+        return [thepid for thepid in thebuffer[:max(thecount, 0)] if thepid > 0]
+
+    def _taskInfo(self, thepid):
+        theinfo = _procTaskAllInfo()
+        if self._libproc.proc_pidinfo(thepid, self._PROC_PIDTASKALLINFO, ctypes.c_uint64(0), ctypes.byref(theinfo), ctypes.sizeof(theinfo)) != ctypes.sizeof(theinfo):
+            return None
+        return theinfo
+
+    def _argv(self, thepid):
+        """ Arguments of a process after the executable (KERN_PROCARGS2), empty if not readable
+            (processes of other users)
+        """
+        themib = (ctypes.c_int * 3)(self._CTL_KERN, self._KERN_PROCARGS2, thepid)
+        with self._argumentsLock:
+            thesize = ctypes.c_size_t(ctypes.sizeof(self._arguments))
+            if self._libc.sysctl(themib, 3, self._arguments, ctypes.byref(thesize), None, 0) != 0:
+                return []
+            theraw = self._arguments.raw[:thesize.value]
+        if len(theraw) < ctypes.sizeof(ctypes.c_int):
+            return []
+        # argc, the executable path, null characters up to an alignment, then the arguments
+        theargc = ctypes.c_int.from_buffer_copy(theraw[:ctypes.sizeof(ctypes.c_int)]).value
+        theend = theraw.find(b'\0', ctypes.sizeof(ctypes.c_int))
+        if theend < 0:
+            return []
+        thestrings = theraw[theend:].lstrip(b'\0').split(b'\0')
+        return thestrings[1:theargc]
+
+    def readTable(self):
+        therows = []
+        for thepid in self._listPids():
+            theinfo = self._taskInfo(thepid)
+            if theinfo is None:
+                continue
+            thename = theinfo.pbsd.pbi_name or theinfo.pbsd.pbi_comm
+            thestate = self._stateDict.get(theinfo.pbsd.pbi_status, 'S')
+            therows.append((core.strutf8(thepid), thestate, b' '.join([thename] + self._argv(thepid)).decode('utf-8', 'replace')))
+        return therows
+
+    def _readSample(self, thesamples, thepid, thenow):
+        theinfo = self._taskInfo(thepid)
+        if theinfo is None:
+            return None
+        thestart = theinfo.pbsd.pbi_start_tvsec + theinfo.pbsd.pbi_start_tvusec / 1e6
+        thecputime = (theinfo.ptinfo.pti_total_user + theinfo.ptinfo.pti_total_system) * self._cpuTimeFactor
+        thepmem = theinfo.ptinfo.pti_resident_size * 100.0 / self._memtotal
+        return (thestart, self._cpuPercent(thesamples, thepid, thestart, thecputime, thenow), thepmem)
+
+
+########################################
+_repRegexChars = re.compile(r"[.^$*+?{}\[\]\\|()]")
+
+class processClassifier(object):
+    """ Matches the process rows against the process name patterns of all the devices at once
+
+        Both kinds of patterns match the end of the command after a space, as egrep
+        ' <pattern>$' did on the ps output: plain names are looked up in a dictionary
+        for the whole command and each of its ends following a space, regular expressions
+        are tested through one combined expression, so a tasklist is classified in a
+        single pass.
+        The keys added with aggregate get all their matching rows in the same pass.
+    """
+    def __init__(self):
+        # key (device id) -> pattern
+        self._patterns = dict()
+        # keys getting all their matching rows
+        self._aggregates = set()
+        self._lock = threading.Lock()
+        self._matcher = None
+
+    def add(self, thekey, thepattern, theaggregate=False):
+        """ Adds or changes the pattern of a key - the matcher is rebuilt on next use
+        """
+        with self._lock:
+            if not self.hasPattern(thekey, thepattern, theaggregate):
+                self._patterns[thekey] = thepattern
+                if theaggregate:
+                    self._aggregates.add(thekey)
+                else:
+                    self._aggregates.discard(thekey)
+                self._matcher = None
+
+    def remove(self, thekey):
+        """ Removes the pattern of a key
+        """
+        with self._lock:
+            if thekey in self._patterns:
+                del self._patterns[thekey]
+                self._aggregates.discard(thekey)
+                self._matcher = None
+
+    def hasPattern(self, thekey, thepattern, theaggregate=False):
+        """ Tests if the key is classified with this pattern
+        """
+        return (self._patterns.get(thekey) == thepattern) and ((thekey in self._aggregates) == theaggregate)
+
+    def _build(self):
+        theliterals = dict()
+        theregexes = []
+        for (thekey, thepattern) in self._patterns.items():
+            if _repRegexChars.search(thepattern) is None:
+                theliterals.setdefault(thepattern, []).append(thekey)
+            else:
+                try:
+                    theregexes.append((thekey, thepattern, re.compile(u' (?:' + thepattern + u')$')))
+                except re.error as e:
+                    core.logger(errLog = u'process name %s is not a valid regular expression: %s' % (thepattern, e))
+
+        thecombined = None
+        if len(theregexes) > 0:
+            try:
+                thecombined = re.compile(u' (?:' + u'|'.join([u'(?:' + thepattern + u')' for (thekey, thepattern, theregex) in theregexes]) + u')$')
+            except (re.error, AssertionError, OverflowError):
+                # too many groups or back references: every expression will be tested
+                thecombined = None
+
+        core.logger(traceLog = (u'process classifier built with %s names and %s expressions', len(theliterals), len(theregexes)))
+        return (theliterals, theregexes, thecombined, frozenset(self._aggregates))
+
+    def classify(self, therows):
+        """ Searches the first process row matching each pattern, and all the rows
+            matching the patterns of the keys added with aggregate
+
+            Args:
+                therows: list of (pid, state, command) rows
+            Returns:
+                (matches, instances) tuple:
+                    matches: dictionary key -> first matching row, for the keys having a match
+                    instances: dictionary key -> list of the matching rows, for the keys
+                               added with aggregate having a match
+        """
+        with self._lock:
+            if self._matcher is None:
+                self._matcher = self._build()
+            (theliterals, theregexes, thecombined, theaggregates) = self._matcher
+
+        thematches = dict()
+        theinstances = dict()
+        for therow in therows:
+            thecommand = therow[2]
+            if len(theliterals) > 0:
+                # the ends are all of different lengths: a name matches a row once
+                theend = thecommand
+                thespace = -1
+                while True:
+                    if theend in theliterals:
+                        for thekey in theliterals[theend]:
+                            if thekey not in thematches:
+                                thematches[thekey] = therow
+                            if thekey in theaggregates:
+                                theinstances.setdefault(thekey, []).append(therow)
+                    thespace = thecommand.find(u' ', thespace + 1)
+                    if thespace < 0:
+                        break
+                    theend = thecommand[thespace + 1:]
+            if len(theregexes) > 0:
+                thecommand = u' ' + thecommand
+                if (thecombined is None) or (thecombined.search(thecommand) is not None):
+                    # few rows get here: find which expressions matched
+                    for (thekey, thepattern, theregex) in theregexes:
+                        if ((thekey not in thematches) or (thekey in theaggregates)) and (theregex.search(thecommand) is not None):
+                            if thekey not in thematches:
+                                thematches[thekey] = therow
+                            if thekey in theaggregates:
+                                theinstances.setdefault(thekey, []).append(therow)
+        return (thematches, theinstances)
@@ -0,0 +1,185 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################################################################################
+"""
+    Mac OS System plug-in device registry
+    By Bernard Philippe (bip.philippe) (C) 2015
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.#
+
+    The devices started by the plugin, with what the polling needs of their properties,
+    so that the dialog cycles neither go through the server device list nor read the
+    device properties. The records are added by deviceStartComm, removed by deviceStopComm
+    and refreshed when the server updates the device.
+    A record has the id and name of its device, so that it can be given to the framework
+    functions taking a device (pace, update requests, process watch).
+    The records of the process devices keep the history of the cpu and memory usage
+    of their process in a ring buffer (see setUsageWindows).
+"""
+####################################################################################
+
+import indigo
+import threading
+import collections
+from bipIndigoFramework import ringbuffer
+
+_processTypes = (u'bip.ms.application', u'bip.ms.helper', u'bip.ms.daemon')
+_instancesTypes = (u'bip.ms.helper', u'bip.ms.daemon')
+# cpu and memory percentages
+_usageSeries = 2
+
+
+def init():
+    indigo.activePlugin._deviceRecords = collections.OrderedDict()
+    indigo.activePlugin._deviceRecordsLock = threading.Lock()
+    indigo.activePlugin._usageWindows = ((300, 3600), 360)
+
+
+def setUsageWindows(thewindows, thesize):
+    """ Set the windows of the process usage statistics - the usage history is cleared
+        if they change
+
+        Args:
+            thewindows: (short, long) windows durations in seconds
+            thesize: number of samples kept per device
+    """
+    if indigo.activePlugin._usageWindows == (thewindows, thesize):
+        return
+    with indigo.activePlugin._deviceRecordsLock:
+        indigo.activePlugin._usageWindows = (thewindows, thesize)
+        for therecord in indigo.activePlugin._deviceRecords.itervalues():
+            if therecord.kind == u'process':
+                therecord.usage = _usageBuffer()
+
+
+def _usageBuffer():
+    (thewindows, thesize) = indigo.activePlugin._usageWindows
+    return ringbuffer.ringBuffer(thesize, _usageSeries, thewindows)
+
+
+########################################
+class deviceRecord(object):
+    """ Polling data of a device
+    """
+    __slots__ = ('id', 'name', 'device', 'kind', 'active', 'processName', 'volumeId', 'closeWindows', 'keepAwaken', 'aggregate', 'pid', 'usage', 'dataDue')
+
+    def __init__(self, thedevice, thepid=None, theusage=None):
+        """ Constructor
+
+            Args:
+                thedevice: device object
+                thepid: last process id, or None for the one of the device states
+                theusage: usage history of the process, or None for a new one
+        """
+        theprops = thedevice.pluginProps
+        self.id = thedevice.id
+        self.name = thedevice.name
+        # device object, kept for the state updates
+        self.device = thedevice
+        if thedevice.deviceTypeId in _processTypes:
+            self.kind = u'process'
+        elif thedevice.deviceTypeId == u'bip.ms.volume':
+            self.kind = u'volume'
+        elif thedevice.deviceTypeId == u'bip.ms.health':
+            self.kind = u'health'
+        else:
+            self.kind = None
+        self.active = thedevice.configured and thedevice.enabled
+        self.processName = theprops.get(u'ApplicationProcessName')
+        self.volumeId = theprops.get(u'VolumeID')
+        self.closeWindows = theprops.get(u'closeWindows', False)
+        self.keepAwaken = theprops.get(u'keepAwaken', False)
+        # helpers and daemons count their instances, and sum them if aggregate is True
+        if thedevice.deviceTypeId in _instancesTypes:
+            self.aggregate = theprops.get(u'aggregateInstances', False)
+        else:
+            self.aggregate = None
+        if thepid is None:
+            thepid = thedevice.states.get(u'ProcessID', 0)
+        self.pid = thepid
+        # (cpu, memory) samples of the process
+        if (theusage is None) and (self.kind == u'process'):
+            theusage = _usageBuffer()
+        self.usage = theusage
+        # the application data timer passed since the last detail read of the process
+        self.dataDue = False
+
+
+########################################
+def add(thedevice):
+    """ Adds or replaces the record of a device
+
+        Args:
+            thedevice: device object
+        Returns:
+            the record
+    """
+    therecord = deviceRecord(thedevice)
+    with indigo.activePlugin._deviceRecordsLock:
+        indigo.activePlugin._deviceRecords[thedevice.id] = therecord
+    return therecord
+
+
+def remove(thedevice):
+    """ Removes the record of a device
+
+        Args:
+            thedevice: device object
+    """
+    with indigo.activePlugin._deviceRecordsLock:
+        indigo.activePlugin._deviceRecords.pop(thedevice.id, None)
+
+
+def _recordChanged(theorigdevice, thedevice):
+    # what a record is made of - the state updates do not change it
+    if (theorigdevice.name != thedevice.name) or (theorigdevice.enabled != thedevice.enabled) \
+            or (theorigdevice.configured != thedevice.configured):
+        return True
+    return dict(theorigdevice.pluginProps.iteritems()) != dict(thedevice.pluginProps.iteritems())
+
+
+def refresh(theorigdevice, thedevice):
+    """ Refreshes the record of a device updated by the server, if what the polling reads
+        of it changed - nothing is done if the device is not started or if only its states
+        changed
+
+        Args:
+            theorigdevice: device object before the update
+            thedevice: new device object
+        Returns:
+            the record, or None if the device has no record
+    """
+    with indigo.activePlugin._deviceRecordsLock:
+        theoldrecord = indigo.activePlugin._deviceRecords.get(thedevice.id)
+        if (theoldrecord is None) or (not _recordChanged(theorigdevice, thedevice)):
+            return theoldrecord
+        therecord = deviceRecord(thedevice, theoldrecord.pid, theoldrecord.usage)
+        therecord.dataDue = theoldrecord.dataDue
+        indigo.activePlugin._deviceRecords[thedevice.id] = therecord
+    return therecord
+
+
+def records(thekind=None):
+    """ Records of the started devices
+
+        Args:
+            thekind: u'process', u'volume' or u'health', or None for all the devices
+        Returns:
+            list of the records, in the order the devices were started
+    """
+    with indigo.activePlugin._deviceRecordsLock:
+        if thekind is None:
+            return indigo.activePlugin._deviceRecords.values()
+        return [therecord for therecord in indigo.activePlugin._deviceRecords.itervalues() if therecord.kind == thekind]
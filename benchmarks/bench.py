@@ -0,0 +1,313 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################################################################################
+""" Polling cycle benchmark of the Mac System plugin
+
+    By Bernard Philippe (bip.philippe) (C) 2015
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.#
+
+    Runs Plugin.runConcurrentThread on a simulated mac (see fakesystem.py) for a number
+    of cycles, with 10, 100 and 1000 devices, and reports per cycle:
+        wallMs          wall time of the cycle in milliseconds (median), sleep excluded
+        subprocesses    commands started
+        stateUpdates    device state and state image calls to the server
+        states          device states pushed to the server
+        objects         objects allocated and still alive at the end of the cycle
+                        (gc tracked objects, the collector being stopped during the cycle)
+    The first cycle, reading everything at startup, is not counted.
+    The results are compared to baselines.json: the run fails if one of them is above
+    its baseline more than the tolerance.
+
+    Usage: python bench.py [--sizes 10,100,1000] [--cycles 60] [--threads 1] [--seed 1]
+                           [--source ps] [--engine thread] [--wall-tolerance 2.0]
+                           [--save] [--json file]
+        --source        ps to read the processes with the ps commands, native as the
+                        in-process sources do
+        --engine        thread or event polling engine
+        --save          stores the results as the new baselines
+        --json          writes the results and the details of each cycle to a file
+"""
+####################################################################################
+
+import sys
+import os
+import gc
+import time
+import json
+import shutil
+import tempfile
+import argparse
+import __builtin__
+
+_benchDirectory = os.path.dirname(os.path.abspath(__file__))
+_pluginDirectory = os.path.join(_benchDirectory, u'..', u'Mac System.indigoPlugin', u'Contents', u'Server Plugin')
+_baselinesFile = os.path.join(_benchDirectory, u'baselines.json')
+
+sys.path.insert(0, _pluginDirectory)
+sys.path.insert(0, _benchDirectory)
+
+import indigo
+# the host process makes indigo a global name of plugin.py
+__builtin__.indigo = indigo
+import fakesystem
+from bipIndigoFramework import corethread
+import plugin
+
+# metric -> (factor, margin) : regression if value > baseline * factor + margin
+_tolerances = {u'subprocesses':(1.0, 0.01),
+               u'stateUpdates':(1.0, 0.01),
+               u'states':(1.0, 0.01),
+               u'objects':(1.25, 50),
+               u'wallMs':(2.0, 1.0)}
+_metrics = (u'wallMs', u'subprocesses', u'stateUpdates', u'states', u'objects')
+
+
+########################################
+class cycleRecorder(object):
+    """ Takes the measures of each cycle - replaces corethread.sleepNext, which ends the cycles
+        of the thread engine, and corethread.nextDelay, which ends the ones of the event engine
+    """
+    def __init__(self, thesystem, thecycles):
+        self._system = thesystem
+        self._cycles = thecycles
+        self._sleepNext = corethread.sleepNext
+        self._nextDelay = corethread.nextDelay
+        self.cycles = []
+
+    def start(self):
+        gc.collect()
+        gc.disable()
+        self._commands = sum(self._system.commands.values())
+        self._calls = indigo.serverCalls.copy()
+        self._objects = gc.get_count()[0]
+        self._time = time.time()
+
+    def sleepNext(self, thetime=None):
+        self._record()
+        self._sleepNext(thetime)
+        self.start()
+
+    def nextDelay(self, thetime=None):
+        self._record()
+        # the event loop waits on the simulated clock as the thread engine does, woken up
+        # by the process exits, so that both engines get the same cycles
+        corethread.nextDelay = self._nextDelay
+        try:
+            self._sleepNext(thetime)
+        finally:
+            corethread.nextDelay = self.nextDelay
+        self.start()
+        return 0
+
+    def _record(self):
+        thewall = time.time() - self._time
+        theobjects = gc.get_count()[0] - self._objects
+        gc.enable()
+
+        thecalls = indigo.serverCalls - self._calls
+        self.cycles.append({u'wallMs':thewall * 1000.0,
+                            u'subprocesses':sum(self._system.commands.values()) - self._commands,
+                            u'stateUpdates':thecalls[u'updateStatesOnServer'] + thecalls[u'updateStateOnServer'] + thecalls[u'updateStateImageOnServer'],
+                            u'states':thecalls[u'states'],
+                            u'objects':theobjects})
+        if len(self.cycles) >= self._cycles:
+            raise indigo.activePlugin.StopThread()
+
+
+def _median(thevalues):
+    thevalues = sorted(thevalues)
+    themiddle = len(thevalues) // 2
+    if len(thevalues) % 2 == 1:
+        return thevalues[themiddle]
+    return (thevalues[themiddle - 1] + thevalues[themiddle]) / 2.0
+
+
+########################################
+def runScenario(thecount, thecycles, thethreads, theseed, thesource=u'ps', theengine=u'thread'):
+    """ Runs the plugin on a simulated mac
+
+        Args:
+            thecount: number of devices
+            thecycles: number of cycles
+            thethreads: number of device polling threads
+            theseed: seed of the simulated changes
+            thesource: u'ps' to read the processes with the ps commands, u'native' to read
+                       them as the in-process sources do
+            theengine: u'thread' or u'event' polling engine
+        Returns:
+            (results, cycles, errors) tuple: dictionary metric -> value per cycle,
+            list of the measures of each cycle, list of the plugin error messages
+    """
+    thesystem = fakesystem.fakeSystem(thecount, theseed)
+    indigo.devices.clear()
+    for thedevice in thesystem.devices:
+        indigo.devices.add(thedevice)
+    indigo.serverCalls.clear()
+    del indigo.server.messages[:]
+
+    # the compiled scripts cache is in the user caches
+    thehome = tempfile.mkdtemp(prefix=u'macsystem-bench-')
+    theoldhome = os.environ.get('HOME')
+    os.environ['HOME'] = thehome
+    themonotonic = corethread.monotonic
+    thesystem.install()
+    corethread.monotonic = thesystem.clock
+    therecorder = cycleRecorder(thesystem, thecycles)
+    corethread.sleepNext = therecorder.sleepNext
+    if theengine == u'event':
+        corethread.nextDelay = therecorder.nextDelay
+    try:
+        theprefs = {u'logLevel':u'1',
+                    u'disksleepTime':0,
+                    u'pollMinInterval':u'10',
+                    u'pollMaxInterval':u'120',
+                    u'pollGrowthFactor':u'1.5',
+                    u'pollEngine':theengine,
+                    u'pollThreads':u'%d' % (thethreads),
+                    u'processSource':u'ps',
+                    u'useScriptHost':False}
+        theplugin = plugin.Plugin(u'com.bip.benchmark', u'Mac System', u'2.0.1', theprefs)
+        theplugin.startup()
+        # the kernel notifications are replaced by the simulated system ones
+        indigo.activePlugin._processWatcher = thesystem.processWatcher()
+        indigo.activePlugin._volumeWatcher = thesystem.volumeWatcher()
+        if thesource == u'native':
+            indigo.activePlugin._processSource = thesystem.processSource()
+        for thedevice in indigo.devices.iter(u'self'):
+            theplugin.deviceStartComm(thedevice)
+
+        therecorder.start()
+        theplugin.runConcurrentThread()
+        gc.enable()
+        theplugin.shutdown()
+    finally:
+        gc.enable()
+        corethread.sleepNext = therecorder._sleepNext
+        corethread.nextDelay = therecorder._nextDelay
+        corethread.monotonic = themonotonic
+        thesystem.uninstall()
+        if theoldhome is None:
+            del os.environ['HOME']
+        else:
+            os.environ['HOME'] = theoldhome
+        shutil.rmtree(thehome, ignore_errors=True)
+
+    thecycles = therecorder.cycles[1:]
+    theresults = {u'wallMs':round(_median([thecycle[u'wallMs'] for thecycle in thecycles]), 3)}
+    for themetric in _metrics[1:]:
+        theresults[themetric] = round(sum([thecycle[themetric] for thecycle in thecycles]) / float(len(thecycles)), 3)
+    return (theresults, therecorder.cycles, list(theplugin.errors))
+
+
+########################################
+def compare(theresults, thebaselines, thewalltolerance):
+    """ Compares the results to the baselines
+
+        Args:
+            theresults: dictionary size -> metric -> value
+            thebaselines: same for the baselines
+            thewalltolerance: factor allowed on the wall time
+        Returns:
+            list of the regressions as texts
+    """
+    theregressions = []
+    for (thesize, thevalues) in sorted(theresults.items(), key=lambda theitem: int(theitem[0])):
+        if thesize not in thebaselines:
+            print(u'no baseline for %s devices' % (thesize))
+            continue
+        for themetric in _metrics:
+            if themetric not in thebaselines[thesize]:
+                continue
+            (thefactor, themargin) = _tolerances[themetric]
+            if themetric == u'wallMs':
+                thefactor = thewalltolerance
+            thebaseline = thebaselines[thesize][themetric]
+            if thevalues[themetric] > thebaseline * thefactor + themargin:
+                theregressions.append(u'%s devices: %s is %s, baseline %s' % (thesize, themetric, thevalues[themetric], thebaseline))
+    return theregressions
+
+
+def main(theargs):
+    theparser = argparse.ArgumentParser(description=u'Mac System plugin polling cycle benchmark')
+    theparser.add_argument(u'--sizes', default=u'10,100,1000', help=u'numbers of devices, comma separated')
+    theparser.add_argument(u'--cycles', type=int, default=60, help=u'cycles run for each size')
+    theparser.add_argument(u'--threads', type=int, default=1, help=u'device polling threads')
+    theparser.add_argument(u'--seed', type=int, default=1, help=u'seed of the simulated changes')
+    theparser.add_argument(u'--source', default=u'ps', choices=(u'ps', u'native'), help=u'process source')
+    theparser.add_argument(u'--engine', default=u'thread', choices=(u'thread', u'event'), help=u'polling engine')
+    theparser.add_argument(u'--wall-tolerance', type=float, default=_tolerances[u'wallMs'][0], help=u'factor allowed on the wall time baseline')
+    theparser.add_argument(u'--save', action=u'store_true', help=u'store the results as the new baselines')
+    theparser.add_argument(u'--json', help=u'file to write the results and the cycle details to')
+    theoptions = theparser.parse_args(theargs)
+
+    thesettings = {u'cycles':theoptions.cycles, u'threads':theoptions.threads, u'seed':theoptions.seed, u'source':theoptions.source}
+    # the baselines saved before the engine option are the thread engine ones
+    if theoptions.engine != u'thread':
+        thesettings[u'engine'] = theoptions.engine
+    theresults = dict()
+    thedetails = dict()
+    theerrors = []
+    print(u'%8s %10s %14s %14s %10s %10s' % ((u'devices',) + _metrics))
+    for thesize in [int(thevalue) for thevalue in theoptions.sizes.split(u',')]:
+        (thevalues, thecycles, theplugerrors) = runScenario(thesize, theoptions.cycles, theoptions.threads, theoptions.seed, theoptions.source, theoptions.engine)
+        theresults[u'%d' % (thesize)] = thevalues
+        thedetails[u'%d' % (thesize)] = thecycles
+        theerrors.extend([u'%s devices: %s' % (thesize, theerror) for theerror in theplugerrors])
+        print(u'%8d %10.3f %14.3f %14.3f %10.3f %10.3f' % ((thesize,) + tuple([thevalues[themetric] for themetric in _metrics])))
+
+    if theoptions.json:
+        with open(theoptions.json, 'w') as thefile:
+            json.dump({u'settings':thesettings, u'results':theresults, u'cycles':thedetails}, thefile, indent=1, sort_keys=True, separators=(',', ': '))
+
+    for theerror in theerrors:
+        print(u'plugin error: %s' % (theerror))
+
+    # one baseline per settings
+    theruns = []
+    if os.path.isfile(_baselinesFile):
+        with open(_baselinesFile) as thefile:
+            theruns = json.load(thefile)[u'runs']
+    thebaselines = None
+    for therun in theruns:
+        if therun[u'settings'] == thesettings:
+            thebaselines = therun
+
+    if theoptions.save:
+        if thebaselines is None:
+            theruns.append({u'settings':thesettings, u'results':theresults})
+        else:
+            thebaselines[u'results'] = theresults
+        with open(_baselinesFile, 'w') as thefile:
+            json.dump({u'runs':theruns}, thefile, indent=1, sort_keys=True, separators=(',', ': '))
+            thefile.write('\n')
+        print(u'baselines saved')
+        return 1 if len(theerrors) > 0 else 0
+
+    if thebaselines is None:
+        print(u'no baselines for the settings %s, run with --save to store them' % (thesettings))
+        return 1 if len(theerrors) > 0 else 0
+
+    theregressions = compare(theresults, thebaselines[u'results'], theoptions.wall_tolerance)
+    for theregression in theregressions:
+        print(u'regression: %s' % (theregression))
+    if (len(theregressions) > 0) or (len(theerrors) > 0):
+        return 1
+    print(u'no regression')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
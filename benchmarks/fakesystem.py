@@ -0,0 +1,436 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################################################################################
+""" Simulated mac for the benchmarks: synthetic devices and canned command outputs
+
+    By Bernard Philippe (bip.philippe) (C) 2015
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.#
+
+    The outputs of ps, df, diskutil, pmset and ls are built from the canned outputs
+    of the outputs directory, with the processes and volumes of the synthetic devices
+    added. subprocess.Popen is replaced while the system is installed: no command is
+    really run, and the commands are counted.
+    The processes of the devices start and stop at random (seeded) times as the
+    simulated clock goes.
+"""
+####################################################################################
+
+import indigo
+import processsource
+import os
+import shutil
+import subprocess
+import tempfile
+import collections
+import random
+import time
+
+_outputsDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), u'outputs')
+
+# index modulo 20 -> device type: half applications, then helpers, daemons and volumes
+_deviceKinds = [u'bip.ms.application']*10 + [u'bip.ms.helper']*4 + [u'bip.ms.daemon']*3 + [u'bip.ms.volume']*3
+
+_applicationStates = {u'onOffState':False, u'PStatus':u'off', u'ProcessID':0, u'LStart':u'', u'ETime':0, u'PCpu':0, u'PMem':0}
+_applicationStates.update([(thestate + thestatistic + thewindow, 0) for thestate in (u'PCpu', u'PMem') for thewindow in (u'Short', u'Long') for thestatistic in (u'Min', u'Avg', u'Max', u'P95')])
+_volumeStates = {u'onOffState':False, u'VStatus':u'off', u'VolumeType':u'', u'VolumeSize':u'', u'VolumeDevice':u'', u'LastPing':u'', u'pcUsed':0, u'BytesFree':0, u'pcInodesUsed':0}
+
+# wall time of the simulated clock origin, for the process start dates
+_epoch = time.mktime((2015, 6, 1, 8, 0, 0, 0, 0, -1))
+
+
+def _readOutput(thename):
+    with open(os.path.join(_outputsDirectory, thename), 'rb') as thefile:
+        return thefile.read()
+
+
+def _elapsedText(theseconds):
+    """ Formats seconds as ps does ([[dd-]hh:]mm:ss)
+    """
+    theseconds = int(theseconds)
+    (thedays, theseconds) = divmod(theseconds, 86400)
+    (thehours, theseconds) = divmod(theseconds, 3600)
+    (theminutes, theseconds) = divmod(theseconds, 60)
+    if thedays > 0:
+        return '%d-%02d:%02d:%02d' % (thedays, thehours, theminutes, theseconds)
+    if thehours > 0:
+        return '%02d:%02d:%02d' % (thehours, theminutes, theseconds)
+    return '%02d:%02d' % (theminutes, theseconds)
+
+
+########################################
+class clock(object):
+    """ Simulated monotonic clock, advanced when the plugin sleeps
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, theseconds):
+        self.now = self.now + theseconds
+
+
+class _process(object):
+    def __init__(self, thepid, thecommand, thestart):
+        self.pid = thepid
+        self.command = thecommand
+        self.start = thestart
+        self.state = 'S'
+
+
+########################################
+class fakeSystem(object):
+    """ The devices of a benchmark and the system they watch
+    """
+    def __init__(self, thecount, theseed=1, thechurn=0.05):
+        """ Constructor
+
+            Args:
+                thecount: number of devices
+                theseed: seed of the random changes
+                thechurn: fraction of the process devices starting or stopping each minute
+        """
+        self.clock = clock()
+        self.commands = collections.Counter()
+        self.devices = []
+        self._random = random.Random(theseed)
+        self._nextPid = 20000
+        # device id -> process when running
+        self._processes = dict()
+        # pid -> process when running
+        self._runningPids = dict()
+        # process device id -> command
+        self._commands = dict()
+        self._volumes = []
+        self._installed = None
+
+        self._psTable = _readOutput(u'ps.txt')
+        self._df = _readOutput(u'df.txt')
+        self._diskutil = _readOutput(u'diskutil.txt')
+        self._pmset = _readOutput(u'pmset.txt')
+        self._ls = _readOutput(u'ls_volumes.txt')
+
+        for theindex in range(thecount):
+            self._addDevice(theindex)
+        self._buildVolumeOutputs()
+
+        self._deviceIds = sorted(self._commands.keys())
+        self._changeInterval = 60.0 / max(thechurn * len(self._commands), 0.01)
+        self._nextChange = self.clock.now + self._changeInterval
+
+    def _addDevice(self, theindex):
+        thetypeid = _deviceKinds[theindex % len(_deviceKinds)]
+        thedeviceid = 100000 + theindex
+
+        if thetypeid == u'bip.ms.volume':
+            thename = u'Bench Volume %04d' % (theindex)
+            theprops = {u'VolumeID':thename, u'forceQuit':False, u'keepAwaken':(theindex % 3 == 0)}
+            thedevice = indigo.device(thedeviceid, thename, thetypeid, theprops, _volumeStates)
+            # most volumes are mounted, all are known by diskutil
+            self._volumes.append((thename, u'disk%ds2' % (10 + len(self._volumes)), self._random.random() < 0.8))
+        else:
+            if thetypeid == u'bip.ms.application':
+                theappid = u'Bench App %04d' % (theindex)
+                theprocessname = theappid
+                thecommand = theappid
+            elif thetypeid == u'bip.ms.helper':
+                theappid = u'BenchHelper%04d' % (theindex)
+                theprocessname = theappid + u'(?: -.+)?'
+                thecommand = theappid + u' -psn_0_%d' % (theindex)
+            else:
+                theappid = u'benchd%04d' % (theindex)
+                theprocessname = theappid + u' +--serve'
+                thecommand = theappid + u' --serve'
+            thepath = u'/Applications/' + theappid + u'.app'
+            theprops = {u'ApplicationID':theappid,
+                        u'ApplicationPathName':thepath,
+                        u'ApplicationProcessName':theprocessname,
+                        u'ApplicationStartPathName':u"open '" + thepath + u"'",
+                        u'ApplicationStopPathName':u'tell application "' + theappid + u'" to quit',
+                        u'windowcloseScript':u'tell application "' + theappid + u'" to close every window',
+                        u'directoryPath':u'/Applications',
+                        u'closeWindows':False,
+                        u'forceQuit':(thetypeid != u'bip.ms.application'),
+                        u'aggregateInstances':(thetypeid == u'bip.ms.daemon'),
+                        u'nameSpecial':False,
+                        u'processSpecial':False,
+                        u'windowcloseSpecial':False}
+            if thetypeid == u'bip.ms.application':
+                thedevice = indigo.device(thedeviceid, theappid, thetypeid, theprops, _applicationStates)
+            else:
+                thedevice = indigo.device(thedeviceid, theappid, thetypeid, theprops, dict(_applicationStates, Instances=0))
+            self._commands[thedeviceid] = thecommand
+            if self._random.random() < 0.7:
+                self._startProcess(thedeviceid)
+
+        self.devices.append(thedevice)
+
+    def _buildVolumeOutputs(self):
+        thediskutil = [self._diskutil]
+        thedf = [self._df]
+        thels = [self._ls]
+        for (thename, thenode, themounted) in self._volumes:
+            thediskutil.append(('/dev/%s (external, physical):\n' % (thenode[:-2])).encode('utf-8'))
+            thediskutil.append(('   2:' + u'Apple_HFS'.rjust(27) + u' ' + thename.ljust(24) + u'999.9 GB'.ljust(11) + thenode + u'\n').encode('utf-8'))
+            if themounted:
+                theused = self._random.randint(10, 900) * 1000000
+                thedf.append(('/dev/%s  976426672 %d %d    %d%%  1000 2000   1%%   /Volumes/%s\n' % (thenode, theused, 976426672 - theused, theused / 9764266, thename)).encode('utf-8'))
+                thels.append((thename + u'\n').encode('utf-8'))
+        self._diskutil = b''.join(thediskutil)
+        self._df = b''.join(thedf)
+        self._ls = b''.join(thels)
+
+    def _startProcess(self, thedeviceid):
+        self._nextPid = self._nextPid + self._random.randint(1, 40)
+        self._processes[thedeviceid] = _process(self._nextPid, self._commands[thedeviceid], self.clock.now)
+        self._runningPids[self._nextPid] = self._processes[thedeviceid]
+
+    ########################################
+    def advance(self, theseconds):
+        """ Advances the clock, starting and stopping the processes of the devices meanwhile
+        """
+        thetarget = self.clock.now + theseconds
+        while (self._nextChange <= thetarget) and (len(self._deviceIds) > 0):
+            self.clock.now = self._nextChange
+            self._nextChange = self._nextChange + self._changeInterval
+            thedeviceid = self._random.choice(self._deviceIds)
+            if thedeviceid in self._processes:
+                del self._runningPids[self._processes.pop(thedeviceid).pid]
+            else:
+                self._startProcess(thedeviceid)
+        self.clock.now = thetarget
+
+    def nextChange(self):
+        """ Delay until the next process start or stop
+        """
+        return self._nextChange - self.clock.now
+
+    def isRunning(self, thepid):
+        return thepid in self._runningPids
+
+    ########################################
+    def output(self, thecommand):
+        """ Output of a command
+
+            Args:
+                thecommand: command as text or list of arguments
+            Returns:
+                (output, error) tuple
+        """
+        if type(thecommand) in (list, tuple):
+            thename = os.path.basename(thecommand[0])
+            self.commands[thename] += 1
+            if thename == u'osacompile':
+                # osacompile -o output source
+                shutil.copyfile(thecommand[3], thecommand[2])
+            return (b'', b'')
+
+        thecommand = thecommand.strip()
+        if thecommand.startswith(u'ps -awxc'):
+            self.commands[u'ps'] += 1
+            return (self._psOutput(), b'')
+        if thecommand.startswith(u'ps -wxc'):
+            self.commands[u'ps'] += 1
+            return (self._psData(thecommand.split(u'-p')[-1].split(u',')), b'')
+        if thecommand.startswith(u'/usr/sbin/diskutil list'):
+            self.commands[u'diskutil'] += 1
+            return (self._diskutil, b'')
+        if thecommand.startswith(u'/bin/df'):
+            self.commands[u'df'] += 1
+            return (self._df, b'')
+        if thecommand.startswith(u'ls -1 /Volumes'):
+            self.commands[u'ls'] += 1
+            return (self._ls, b'')
+        if thecommand.startswith(u'pmset -g'):
+            self.commands[u'pmset'] += 1
+            # same as: grep disksleep | sed -e s/[a-z]//g | sed -e 's/ //g'
+            thelines = [theline for theline in self._pmset.splitlines() if b'disksleep' in theline]
+            return (b''.join([b''.join([thechar for thechar in theline if not (thechar.islower() or thechar == b' ')]) + b'\n' for theline in thelines]), b'')
+        self.commands[thecommand.split(u' ')[0]] += 1
+        return (b'', b'')
+
+    def _psOutput(self):
+        thelines = [self._psTable]
+        for theprocess in sorted(self._processes.values(), key=lambda theprocess: theprocess.pid):
+            # cpu varying with the clock, without drawing from the seeded random numbers
+            thecpu = ((theprocess.pid + int(self.clock.now / 10)) % 40) / 2.0
+            thelines.append(('%5d %-4s %5.1f %4.1f %s\n' % (theprocess.pid, theprocess.state, thecpu, (theprocess.pid % 50) / 10.0, theprocess.command)).encode('utf-8'))
+        return b''.join(thelines)
+
+    def _psData(self, thepids):
+        thepids = set([int(thepid) for thepid in thepids if thepid.strip().isdigit()])
+        thelines = [b'  PID STARTED                        %CPU %MEM ELAPSED\n']
+        for theprocess in sorted(self._processes.values(), key=lambda theprocess: theprocess.pid):
+            if theprocess.pid in thepids:
+                if self._random.random() < 0.8:
+                    thecpu = 0.0
+                else:
+                    thecpu = round(self._random.uniform(0, 30), 1)
+                thestart = time.strftime('%a %b %e %H:%M:%S %Y', time.localtime(_epoch + theprocess.start))
+                thelines.append(('%5d %s %5.1f %4.1f %11s\n' % (theprocess.pid, thestart, thecpu, (theprocess.pid % 50) / 10.0, _elapsedText(self.clock.now - theprocess.start))).encode('utf-8'))
+        return b''.join(thelines)
+
+    ########################################
+    def install(self):
+        """ Replaces subprocess.Popen, the sleep of the plugin and the local time of the
+            states (LastPing) by the simulation
+        """
+        self._installed = (subprocess.Popen, time.localtime)
+        subprocess.Popen = self._popen
+        time.localtime = self._localtime
+        indigo.setClock(self.advance)
+
+    def uninstall(self):
+        """ Restores subprocess.Popen and time.localtime
+        """
+        if self._installed is not None:
+            (subprocess.Popen, time.localtime) = self._installed
+            self._installed = None
+        indigo.setClock(None)
+
+    def _localtime(self, *theargs):
+        if len(theargs) == 0:
+            theargs = (_epoch + self.clock.now,)
+        return self._installed[1](*theargs)
+
+    def _popen(self, thecommand, **theoptions):
+        return _popen(self.output(thecommand))
+
+    def processSource(self):
+        """ Process source reading the simulated system as the native sources read the mac
+        """
+        return _processSource(self)
+
+    def processWatcher(self):
+        """ Watcher of the process exits for processwatch
+        """
+        return _processWatcher(self)
+
+    def volumeWatcher(self):
+        """ Watcher of the mount root for interface - the volumes do not change
+        """
+        return _volumeWatcher()
+
+
+########################################
+class _popen(object):
+    """ Finished subprocess, which outputs are read from temporary files
+    """
+    _pids = [50000]
+
+    def __init__(self, theoutputs):
+        (theoutput, theerror) = theoutputs
+        self.stdout = self._file(theoutput)
+        self.stderr = self._file(theerror)
+        self.stdin = None
+        self._pids[0] = self._pids[0] + 1
+        self.pid = self._pids[0]
+        self.returncode = 0
+
+    def _file(self, thedata):
+        thefile = tempfile.TemporaryFile()
+        thefile.write(thedata)
+        thefile.seek(0)
+        return thefile
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        return self.returncode
+
+    def communicate(self, theinput=None):
+        return (self.stdout.read(), self.stderr.read())
+
+
+class _processSource(processsource._nativeSource):
+    """ Native process source of the simulated system: the rows of the canned ps output
+        and of the processes of the devices, with their arguments, and cpu times growing
+        at a rate depending on the process
+    """
+    name = u'simulated'
+
+    def __init__(self, thesystem):
+        processsource._nativeSource.__init__(self)
+        self._system = thesystem
+        self._table = []
+        for theline in thesystem._psTable.decode('utf-8').splitlines()[1:]:
+            thefields = theline.split(None, 4)
+            self._table.append((thefields[0], thefields[1], thefields[4]))
+
+    def _wallTime(self):
+        return _epoch + self._system.clock.now
+
+    def readTable(self):
+        therows = list(self._table)
+        for theprocess in sorted(self._system._processes.values(), key=lambda theprocess: theprocess.pid):
+            therows.append((u'%d' % (theprocess.pid), theprocess.state, theprocess.command))
+        return therows
+
+    def _readSample(self, thesamples, thepid, thenow):
+        theprocess = self._system._runningPids.get(thepid)
+        if theprocess is None:
+            return None
+        thestart = _epoch + theprocess.start
+        thecputime = (thenow - thestart) * (thepid % 7) / 20.0
+        return (thestart, self._cpuPercent(thesamples, thepid, thestart, thecputime, thenow), (thepid % 50) / 10.0)
+
+
+class _processWatcher(object):
+    """ Process exit watcher of the simulated system
+    """
+    name = u'simulated'
+
+    def __init__(self, thesystem):
+        self._system = thesystem
+        self._pids = set()
+
+    def add(self, thepid):
+        if not self._system.isRunning(thepid):
+            return False
+        self._pids.add(thepid)
+        return True
+
+    def remove(self, thepid):
+        self._pids.discard(thepid)
+
+    def wait(self, thetimeout):
+        theexited = self._exited()
+        if len(theexited) == 0:
+            # wait until the timeout or the next process change
+            self._system.advance(max(min(thetimeout, self._system.nextChange()), 0))
+            theexited = self._exited()
+        return theexited
+
+    def exited(self, thepids):
+        thepids = set(thepids) & self._pids
+        self._pids = self._pids - thepids
+        return thepids
+
+    def _exited(self):
+        return set([thepid for thepid in self._pids if not self._system.isRunning(thepid)])
+
+
+class _volumeWatcher(object):
+    name = u'simulated'
+
+    def __init__(self):
+        self._first = True
+
+    def hasChanged(self):
+        (thechange, self._first) = (self._first, False)
+        return thechange
@@ -0,0 +1,186 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################################################################################
+""" Stand-in for the indigo module of the Indigo server, for the benchmarks
+
+    By Bernard Philippe (bip.philippe) (C) 2015
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.#
+
+    Provides what the plugin uses of the host API: the plugin base class, the devices,
+    the plugin preferences, the sleep and the logs. The calls to the server are counted
+    in serverCalls, and the time the plugin sleeps is given to the clock set by setClock,
+    so that the cycles run without waiting.
+"""
+####################################################################################
+
+import collections
+
+activePlugin = None
+
+# server call name -> number of calls
+serverCalls = collections.Counter()
+
+# function(seconds) called instead of sleeping
+_clock = None
+
+
+def setClock(thefunction):
+    """ Set the function called when the plugin sleeps
+
+        Args:
+            thefunction: function(seconds) advancing the clock
+    """
+    global _clock
+    _clock = thefunction
+
+
+########################################
+class Dict(dict):
+    pass
+
+
+class List(list):
+    pass
+
+
+class _enumeration(object):
+    def __init__(self, thename, thevalues):
+        for thevalue in thevalues:
+            setattr(self, thevalue, u'%s.%s' % (thename, thevalue))
+
+kStateImageSel = _enumeration(u'kStateImageSel', (u'Auto', u'None', u'AvPaused', u'AvStopped', u'AvPlaying', u'SensorOn', u'SensorOff', u'SensorTripped', u'PowerOn', u'PowerOff'))
+kDimmerRelayAction = _enumeration(u'kDimmerRelayAction', (u'TurnOn', u'TurnOff', u'Toggle', u'SetBrightness', u'BrightenBy', u'DimBy', u'AllOff', u'AllLightsOn', u'AllLightsOff'))
+kDeviceGeneralAction = _enumeration(u'kDeviceGeneralAction', (u'Beep', u'EnergyUpdate', u'EnergyReset', u'RequestStatus'))
+
+
+########################################
+class server(object):
+    """ Server log, kept in memory
+    """
+    messages = []
+
+    @staticmethod
+    def log(themessage, type=None, isError=False):
+        serverCalls[u'log'] += 1
+        server.messages.append(themessage)
+
+
+########################################
+class device(object):
+    """ Plugin device - the states pushed to the server are applied to the object,
+        as the server would do on the next device read
+    """
+    def __init__(self, theid, thename, thetypeid, theprops, thestates):
+        self.id = theid
+        self.name = thename
+        self.deviceTypeId = thetypeid
+        self.pluginProps = Dict(theprops)
+        self.states = Dict(thestates)
+        self.displayStateId = u'onOffState'
+        self.configured = True
+        self.enabled = True
+        self.stateImage = kStateImageSel.Auto
+
+    def updateStateOnServer(self, key, value, uiValue=None, decimalPlaces=None):
+        serverCalls[u'updateStateOnServer'] += 1
+        serverCalls[u'states'] += 1
+        self.states[key] = value
+
+    def updateStatesOnServer(self, thelist):
+        serverCalls[u'updateStatesOnServer'] += 1
+        serverCalls[u'states'] += len(thelist)
+        for theupdate in thelist:
+            self.states[theupdate[u'key']] = theupdate[u'value']
+
+    def updateStateImageOnServer(self, theimage):
+        serverCalls[u'updateStateImageOnServer'] += 1
+        self.stateImage = theimage
+
+    def replacePluginPropsOnServer(self, theprops):
+        serverCalls[u'replacePluginPropsOnServer'] += 1
+        self.pluginProps = Dict(theprops)
+
+    def stateListOrDisplayStateIdChanged(self):
+        serverCalls[u'stateListOrDisplayStateIdChanged'] += 1
+
+
+class _deviceList(object):
+    """ indigo.devices: the devices of the plugin by id
+    """
+    def __init__(self):
+        self._devices = collections.OrderedDict()
+
+    def clear(self):
+        self._devices.clear()
+
+    def add(self, thedevice):
+        self._devices[thedevice.id] = thedevice
+
+    def iter(self, thefilter=None):
+        # u'self' for all the devices, u'self.<device type id>' for one type
+        if (thefilter is None) or (thefilter == u'self'):
+            return iter(self._devices.values())
+        thetypeid = thefilter[len(u'self.'):]
+        return iter([thedevice for thedevice in self._devices.values() if thedevice.deviceTypeId == thetypeid])
+
+    def __iter__(self):
+        return self.iter()
+
+    def __getitem__(self, theid):
+        return self._devices[theid]
+
+    def __contains__(self, theid):
+        return theid in self._devices
+
+    def __len__(self):
+        return len(self._devices)
+
+devices = _deviceList()
+
+
+########################################
+class PluginBase(object):
+    """ Plugin base class: preferences, logs and sleep
+    """
+    class StopThread(Exception):
+        pass
+
+    def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
+        global activePlugin
+        self.pluginId = pluginId
+        self.pluginDisplayName = pluginDisplayName
+        self.pluginVersion = pluginVersion
+        self.pluginPrefs = Dict(pluginPrefs)
+        self.debug = False
+        self.errors = []
+        activePlugin = self
+
+    def __del__(self):
+        pass
+
+    def debugLog(self, themessage):
+        serverCalls[u'debugLog'] += 1
+
+    def errorLog(self, themessage):
+        serverCalls[u'errorLog'] += 1
+        self.errors.append(themessage)
+
+    def deviceUpdated(self, origDev, newDev):
+        pass
+
+    def sleep(self, theseconds):
+        if _clock is not None:
+            _clock(theseconds)
@@ -0,0 +1,73 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################################################################################
+""" Checks that the thread and event engines poll the simulated mac alike
+
+    By Bernard Philippe (bip.philippe) (C) 2015
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.#
+
+    Run with python 2.7:
+
+        python benchmarks/test_engines.py
+
+    The scenarios of bench.py are run by both engines, with the same devices and seed.
+"""
+####################################################################################
+
+import unittest
+import bench
+import indigo
+
+_sizes = (10, 100)
+_cycles = 60
+
+
+def _accountedCalls():
+    """ Subprocesses counted for each device, the plugin excluded
+    """
+    thedevices = indigo.activePlugin._accounting._devices
+    return dict([(thename, theusage.calls) for (thename, theusage) in thedevices.items() if thename != u'plugin'])
+
+
+class enginesTest(unittest.TestCase):
+
+    def _run(self, thecount, theengine):
+        (theresults, thecycles, theerrors) = bench.runScenario(thecount, _cycles, 1, 1, u'ps', theengine)
+        thestates = dict([(thedevice.id, dict(thedevice.states)) for thedevice in indigo.devices.iter(u'self')])
+        return (theresults, thestates, _accountedCalls())
+
+    def test_sameCycles(self):
+        for thecount in _sizes:
+            self._checkSameCycles(thecount)
+
+    def _checkSameCycles(self, thecount):
+        # the same simulated mac gives the same commands, pushes and states
+        (thethreadresults, thethreadstates, thethreadcalls) = self._run(thecount, u'thread')
+        (theeventresults, theeventstates, theeventcalls) = self._run(thecount, u'event')
+        for themetric in (u'subprocesses', u'stateUpdates', u'states'):
+            self.assertEqual(thethreadresults[themetric], theeventresults[themetric], u'%s with %s devices' % (themetric, thecount))
+        self.assertEqual(thethreadstates, theeventstates)
+
+        # the snapshots read for all the devices are counted for the plugin by both
+        # engines, whichever device poll needs them first: the devices are only counted
+        # for their spin commands
+        self.assertEqual(thethreadcalls, theeventcalls)
+        thespins = indigo.activePlugin._accounting._labels.get(u"touch '/Volumes/Bench Volume #/.spinner'")
+        self.assertEqual(sum(thethreadcalls.values()), 0 if thespins is None else thespins.calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################################################################################
+""" Checks of the in-process sources of the process list, against real processes
+
+    By Bernard Philippe (bip.philippe) (C) 2015
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.#
+
+    Run with python 2.7:
+
+        python benchmarks/test_processsource.py
+
+    The native source of the machine (procfs on linux, libproc on mac) is tested,
+    the tests are skipped if there is none.
+"""
+####################################################################################
+
+import sys
+import os
+import time
+import subprocess
+import unittest
+import __builtin__
+
+_benchDirectory = os.path.dirname(os.path.abspath(__file__))
+_pluginDirectory = os.path.join(_benchDirectory, u'..', u'Mac System.indigoPlugin', u'Contents', u'Server Plugin')
+
+sys.path.insert(0, _pluginDirectory)
+sys.path.insert(0, _benchDirectory)
+
+import indigo
+# the host process makes indigo a global name of the plugin modules
+__builtin__.indigo = indigo
+import processsource
+
+
+def _nativeSource():
+    for thesource in (processsource.procfsSource, processsource.libprocSource):
+        try:
+            return thesource()
+        except (OSError, AttributeError):
+            pass
+    return None
+
+
+class nativeSourceTest(unittest.TestCase):
+
+    def setUp(self):
+        indigo.PluginBase(u'bench', u'bench', u'0', {}).logLevel = 0
+        self.source = _nativeSource()
+        if self.source is None:
+            self.skipTest(u'no native process source on this system')
+        # a child process using a full cpu
+        self.child = subprocess.Popen([sys.executable, u'-c', u'while True: pass'])
+        self.pid = u'%d' % (self.child.pid)
+
+    def tearDown(self):
+        if getattr(self, 'child', None) is not None:
+            self.child.kill()
+            self.child.wait()
+
+    def test_usageAndData(self):
+        # as in a cycle: the usage is read with the table, the details just after
+        self.source.readUsage([self.pid])
+        self.source.readData([self.pid])
+        time.sleep(1)
+        theusage = self.source.readUsage([self.pid])
+        thedata = self.source.readData([self.pid])
+        self.assertGreater(theusage[self.pid][0], 50)
+        self.assertGreater(float(thedata[self.pid][u'PCpu']), 50)
+
+    def test_arguments(self):
+        # the daemon patterns match on the arguments
+        therows = [therow for therow in self.source.readTable() if therow[0] == self.pid]
+        self.assertEqual(len(therows), 1)
+        self.assertTrue(therows[0][2].endswith(u' -c while True: pass'))
+        (thematches, theinstances) = self._classify(u'python[0-9.]* +-c .+', therows)
+        self.assertEqual(thematches.get(1), therows[0])
+
+    def _classify(self, thepattern, therows):
+        theclassifier = processsource.processClassifier()
+        theclassifier.add(1, thepattern)
+        return theclassifier.classify(therows)
+
+
+class classifierTest(unittest.TestCase):
+
+    def setUp(self):
+        indigo.PluginBase(u'bench', u'bench', u'0', {}).logLevel = 0
+        self.classifier = processsource.processClassifier()
+
+    def test_names(self):
+        # a name matches the whole command or its end after a space, as egrep ' name$' did
+        therows = [(u'1', u'S', u'Finder'),
+                   (u'2', u'S', u'/usr/bin/python /opt/tools/helper'),
+                   (u'3', u'S', u'/usr/bin/open -a Google Chrome'),
+                   (u'4', u'S', u'/usr/bin/myhelper'),
+                   (u'5', u'S', u'/Applications/Google Chrome.app/Contents/MacOS/Google Chrome')]
+        self.classifier.add(1, u'Finder')
+        self.classifier.add(2, u'/opt/tools/helper')
+        self.classifier.add(3, u'Google Chrome')
+        self.classifier.add(4, u'helper', theaggregate=True)
+        (thematches, theinstances) = self.classifier.classify(therows)
+        self.assertEqual(thematches, {1:therows[0], 2:therows[1], 3:therows[2]})
+        self.assertEqual(theinstances, {})
+
+    def test_aggregate(self):
+        therows = [(u'1', u'S', u'sh -c worker'), (u'2', u'S', u'worker'), (u'3', u'S', u'coworker')]
+        self.classifier.add(1, u'worker', theaggregate=True)
+        (thematches, theinstances) = self.classifier.classify(therows)
+        self.assertEqual(thematches, {1:therows[0]})
+        self.assertEqual(theinstances, {1:therows[:2]})
+
+
+if __name__ == '__main__':
+    unittest.main()
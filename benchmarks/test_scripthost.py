@@ -0,0 +1,110 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################################################################################
+""" Checks of the persistent script host, with the shell standing in for applescript
+
+    By Bernard Philippe (bip.philippe) (C) 2015
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.#
+
+    Run with python 2.7:
+
+        python benchmarks/test_scripthost.py
+
+    The host server is run with --shell: the scripts are shell scripts run by /bin/sh.
+"""
+####################################################################################
+
+import sys
+import os
+import signal
+import unittest
+import __builtin__
+
+_benchDirectory = os.path.dirname(os.path.abspath(__file__))
+_pluginDirectory = os.path.join(_benchDirectory, u'..', u'Mac System.indigoPlugin', u'Contents', u'Server Plugin')
+sys.path.insert(0, _pluginDirectory)
+sys.path.insert(0, _benchDirectory)
+
+import indigo
+# the host process makes indigo a global name of the plugin modules
+__builtin__.indigo = indigo
+from bipIndigoFramework import scripthost
+from bipIndigoFramework import scripthostserver
+
+
+class _range(object):
+    """ NSValue of an NSRange, as given by NSAppleScript
+    """
+    def __init__(self, thelocation, thelength):
+        self.location = thelocation
+        self.length = thelength
+
+    def rangeValue(self):
+        return self
+
+
+class scriptHostTest(unittest.TestCase):
+
+    def setUp(self):
+        indigo.PluginBase(u'bench', u'bench', u'0', {}).logLevel = 0
+        self.host = scripthost.scriptHost([sys.executable, scripthost._hostServer, u'--shell'])
+
+    def tearDown(self):
+        self.host.stop()
+
+    def _serverPid(self):
+        # the shell running the script is a child of the server
+        (theoutput, theerror) = self.host.execute(u'echo $PPID', 5)
+        return int(theoutput)
+
+    def test_roundTrip(self):
+        self.assertEqual(self.host.execute(u'echo hello', 5), (b'hello\n', b''))
+        # the same server runs the next scripts
+        thepid = self._serverPid()
+        self.assertEqual(self.host.execute(u'printf "%s\\n" "café"', 5), (u'café\n'.encode('utf-8'), b''))
+        self.assertEqual(self._serverPid(), thepid)
+
+    def test_error(self):
+        self.assertEqual(self.host.execute(u'echo partial; echo failed >&2; exit 3', 5), (b'partial\n', b'failed\n'))
+        self.assertEqual(self.host.execute(u'echo next', 5), (b'next\n', b''))
+
+    def test_restartAfterDeath(self):
+        # killed between two scripts: the next script is sent to a new server
+        thepid = self._serverPid()
+        os.kill(thepid, signal.SIGKILL)
+        self.assertEqual(self.host.execute(u'echo again', 5), (b'again\n', b''))
+        self.assertNotEqual(self._serverPid(), thepid)
+
+        # killed while running a script: the script is not sent again
+        thepid = self._serverPid()
+        self.assertIsNone(self.host.execute(u'kill -9 $PPID; sleep 1', 5))
+        self.assertEqual(self.host.execute(u'echo again', 5), (b'again\n', b''))
+        self.assertNotEqual(self._serverPid(), thepid)
+
+    def test_timeout(self):
+        self.assertIsNone(self.host.execute(u'sleep 5', 0.5))
+        self.assertEqual(self.host.execute(u'echo after', 5), (b'after\n', b''))
+
+    def test_errorText(self):
+        # as osascript writes them
+        self.assertEqual(scripthostserver._errorText({u'NSAppleScriptErrorMessage':u'The variable x is not defined.', u'NSAppleScriptErrorNumber':-2753, u'NSAppleScriptErrorRange':_range(7, 1)}, u'execution error'),
+                         b'7:8: execution error: The variable x is not defined. (-2753)\n')
+        self.assertEqual(scripthostserver._errorText({u'NSAppleScriptErrorMessage':u'Expected end of line.', u'NSAppleScriptErrorNumber':-2741}, u'syntax error'),
+                         b'0:0: syntax error: Expected end of line. (-2741)\n')
+
+
+if __name__ == '__main__':
+    unittest.main()